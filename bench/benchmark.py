@@ -0,0 +1,456 @@
+# benchmark.py
+"""Benchmarks the app against a synthetic media library.
+
+Generates users with libraries of real (small) JPEG, PNG and MP4 files, starts the app on them in a
+scratch directory and times the main endpoints, one request at a time and with concurrent clients.
+Results are written as JSON, and --compare checks them against an earlier run:
+
+    python bench/benchmark.py --files 100000 --output after.json --compare before.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then left out
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_ROOT, 'selfly')
+
+PASSWORD = 'benchmark'
+# mtimes of the generated files are spread over this many years before this date, so the
+# library has a realistic timeline
+MTIME_END = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()
+MTIME_YEARS = 10
+
+# A p95 this much slower than the baseline (or a throughput this much lower) counts as a regression
+DEFAULT_THRESHOLD = 0.10
+
+
+# --- Synthetic library ---
+
+def make_images(count, rng):
+    """Makes count distinct small images as (extension, bytes): blocks of colour, JPEG and PNG alternating."""
+    from PIL import Image, ImageDraw
+    images = []
+    for i in range(count):
+        img = Image.new('RGB', (96, 64), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(6):
+            x, y = rng.randrange(96), rng.randrange(64)
+            draw.rectangle((x, y, x + rng.randrange(8, 40), y + rng.randrange(8, 30)),
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        extension = 'png' if i % 4 == 3 else 'jpg'
+        img.save(buffer, 'PNG' if extension == 'png' else 'JPEG', quality=75)
+        images.append((extension, buffer.getvalue()))
+    return images
+
+def mp4_box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def make_video(duration, width, height):
+    """Builds a tiny MP4 with just the boxes the metadata reader looks at (no real frames)."""
+    mvhd = mp4_box(b'mvhd', b'\0' * 12 + struct.pack('>II', 1000, int(duration * 1000)) + b'\0' * 80)
+    tkhd = mp4_box(b'tkhd', b'\0' * 76 + struct.pack('>II', width << 16, height << 16))
+    hdlr = mp4_box(b'hdlr', b'\0' * 8 + b'vide' + b'\0' * 12)
+    stsd = mp4_box(b'stsd', b'\0' * 4 + struct.pack('>I', 1) + struct.pack('>I4s', 16, b'avc1') + b'\0' * 8)
+    trak = mp4_box(b'trak', tkhd + mp4_box(b'mdia', hdlr + mp4_box(b'minf', mp4_box(b'stbl', stsd))))
+    return mp4_box(b'ftyp', b'isom\0\0\0\0') + mp4_box(b'mdat', b'\0' * 2048) + mp4_box(b'moov', mvhd + trak)
+
+def generate_library(workspace, args, rng):
+    """Writes the users' photo and video directories. Returns [(username, photo_dir, video_dir, file count)]."""
+    images = make_images(args.distinct_images, rng)
+    videos = [make_video(rng.uniform(2, 120), 1920, 1080) for _ in range(8)]
+    users = []
+    for u in range(args.users):
+        photo_dir = os.path.join(workspace, 'library', f"user{u}", 'photos')
+        video_dir = os.path.join(workspace, 'library', f"user{u}", 'videos')
+        os.makedirs(photo_dir)
+        os.makedirs(video_dir)
+        count = args.files // args.users + (1 if u < args.files % args.users else 0)
+        for i in range(count):
+            mtime = MTIME_END - rng.random() * MTIME_YEARS * 365 * 86400
+            if rng.random() < args.video_ratio:
+                path = os.path.join(video_dir, f"VID_{i:07d}.mp4")
+                data = rng.choice(videos)
+            else:
+                extension, data = rng.choice(images)
+                path = os.path.join(photo_dir, f"IMG_{i:07d}.{extension}")
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (mtime, mtime))
+        users.append((f"user{u}", photo_dir, video_dir, count))
+    return users
+
+
+# --- Measurements ---
+
+def peak_rss_mb():
+    """Peak resident set size of the whole process so far, in MB (None where it cannot be read).
+
+    This is a high-water mark over the whole run, so it cannot be split up by endpoint.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize(latencies, errors, elapsed):
+    """Turns per-request latencies (seconds) into the numbers that get reported."""
+    ordered = sorted(latencies)
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': to_ms(percentile(ordered, 0.50)),
+        'p95_ms': to_ms(percentile(ordered, 0.95)),
+        'p99_ms': to_ms(percentile(ordered, 0.99)),
+        'mean_ms': to_ms(sum(ordered) / len(ordered)) if ordered else None,
+        'max_ms': to_ms(ordered[-1]) if ordered else None,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+class Bench:
+    """The running app plus what the endpoint callables need: logged-in clients and sample files and cursors."""
+
+    def __init__(self, app, users, rng):
+        self.app = app
+        self.users = users
+        self.rng = rng
+        self.user_ids = {}
+        self.samples = {}  # username -> {'photos': [...], 'videos': [...], 'cursors': [...]}
+
+    def prepare(self, sample_size):
+        """Picks random files and random-depth page cursors of every user."""
+        from database import get_user_by_username, get_db_connection
+        from routes import encode_cursor
+        with self.app.app_context():
+            conn = get_db_connection()
+            for username, *_ in self.users:
+                user_id = get_user_by_username(username)['id']
+                self.user_ids[username] = user_id
+                samples = {}
+                for kind in ('photo', 'video'):
+                    rows = conn.execute('SELECT filename FROM media WHERE user_id = ? AND kind = ? '
+                                        'ORDER BY random() LIMIT ?', (user_id, kind, sample_size)).fetchall()
+                    samples[kind] = [row['filename'] for row in rows]
+                total = conn.execute('SELECT COUNT(*) FROM media WHERE user_id = ?', (user_id,)).fetchone()[0]
+                cursors = []
+                for _ in range(min(sample_size, total)):
+                    row = conn.execute('SELECT sort_key, filename FROM media WHERE user_id = ? '
+                                       'ORDER BY sort_key DESC, filename DESC LIMIT 1 OFFSET ?',
+                                       (user_id, self.rng.randrange(total))).fetchone()
+                    cursors.append(encode_cursor(row))
+                samples['cursors'] = cursors
+                self.samples[username] = samples
+
+    def client(self, username):
+        """A test client logged in as the given user."""
+        client = self.app.test_client()
+        response = client.post('/login', data={'username': username, 'password': PASSWORD})
+        if response.status_code != 302:
+            raise RuntimeError(f"Could not log in as {username}")
+        return client
+
+    def pick(self, rng, username, key):
+        values = self.samples[username][key]
+        return rng.choice(values) if values else None
+
+
+def call_get_user_media(bench, client, username, rng):
+    """The dashboard's paging query, called directly: first page or a random deeper page."""
+    from routes import get_user_media
+    cursor = bench.pick(rng, username, 'cursors') if rng.random() < 0.5 else None
+    with bench.app.app_context():
+        get_user_media(bench.user_ids[username], 20, cursor)
+    return 200
+
+def call_api_media(bench, client, username, rng):
+    cursor = bench.pick(rng, username, 'cursors') if rng.random() < 0.5 else None
+    query = f"?per_page=20&cursor={cursor}" if cursor else '?per_page=20'
+    return client.get(f"/api/media{query}").status_code
+
+def call_dashboard(bench, client, username, rng):
+    return client.get('/dashboard').status_code
+
+def call_serve_media(bench, client, username, rng):
+    filename = bench.pick(rng, username, 'photo')
+    response = client.get(f"/media/{filename}")
+    response.close()
+    return response.status_code
+
+def call_serve_media_range(bench, client, username, rng):
+    filename = bench.pick(rng, username, 'video') or bench.pick(rng, username, 'photo')
+    response = client.get(f"/media/{filename}", headers={'Range': 'bytes=0-1023'})
+    response.close()
+    return response.status_code
+
+def call_thumbnail(bench, client, username, rng):
+    filename = bench.pick(rng, username, 'photo')
+    response = client.get(f"/thumb/256/{filename}", headers={'Accept': 'image/webp'})
+    response.close()
+    return response.status_code
+
+def call_get_metadata(bench, client, username, rng):
+    filename = bench.pick(rng, username, 'photo' if rng.random() < 0.8 else 'video')
+    return client.get(f"/api/metadata/{filename}").status_code
+
+def call_admin_dashboard(bench, client, username, rng):
+    return client.get('/admin').status_code
+
+# name -> (callable, needs an admin); the admin is user0
+ENDPOINTS = {
+    'get_user_media': (call_get_user_media, False),
+    'api_media': (call_api_media, False),
+    'dashboard': (call_dashboard, False),
+    'serve_media': (call_serve_media, False),
+    'serve_media_range': (call_serve_media_range, False),
+    'thumbnail': (call_thumbnail, False),
+    'get_metadata': (call_get_metadata, False),
+    'admin_dashboard': (call_admin_dashboard, True),
+}
+
+def run_sequential(bench, name, count, warmup, seed):
+    """Times count calls of one endpoint, one after another, after warmup untimed ones."""
+    call, admin_only = ENDPOINTS[name]
+    rng = random.Random(seed)
+    users = [bench.users[0][0]] if admin_only else [user[0] for user in bench.users]
+    clients = {username: bench.client(username) for username in users}
+    for _ in range(warmup):
+        username = rng.choice(users)
+        call(bench, clients[username], username, rng)
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(count):
+        username = rng.choice(users)
+        t0 = time.perf_counter()
+        status = call(bench, clients[username], username, rng)
+        latencies.append(time.perf_counter() - t0)
+        errors += status >= 400
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+def measure_allocations(bench, name, count, seed):
+    """Peak Python heap growth (MB) over count calls of one endpoint, one after another.
+
+    Runs separately from the timed calls, since tracing allocations slows every request down. Only
+    memory allocated through Python is seen, not buffers that C extensions allocate themselves.
+    """
+    call, admin_only = ENDPOINTS[name]
+    rng = random.Random(seed)
+    users = [bench.users[0][0]] if admin_only else [user[0] for user in bench.users]
+    clients = {username: bench.client(username) for username in users}
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        for _ in range(count):
+            username = rng.choice(users)
+            call(bench, clients[username], username, rng)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round((peak - baseline) / (1024 * 1024), 2)
+
+def run_concurrent(bench, name, count, concurrency, seed):
+    """Times count calls of one endpoint spread over concurrency threads, each with its own client."""
+    call, admin_only = ENDPOINTS[name]
+    users = [bench.users[0][0]] if admin_only else [user[0] for user in bench.users]
+    latencies, error_counts = [], []
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        username = users[index % len(users)]
+        client = bench.client(username)
+        mine, errors = [], 0
+        ready.wait()
+        for _ in range(count // concurrency + (1 if index < count % concurrency else 0)):
+            t0 = time.perf_counter()
+            status = call(bench, client, username, rng)
+            mine.append(time.perf_counter() - t0)
+            errors += status >= 400
+        with lock:
+            latencies.extend(mine)
+            error_counts.append(errors)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, sum(error_counts), time.perf_counter() - started)
+    result['concurrency'] = concurrency
+    return result
+
+
+# --- Comparing runs ---
+
+def compare(baseline, current, threshold):
+    """Prints how current differs from baseline. Returns the list of regressions."""
+    regressions = []
+    print(f"\n{'mode':<11} {'endpoint':<18} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16} {'req/s':>16}")
+    for mode, results in current['results'].items():
+        for name, now in results.items():
+            before = baseline.get('results', {}).get(mode, {}).get(name)
+            if not before:
+                continue
+            cells = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+                old, new = before.get(key), now.get(key)
+                if not old or new is None:
+                    cells.append(f"{'-':>16}")
+                    continue
+                change = (new - old) / old
+                cells.append(f"{new:>9.2f} {change:+6.0%}")
+                worse = change > threshold if key == 'p95_ms' else key == 'throughput_rps' and -change > threshold
+                if worse:
+                    regressions.append(f"{mode}/{name} {key}: {old} -> {new} ({change:+.0%})")
+            print(f"{mode:<11} {name:<18} " + ' '.join(cells))
+    return regressions
+
+
+# --- Main ---
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_ROOT, capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=10000, help='media files in the library, over all users')
+    parser.add_argument('--users', type=int, default=2, help='number of users (user0 is an admin)')
+    parser.add_argument('--video-ratio', type=float, default=0.1, help='share of the files that are videos')
+    parser.add_argument('--distinct-images', type=int, default=64, help='distinct images the photos are copies of')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per endpoint and mode')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per endpoint before timing')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads in the concurrent mode (0 skips it)')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='comma-separated endpoints to run')
+    parser.add_argument('--ingest-workers', type=int, default=0,
+                        help='ingest processes running during the benchmark (0 measures the requests alone)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the library and the request mix')
+    parser.add_argument('--workspace', help='directory for the library and database (default: a temp dir)')
+    parser.add_argument('--keep', action='store_true', help='keep the temp workspace afterwards')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative slowdown counted as a regression by --compare (default 0.10)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    endpoints = [name for name in args.endpoints.split(',') if name]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        sys.exit(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    rng = random.Random(args.seed)
+    workspace = os.path.abspath(args.workspace) if args.workspace else tempfile.mkdtemp(prefix='selfly-bench-')
+    os.makedirs(workspace, exist_ok=True)
+    if os.listdir(workspace):
+        sys.exit(f"Workspace {workspace} is not empty")
+    # The app keeps its database and caches relative to the working directory, and reads its
+    # settings when imported, so all of this has to happen before the import
+    os.chdir(workspace)
+    os.environ['SELFLY_INGEST_WORKERS'] = str(args.ingest_workers)
+    os.environ['SELFLY_MEDIA_WATCHER'] = 'off'
+    sys.path.insert(0, APP_DIR)
+
+    try:
+        print(f"Generating {args.files} files for {args.users} users in {workspace}")
+        t0 = time.perf_counter()
+        users = generate_library(workspace, args, rng)
+        generate_seconds = time.perf_counter() - t0
+
+        from database import init_db, add_new_user
+        init_db()
+        for i, (username, photo_dir, video_dir, _count) in enumerate(users):
+            add_new_user(username, PASSWORD, photo_dir, video_dir, is_admin=(i == 0))
+
+        # Importing the app indexes every user directory, like a first start on an existing library
+        t0 = time.perf_counter()
+        import app as app_module
+        index_seconds = time.perf_counter() - t0
+        app = app_module.app
+        print(f"Generated in {generate_seconds:.1f}s, indexed in {index_seconds:.1f}s")
+
+        bench = Bench(app, users, rng)
+        bench.prepare(sample_size=200)
+
+        results = {'sequential': {}}
+        if args.concurrency > 0:
+            results['concurrent'] = {}
+        for name in endpoints:
+            results['sequential'][name] = run_sequential(bench, name, args.requests, args.warmup, args.seed)
+            results['sequential'][name]['heap_peak_mb'] = measure_allocations(bench, name, args.requests, args.seed)
+            if args.concurrency > 0:
+                results['concurrent'][name] = run_concurrent(bench, name, args.requests, args.concurrency, args.seed)
+            for mode in results:
+                r = results[mode][name]
+                print(f"{mode:<11} {name:<18} p50 {r['p50_ms']:>8} ms  p95 {r['p95_ms']:>8} ms  "
+                      f"p99 {r['p99_ms']:>8} ms  {r['throughput_rps']:>8} req/s  errors {r['errors']}"
+                      + (f"  heap peak {r['heap_peak_mb']} MB" if 'heap_peak_mb' in r else ''))
+
+        report = {
+            'version': git_revision(),
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'compare', 'workspace', 'keep')},
+            'setup': {'generate_seconds': round(generate_seconds, 2), 'index_seconds': round(index_seconds, 2),
+                      'process_peak_rss_mb': peak_rss_mb()},
+            'results': results,
+        }
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {output}")
+
+        if baseline_path:
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+            regressions = compare(baseline, report, args.threshold)
+            if regressions:
+                print('\nRegressions:\n  ' + '\n  '.join(regressions))
+                return 1
+            print('\nNo regressions.')
+        return 0
+    finally:
+        os.chdir(REPO_ROOT)
+        if not args.workspace and not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,7 +20,7 @@ python -m venv venv
 REM Activate the virtual environment and install dependencies
 echo Activating virtual environment and installing dependencies...
 call venv\Scripts\activate.bat
-pip install Flask requests Pillow
+pip install Flask requests Pillow numpy
 
 REM Run the application
 echo Starting the application...
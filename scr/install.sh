@@ -18,7 +18,7 @@ source venv/bin/activate
 
 # Install dependencies
 echo "Installing dependencies..."
-pip install Flask, requests, Pillow
+pip install Flask requests Pillow numpy
 
 # Run the application
 echo "Starting the application..."
@@ -1,7 +1,12 @@
 # app.py
 from flask import Flask
 from routes import main_bp
-from database import init_db
+from database import init_db, reset_db_connection
+from library import reconcile_all_media
+from ingest import start_ingest_worker
+from watcher import start_media_watcher
+from uploads import expire_uploads
+from sharing import start_share_worker
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
@@ -10,12 +15,85 @@ app.secret_key = 'changethistoasuperlongcomplexstringpleaseunlessitsalreadyonelo
 # Define allowed file extensions for uploads
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'webp', 'jpg', 'jpeg', 'gif', 'mp4', 'mov', 'avi'}
 
+# Where resized thumbnails are cached, and how big that cache may grow before old ones are evicted
+app.config['THUMBNAIL_CACHE_DIR'] = 'thumbnail_cache'
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024  # 2 GB
+
+# Let a front proxy send media files itself: None, 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx).
+# For nginx, MEDIA_ACCEL_REDIRECT_PREFIX must be an internal location that maps to the filesystem root.
+app.config['MEDIA_SENDFILE'] = None
+app.config['MEDIA_ACCEL_REDIRECT_PREFIX'] = '/protected'
+# Read size used when streaming ranges of a file ourselves
+app.config['MEDIA_STREAM_CHUNK_SIZE'] = 64 * 1024
+
+# Resumable uploads that receive nothing for this long are thrown away at startup
+app.config['UPLOAD_SESSION_MAX_AGE'] = 7 * 24 * 60 * 60  # 1 week
+# Batch uploads: how many files one request may carry, and how many are written at the same time
+app.config['UPLOAD_BATCH_MAX_FILES'] = 500
+app.config['UPLOAD_BATCH_WORKERS'] = 4
+# What to do with an upload whose content (BLAKE2b hash) is already in a library: 'off' stores it anyway,
+# 'skip' drops it if the same user has it, 'hardlink' also links to another user's copy instead of storing
+# the bytes twice (user directories must be on the same filesystem for that).
+app.config['DEDUPE_MODE'] = 'skip'
+
+# Keep the media index in sync with files that other programs add to user directories:
+# 'auto' (inotify on Linux, polling elsewhere), 'inotify', 'poll' or 'off'
+app.config['MEDIA_WATCHER'] = 'auto'
+# How often polled directories are checked for changes, in seconds
+app.config['MEDIA_WATCHER_POLL_INTERVAL'] = 30
+
+# Photos whose perceptual hashes differ in at most this many of their 64 bits are shown as near-duplicates
+app.config['DUPLICATE_MAX_DISTANCE'] = 3
+
+# Background processing of new files (hashing, EXIF, thumbnails). Set INGEST_WORKERS to 0 to turn it off.
+app.config['INGEST_WORKERS'] = 2
+app.config['INGEST_MAX_ATTEMPTS'] = 5
+# Uploads are refused with a 503 while this many uploaded files are still waiting to be processed
+app.config['INGEST_MAX_PENDING'] = 500
+
+# Public sharing: which image host to upload to, and where its API lives (point it at a local stand-in for testing)
+app.config['SHARE_PROVIDER'] = 'imagebb'
+app.config['IMAGEBB_API_URL'] = 'https://api.imgbb.com/1/upload'
+# Uploads run in the background on this many threads, and are retried with backoff on network errors
+app.config['SHARE_WORKERS'] = 2
+app.config['SHARE_MAX_ATTEMPTS'] = 4
+app.config['SHARE_CONNECT_TIMEOUT'] = 5
+app.config['SHARE_READ_TIMEOUT'] = 120
+
+# Admins can add ?profile=1 to a request to get its sampled call stacks instead of the page. Off by default,
+# since it exposes code paths; the interval is how often the stack is sampled, in seconds.
+app.config['METRICS_PROFILER'] = False
+app.config['METRICS_PROFILER_INTERVAL'] = 0.005
+
+# Any setting above can be overridden from the environment with a SELFLY_ prefix,
+# e.g. SELFLY_INGEST_WORKERS=0 or SELFLY_MEDIA_WATCHER=off (values are parsed as JSON where possible)
+app.config.from_prefixed_env('SELFLY')
+
 # Register the blueprint
 app.register_blueprint(main_bp)
 
+# Database connections are reused per thread; make sure no request leaves a transaction open on one
+app.teardown_appcontext(reset_db_connection)
+
 # Initialize the database
 init_db()
 
+# Start working through the ingest queue, including jobs left over from the last run. This comes before
+# anything that starts a thread, so the worker processes are forked from a single-threaded process.
+start_ingest_worker(app)
+
+# Watch user directories for changes. The watches are in place before the scan below, so nothing added
+# while it runs is missed; a file seen by both is simply indexed twice, which is harmless.
+start_media_watcher(app)
+
+# Pick up files that were added to user directories while the app was down
+with app.app_context():
+    reconcile_all_media()
+    expire_uploads(app.config['UPLOAD_SESSION_MAX_AGE'])
+
+# Upload shared photos to the public host in the background
+start_share_worker(app)
+
 # --- Entry Point for the Application ---
 if __name__ == '__main__':
     app.run(debug=False, port=8000, host='0.0.0.0')
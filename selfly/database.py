@@ -1,16 +1,67 @@
 # database.py
 import sqlite3
 import os
+import threading
+import time
+import json
+from metrics import DB_DURATION, count_cache, instrument_functions
 
 # Define the path to the database file
 DATABASE_PATH = 'database.db'
 
-def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_PATH)
+# Connection settings: WAL lets readers carry on while an upload commits, and the rest trade a little
+# durability on power loss (never corruption) for far fewer fsyncs and a bigger page cache
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # 16 MB
+    'PRAGMA mmap_size = 268435456',  # 256 MB
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Users looked up by ID are cached in-process for a few seconds, so the hot media routes skip the
+# database entirely. Every function that changes a user row invalidates its entry.
+USER_CACHE_TTL = 30  # seconds
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+# One open connection per thread, reused by every request and background job that runs on it
+_local = threading.local()
+
+def connect_db():
+    """Opens a new connection to the SQLite database with the app's pragmas applied."""
+    # A large statement cache means the queries below are only prepared once per connection
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_db_connection():
+    """Returns this thread's connection to the SQLite database, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != DATABASE_PATH:
+        conn = connect_db()
+        _local.conn, _local.path = conn, DATABASE_PATH
     return conn
 
+def reset_db_connection(exception=None):
+    """Rolls back anything a request left uncommitted, so the next request on this thread starts clean.
+
+    Registered with app.teardown_appcontext; the connection itself stays open for reuse.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+def ensure_column(c, table, column, declaration):
+    """Adds a column to an existing table if an older database does not have it yet. Returns True if it was added."""
+    columns = [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+        return True
+    return False
+
 def init_db():
     """Initializes the database and creates tables if they don't exist."""
     conn = get_db_connection()
@@ -31,23 +82,286 @@ def init_db():
             value TEXT
         )
     ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sort_key REAL NOT NULL,
+            UNIQUE (user_id, kind, filename)
+        )
+    ''')
+    # Derived data filled in by the ingest worker
+    ensure_column(c, 'media', 'content_hash', 'TEXT')
+    ensure_column(c, 'media', 'width', 'INTEGER')
+    ensure_column(c, 'media', 'height', 'INTEGER')
+    ensure_column(c, 'media', 'captured_at', 'REAL')
+    ensure_column(c, 'media', 'phash', 'INTEGER')  # 64-bit perceptual hash of photos, stored signed
+    camera_added = ensure_column(c, 'media', 'camera', 'TEXT')
+    # Written by the user
+    ensure_column(c, 'media', 'caption', 'TEXT')
+    ensure_column(c, 'media', 'place', 'TEXT')
+    ensure_column(c, 'media', 'crc32', 'INTEGER')  # Needed up front for resumable ZIP exports
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_user_filename ON media (user_id, filename)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_user_sort ON media (user_id, sort_key, filename)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_content_hash ON media (content_hash, user_id)')
+    # For the admin listing, which pages through everyone's media by (sort_key, id)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_sort ON media (sort_key)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_kind_sort ON media (kind, sort_key)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_media_user_kind_sort ON media (user_id, kind, sort_key)')
+
+    # Per-user file counts and byte totals, kept up to date by triggers on media
+    stats_exist = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_media_stats'").fetchone()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_media_stats (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            file_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, kind)
+        )
+    ''')
+    if not stats_exist:
+        c.execute('''
+            INSERT INTO user_media_stats (user_id, kind, file_count, total_bytes)
+            SELECT user_id, kind, COUNT(*), SUM(size) FROM media GROUP BY user_id, kind
+        ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_stats_insert AFTER INSERT ON media BEGIN
+            INSERT INTO user_media_stats (user_id, kind, file_count, total_bytes) VALUES (NEW.user_id, NEW.kind, 1, NEW.size)
+            ON CONFLICT (user_id, kind) DO UPDATE SET file_count = file_count + 1, total_bytes = total_bytes + NEW.size;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_stats_delete AFTER DELETE ON media BEGIN
+            UPDATE user_media_stats SET file_count = file_count - 1, total_bytes = total_bytes - OLD.size
+            WHERE user_id = OLD.user_id AND kind = OLD.kind;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_stats_update AFTER UPDATE OF size ON media BEGIN
+            UPDATE user_media_stats SET total_bytes = total_bytes + NEW.size - OLD.size
+            WHERE user_id = NEW.user_id AND kind = NEW.kind;
+        END
+    ''')
+
+
+    # Per-user, per-day file counts for the timeline, kept up to date by triggers on media.
+    # Days are the UTC date of sort_key, i.e. the EXIF capture date, or the file date before ingest.
+    timeline_exists = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media_timeline'").fetchone()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS media_timeline (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+    if not timeline_exists:
+        c.execute('''
+            INSERT INTO media_timeline (user_id, day, count)
+            SELECT user_id, date(sort_key, 'unixepoch'), COUNT(*) FROM media GROUP BY 1, 2
+        ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_timeline_insert AFTER INSERT ON media BEGIN
+            INSERT INTO media_timeline (user_id, day, count) VALUES (NEW.user_id, date(NEW.sort_key, 'unixepoch'), 1)
+            ON CONFLICT (user_id, day) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_timeline_delete AFTER DELETE ON media BEGIN
+            UPDATE media_timeline SET count = count - 1 WHERE user_id = OLD.user_id AND day = date(OLD.sort_key, 'unixepoch');
+            DELETE FROM media_timeline WHERE user_id = OLD.user_id AND day = date(OLD.sort_key, 'unixepoch') AND count <= 0;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_timeline_update AFTER UPDATE OF sort_key ON media
+        WHEN date(OLD.sort_key, 'unixepoch') IS NOT date(NEW.sort_key, 'unixepoch') BEGIN
+            UPDATE media_timeline SET count = count - 1 WHERE user_id = OLD.user_id AND day = date(OLD.sort_key, 'unixepoch');
+            DELETE FROM media_timeline WHERE user_id = OLD.user_id AND day = date(OLD.sort_key, 'unixepoch') AND count <= 0;
+            INSERT INTO media_timeline (user_id, day, count) VALUES (NEW.user_id, date(NEW.sort_key, 'unixepoch'), 1)
+            ON CONFLICT (user_id, day) DO UPDATE SET count = count + 1;
+        END
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS media_metadata (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            data TEXT NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            temp_path TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_jobs (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            priority INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            available_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            UNIQUE (user_id, kind, filename)
+        )
+    ''')
+    # Bumped every time a job is queued again, so a run that started before that cannot finish it
+    ensure_column(c, 'ingest_jobs', 'generation', 'INTEGER NOT NULL DEFAULT 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, priority, available_at)')
+
+    # Uploads to a public image host, done in the background; the view page polls them by id
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS share_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            path TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            public_url TEXT,
+            last_error TEXT,
+            available_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    ensure_column(c, 'share_jobs', 'generation', 'INTEGER NOT NULL DEFAULT 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_share_jobs_status ON share_jobs (status, available_at)')
+
+    # Bumped by triggers whenever something the near-duplicate groups are built from changes, so the
+    # groups can be cached until then
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    c.execute("INSERT OR IGNORE INTO change_counters (name, value) VALUES ('phash', 0)")
+    for event, condition in (('INSERT', 'NEW.phash IS NOT NULL'), ('DELETE', 'OLD.phash IS NOT NULL'),
+                             ('UPDATE OF phash, filename, size, content_hash',
+                              'OLD.phash IS NOT NULL OR NEW.phash IS NOT NULL')):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS media_phash_{event.split()[0].lower()} AFTER {event} ON media
+            WHEN {condition} BEGIN
+                UPDATE change_counters SET value = value + 1 WHERE name = 'phash';
+            END
+        ''')
+
+    if camera_added:
+        # Fill in the camera of files ingested before the column existed, from their stored metadata
+        c.execute('''
+            UPDATE media SET camera = (
+                SELECT NULLIF(TRIM(COALESCE(json_extract(m.data, '$.camera_make'), '') || ' ' ||
+                                   COALESCE(json_extract(m.data, '$.camera_model'), '')), '')
+                FROM users JOIN media_metadata AS m
+                    ON m.path = rtrim(CASE media.kind WHEN 'video' THEN users.video_dir ELSE users.photo_dir END, '/')
+                                || '/' || media.filename
+                WHERE users.id = media.user_id)
+        ''')
+    init_search_index(c)
     conn.commit()
-    conn.close()
+
+def init_search_index(c):
+    """Creates the tag table and the FTS5 search index over media, and the triggers that keep it current.
+
+    Each media row has one index row with the same rowid. The owner column holds 'u<user id>', so a
+    search can be limited to one user inside the full-text query itself.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS media_tags (
+            media_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (media_id, tag)
+        ) WITHOUT ROWID
+    ''')
+    index_exists = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media_fts'").fetchone()
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+            owner, filename, caption, tags, camera, place, prefix = '2 3'
+        )
+    ''')
+    if not index_exists:
+        # Matches in tags and captions count for more than matches in filenames or camera names
+        c.execute("INSERT INTO media_fts (media_fts, rank) VALUES ('rank', 'bm25(0.0, 2.0, 3.0, 4.0, 1.0, 1.0)')")
+        c.execute('''
+            INSERT INTO media_fts (rowid, owner, filename, caption, tags, camera, place)
+            SELECT id, 'u' || user_id, filename, caption,
+                (SELECT group_concat(tag, ' ') FROM media_tags WHERE media_id = media.id), camera, place
+            FROM media
+        ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_fts_insert AFTER INSERT ON media BEGIN
+            INSERT INTO media_fts (rowid, owner, filename, caption, tags, camera, place)
+            VALUES (NEW.id, 'u' || NEW.user_id, NEW.filename, NEW.caption, NULL, NEW.camera, NEW.place);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_fts_delete AFTER DELETE ON media BEGIN
+            DELETE FROM media_tags WHERE media_id = OLD.id;
+            DELETE FROM media_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS media_fts_update AFTER UPDATE OF filename, caption, camera, place ON media BEGIN
+            UPDATE media_fts SET filename = NEW.filename, caption = NEW.caption, camera = NEW.camera, place = NEW.place
+            WHERE rowid = NEW.id;
+        END
+    ''')
+    for event, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS media_tags_{event.lower()} AFTER {event} ON media_tags BEGIN
+                UPDATE media_fts SET tags = (SELECT group_concat(tag, ' ') FROM media_tags WHERE media_id = {row}.media_id)
+                WHERE rowid = {row}.media_id;
+            END
+        ''')
 
 def get_user_by_username(username):
     """Retrieves a user by their username."""
     conn = get_db_connection()
     user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
     return user
 
 def get_user_by_id(user_id):
-    """Retrieves a user by their ID."""
+    """Retrieves a user by their ID, from the short-lived user cache when possible."""
+    now = time.monotonic()
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached and cached[0] > now:
+        count_cache('user', hit=True)
+        return cached[1]
+
+    count_cache('user', hit=False)
     conn = get_db_connection()
     user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    if user is not None:
+        with _user_cache_lock:
+            _user_cache[user_id] = (now + USER_CACHE_TTL, user)
     return user
 
+def invalidate_user_cache(user_id):
+    """Drops a user from the user cache after their row changed."""
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
 def add_new_user(username, password, photo_dir, video_dir, is_admin=False):
     """Adds a new user to the database."""
     try:
@@ -60,58 +374,71 @@ def add_new_user(username, password, photo_dir, video_dir, is_admin=False):
             os.makedirs(photo_dir)
         if not os.path.exists(video_dir):
             os.makedirs(video_dir)
-        conn.close()
         return True
     except sqlite3.IntegrityError:
+        conn.rollback()
         return False
 
 def get_user_directories(user_id):
-    """Returns the photo and video directories for a user."""
-    conn = get_db_connection()
-    user = conn.execute('SELECT photo_dir, video_dir FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    return user
+    """Returns the photo and video directories for a user (the cached user row, which includes them)."""
+    return get_user_by_id(user_id)
 
 def check_for_users():
     """Returns the number of users in the database."""
     conn = get_db_connection()
     count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    conn.close()
     return count
 
 def get_all_users():
     """Returns a list of all users."""
     conn = get_db_connection()
     users = conn.execute('SELECT * FROM users').fetchall()
-    conn.close()
+    return users
+
+def get_all_users_with_stats():
+    """Returns all users with their photo and video counts and total bytes, from the maintained totals."""
+    conn = get_db_connection()
+    users = conn.execute('''
+        SELECT users.*,
+            COALESCE(SUM(CASE WHEN stats.kind = 'photo' THEN stats.file_count END), 0) AS photo_count,
+            COALESCE(SUM(CASE WHEN stats.kind = 'video' THEN stats.file_count END), 0) AS video_count,
+            COALESCE(SUM(stats.total_bytes), 0) AS total_bytes
+        FROM users LEFT JOIN user_media_stats AS stats ON stats.user_id = users.id
+        GROUP BY users.id ORDER BY users.id
+    ''').fetchall()
     return users
 
 def delete_user(user_id):
     """Deletes a user from the database."""
     conn = get_db_connection()
+    conn.execute('DELETE FROM media WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM ingest_jobs WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM share_jobs WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM upload_sessions WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM user_media_stats WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM media_timeline WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
-    conn.close()
+    invalidate_user_cache(user_id)
 
 def update_user_password(user_id, new_password):
     """Updates a user's password."""
     conn = get_db_connection()
     conn.execute('UPDATE users SET password = ? WHERE id = ?', (new_password, user_id))
     conn.commit()
-    conn.close()
+    invalidate_user_cache(user_id)
 
 def update_user_admin_status(user_id, is_admin):
     """Updates a user's admin status."""
     conn = get_db_connection()
     conn.execute('UPDATE users SET is_admin = ? WHERE id = ?', (is_admin, user_id))
     conn.commit()
-    conn.close()
+    invalidate_user_cache(user_id)
 
 def get_setting(key):
     """Retrieves a setting value by its key."""
     conn = get_db_connection()
     setting = conn.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
-    conn.close()
     return setting['value'] if setting else None
 
 def add_setting(key, value):
@@ -119,4 +446,519 @@ def add_setting(key, value):
     conn = get_db_connection()
     conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
     conn.commit()
-    conn.close()
+
+# --- Media Index ---
+
+def upsert_media(user_id, kind, filename, size, mtime, content_hash=None):
+    """Adds a file to the media index, or refreshes it if it is already indexed.
+
+    content_hash can be passed when it is already known, e.g. because it was computed during the upload.
+    """
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO media (user_id, kind, filename, size, mtime, sort_key, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, kind, filename) DO UPDATE SET
+            size = excluded.size, mtime = excluded.mtime, sort_key = excluded.sort_key,
+            content_hash = excluded.content_hash, width = NULL, height = NULL, captured_at = NULL, phash = NULL,
+            camera = NULL, crc32 = NULL
+    ''', (user_id, kind, filename, size, mtime, mtime, content_hash))
+    conn.commit()
+
+def delete_media(user_id, filename):
+    """Removes a file from the media index."""
+    conn = get_db_connection()
+    conn.execute('DELETE FROM media WHERE user_id = ? AND filename = ?', (user_id, filename))
+    conn.commit()
+
+def get_indexed_media(user_id, kind, filenames=None):
+    """Returns a dict of filename -> (size, mtime) for one kind of a user's indexed media.
+
+    If filenames is given, only those files are looked up.
+    """
+    conn = get_db_connection()
+    if filenames is None:
+        rows = conn.execute('SELECT filename, size, mtime FROM media WHERE user_id = ? AND kind = ?',
+                            (user_id, kind)).fetchall()
+    else:
+        filenames = list(filenames)
+        rows = []
+        # Stay well below SQLite's limit on the number of query parameters
+        for start in range(0, len(filenames), 500):
+            batch = filenames[start:start + 500]
+            rows += conn.execute(f'''
+                SELECT filename, size, mtime FROM media WHERE user_id = ? AND kind = ?
+                AND filename IN ({', '.join('?' * len(batch))})
+            ''', (user_id, kind, *batch)).fetchall()
+    return {row['filename']: (row['size'], row['mtime']) for row in rows}
+
+def get_export_batch(user_id, limit, after=None, start=None, end=None):
+    """Returns the next batch of a user's media for an export, ordered by (kind, filename).
+
+    after is the (kind, filename) of the last row of the previous batch; start and end bound the sort key.
+    """
+    clauses = ['user_id = ?']
+    params = [user_id]
+    for clause, value in (('sort_key >= ?', start), ('sort_key < ?', end)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    if after is not None:
+        clauses.append('(kind, filename) > (?, ?)')
+        params += list(after)
+    conn = get_db_connection()
+    return conn.execute(f'''
+        SELECT kind, filename, size, mtime, crc32 FROM media WHERE {' AND '.join(clauses)}
+        ORDER BY kind, filename LIMIT ?
+    ''', (*params, limit)).fetchall()
+
+def get_export_selection(user_id, filenames):
+    """Returns the indexed media among filenames for an export, ordered by (kind, filename)."""
+    conn = get_db_connection()
+    filenames = list(dict.fromkeys(filenames))
+    rows = []
+    for start in range(0, len(filenames), 500):
+        batch = filenames[start:start + 500]
+        rows += conn.execute(f'''
+            SELECT kind, filename, size, mtime, crc32 FROM media
+            WHERE user_id = ? AND filename IN ({', '.join('?' * len(batch))})
+        ''', (user_id, *batch)).fetchall()
+    return sorted(rows, key=lambda row: (row['kind'], row['filename']))
+
+def set_media_crc32(user_id, kind, filename, size, mtime, crc):
+    """Stores a file's CRC-32 worked out during an export, unless the file has changed since it was indexed."""
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE media SET crc32 = ? WHERE user_id = ? AND kind = ? AND filename = ? AND size = ? AND mtime = ?
+    ''', (crc, user_id, kind, filename, size, mtime))
+    conn.commit()
+
+def rename_media(user_id, kind, old_filename, new_filename, old_path, new_path):
+    """Renames an indexed file, keeping everything already derived from it.
+
+    A file that was replaced by the rename is dropped from the index first. Returns False if
+    old_filename was not indexed.
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.execute('DELETE FROM media WHERE user_id = ? AND kind = ? AND filename = ?', (user_id, kind, new_filename))
+        renamed = conn.execute('UPDATE media SET filename = ? WHERE user_id = ? AND kind = ? AND filename = ?',
+                               (new_filename, user_id, kind, old_filename)).rowcount
+        conn.execute('DELETE FROM ingest_jobs WHERE user_id = ? AND kind = ? AND filename = ?',
+                     (user_id, kind, new_filename))
+        conn.execute('UPDATE ingest_jobs SET filename = ?, path = ? WHERE user_id = ? AND kind = ? AND filename = ?',
+                     (new_filename, new_path, user_id, kind, old_filename))
+        conn.execute('DELETE FROM media_metadata WHERE path = ?', (new_path,))
+        conn.execute('UPDATE media_metadata SET path = ? WHERE path = ?', (new_path, old_path))
+    return renamed > 0
+
+def apply_media_changes(user_id, kind, upserts, removals):
+    """Applies a batch of index changes in one transaction.
+
+    upserts is a list of (filename, size, mtime, content_hash) tuples, with content_hash None when it
+    is not known yet, and removals a list of filenames.
+    """
+    conn = get_db_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO media (user_id, kind, filename, size, mtime, sort_key, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, kind, filename) DO UPDATE SET
+                size = excluded.size, mtime = excluded.mtime, sort_key = excluded.sort_key,
+                content_hash = excluded.content_hash, width = NULL, height = NULL, captured_at = NULL, phash = NULL,
+                camera = NULL, crc32 = NULL
+        ''', [(user_id, kind, filename, size, mtime, mtime, content_hash)
+              for filename, size, mtime, content_hash in upserts])
+        conn.executemany('DELETE FROM media WHERE user_id = ? AND kind = ? AND filename = ?',
+                         [(user_id, kind, filename) for filename in removals])
+
+def find_media_by_hash(content_hash, user_id=None):
+    """Returns indexed files with the given content hash, with their owner's directories.
+
+    With a user_id only that user's files are returned.
+    """
+    conn = get_db_connection()
+    query = '''
+        SELECT media.*, users.photo_dir, users.video_dir FROM media JOIN users ON users.id = media.user_id
+        WHERE media.content_hash = ?
+    '''
+    if user_id is None:
+        return conn.execute(query, (content_hash,)).fetchall()
+    return conn.execute(query + ' AND media.user_id = ?', (content_hash, user_id)).fetchall()
+
+def get_perceptual_hashes(user_id=None):
+    """Returns the photos that have a perceptual hash, with their owner's username.
+
+    With a user_id only that user's photos are returned.
+    """
+    conn = get_db_connection()
+    query = '''
+        SELECT media.user_id, media.filename, media.size, media.mtime, media.content_hash, media.phash,
+            users.username
+        FROM media JOIN users ON users.id = media.user_id
+        WHERE media.phash IS NOT NULL
+    '''
+    if user_id is None:
+        return conn.execute(query + ' ORDER BY media.id').fetchall()
+    return conn.execute(query + ' AND media.user_id = ? ORDER BY media.id', (user_id,)).fetchall()
+
+def get_phash_version():
+    """Returns a number that changes whenever a perceptual hash, or a photo that has one, changes."""
+    conn = get_db_connection()
+    return conn.execute("SELECT value FROM change_counters WHERE name = 'phash'").fetchone()[0]
+
+def get_photos_missing_phash():
+    """Returns processed photos that have no perceptual hash yet, e.g. because they were ingested before it existed."""
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT media.user_id, media.filename, users.photo_dir
+        FROM media JOIN users ON users.id = media.user_id
+        WHERE media.kind = 'photo' AND media.phash IS NULL AND media.content_hash IS NOT NULL
+    ''').fetchall()
+    return rows
+
+def get_media_page(user_id, limit, after=None, start=None, end=None):
+    """Returns one page of a user's indexed media, newest first.
+
+    after is the (sort_key, filename) of the last row of the previous page, or None for the first page.
+    start and end optionally limit the page to sort keys in [start, end).
+    """
+    clauses = ['user_id = ?']
+    params = [user_id]
+    if start is not None:
+        clauses.append('sort_key >= ?')
+        params.append(start)
+    if end is not None:
+        clauses.append('sort_key < ?')
+        params.append(end)
+    if after is not None:
+        clauses.append('(sort_key, filename) < (?, ?)')
+        params.extend(after)
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT * FROM media WHERE {' AND '.join(clauses)}
+        ORDER BY sort_key DESC, filename DESC LIMIT ?
+    ''', (*params, limit)).fetchall()
+    return rows
+
+# Length of the day string prefix that identifies each timeline bucket
+TIMELINE_PERIODS = {'year': 4, 'month': 7, 'day': 10}
+
+def get_timeline(user_id, granularity, start_day=None, end_day=None):
+    """Returns (period, count) rows for a user's media per year, month or day, newest first.
+
+    Read from the media_timeline totals, so the cost depends on the number of days with media, not
+    on the number of files. start_day and end_day ('YYYY-MM-DD', inclusive) limit the range.
+    """
+    length = TIMELINE_PERIODS[granularity]
+    clauses = ['user_id = ?']
+    params = [user_id]
+    if start_day is not None:
+        clauses.append('day >= ?')
+        params.append(start_day)
+    if end_day is not None:
+        clauses.append('day <= ?')
+        params.append(end_day)
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT substr(day, 1, {length}) AS period, SUM(count) AS count FROM media_timeline
+        WHERE {' AND '.join(clauses)}
+        GROUP BY period ORDER BY period DESC
+    ''', params).fetchall()
+    return rows
+
+def update_media_details(user_id, kind, filename, size, mtime, details):
+    """Stores what the ingest worker derived from a file.
+
+    Nothing is written if the file has changed since the worker looked at it. Returns whether the details were stored.
+    """
+    conn = get_db_connection()
+    cursor = conn.execute('''
+        UPDATE media SET content_hash = ?, crc32 = ?, width = ?, height = ?, captured_at = ?, phash = ?, camera = ?,
+            sort_key = COALESCE(?, mtime)
+        WHERE user_id = ? AND kind = ? AND filename = ? AND size = ? AND mtime = ?
+    ''', (details['content_hash'], details['crc32'], details['width'], details['height'], details['captured_at'],
+          details['phash'], details['camera'], details['captured_at'], user_id, kind, filename, size, mtime))
+    conn.commit()
+    return cursor.rowcount > 0
+
+def get_admin_media_page(limit, user_id=None, kind=None, start=None, end=None, min_size=None, max_size=None,
+                         after=None):
+    """Returns one page of everyone's indexed media, newest first, with the owner's username.
+
+    All filters are optional: start and end bound the sort key (capture time, else mtime), min_size
+    and max_size are in bytes. after is the (sort_key, id) of the last row of the previous page.
+    """
+    clauses = []
+    params = []
+    for clause, value in (('media.user_id = ?', user_id), ('media.kind = ?', kind),
+                          ('media.sort_key >= ?', start), ('media.sort_key < ?', end),
+                          ('media.size >= ?', min_size), ('media.size <= ?', max_size)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    if after is not None:
+        clauses.append('(media.sort_key, media.id) < (?, ?)')
+        params.extend(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    conn = get_db_connection()
+    # CROSS JOIN keeps media as the outer loop, so the page is read in index order and stops at the limit
+    rows = conn.execute(f'''
+        SELECT media.*, users.username FROM media CROSS JOIN users ON users.id = media.user_id
+        {where}
+        ORDER BY media.sort_key DESC, media.id DESC LIMIT ?
+    ''', (*params, limit)).fetchall()
+    return rows
+
+def get_media_item(user_id, filename):
+    """Returns a user's indexed media row for a filename, or None."""
+    conn = get_db_connection()
+    item = conn.execute('SELECT * FROM media WHERE user_id = ? AND filename = ?', (user_id, filename)).fetchone()
+    return item
+
+# --- Tags, Captions and Search ---
+
+def get_media_tags(media_id):
+    """Returns the tags of a media row, sorted."""
+    conn = get_db_connection()
+    rows = conn.execute('SELECT tag FROM media_tags WHERE media_id = ? ORDER BY tag', (media_id,)).fetchall()
+    return [row['tag'] for row in rows]
+
+def set_media_annotations(media_id, caption, place, tags):
+    """Replaces the caption, place and tags of a media row. The search index follows through triggers."""
+    conn = get_db_connection()
+    with conn:
+        conn.execute('UPDATE media SET caption = ?, place = ? WHERE id = ?', (caption, place, media_id))
+        conn.execute('DELETE FROM media_tags WHERE media_id = ?', (media_id,))
+        conn.executemany('INSERT INTO media_tags (media_id, tag) VALUES (?, ?)', [(media_id, tag) for tag in tags])
+
+# The media_fts columns a search looks in; owner is only there to limit a search to one user
+SEARCH_COLUMNS = ('filename', 'caption', 'tags', 'camera', 'place')
+
+def build_search_query(user_id, text):
+    """Turns what the user typed into an FTS5 query: every word must match as a prefix, within their media.
+
+    Words are quoted, so FTS5 operators and punctuation in the input are searched for literally.
+    Returns None if there is nothing to search for.
+    """
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    # The words are limited to the content columns, or 'u' would match every owner value
+    terms = ' AND '.join(f'"{word}"*' for word in words)
+    return f'owner:u{int(user_id)} AND {{{" ".join(SEARCH_COLUMNS)}}}: ({terms})'
+
+def search_media(user_id, text, limit, after=None):
+    """Returns one page of a user's media matching a search, best matches first.
+
+    Each row carries its bm25 score; after is the (score, id) of the last row of the previous page.
+    """
+    query = build_search_query(user_id, text)
+    if query is None:
+        return []
+    conn = get_db_connection()
+    if after is None:
+        rows = conn.execute('''
+            SELECT media.*, media_fts.rank AS score FROM media_fts JOIN media ON media.id = media_fts.rowid
+            WHERE media_fts MATCH ? ORDER BY media_fts.rank, media_fts.rowid LIMIT ?
+        ''', (query, limit)).fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT media.*, media_fts.rank AS score FROM media_fts JOIN media ON media.id = media_fts.rowid
+            WHERE media_fts MATCH ? AND (media_fts.rank, media_fts.rowid) > (?, ?)
+            ORDER BY media_fts.rank, media_fts.rowid LIMIT ?
+        ''', (query, after[0], after[1], limit)).fetchall()
+    return rows
+
+def get_stored_metadata(path, size, mtime):
+    """Returns the extracted metadata for this exact version of a file, or None if it has not been extracted."""
+    conn = get_db_connection()
+    row = conn.execute('SELECT data FROM media_metadata WHERE path = ? AND size = ? AND mtime = ?',
+                       (path, size, mtime)).fetchone()
+    return json.loads(row['data']) if row else None
+
+def store_metadata(path, size, mtime, data):
+    """Saves extracted metadata for a file version, replacing what was stored for older versions."""
+    conn = get_db_connection()
+    conn.execute('INSERT OR REPLACE INTO media_metadata (path, size, mtime, data) VALUES (?, ?, ?, ?)',
+                 (path, size, mtime, json.dumps(data)))
+    conn.commit()
+
+# --- Resumable Uploads ---
+
+def create_upload_session(upload_id, user_id, kind, filename, temp_path, total_size):
+    """Records a new resumable upload."""
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO upload_sessions (id, user_id, kind, filename, temp_path, total_size, received, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+    ''', (upload_id, user_id, kind, filename, temp_path, total_size, time.time()))
+    conn.commit()
+
+def get_upload_session(upload_id, user_id):
+    """Returns one of a user's upload sessions, or None."""
+    conn = get_db_connection()
+    upload = conn.execute('SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?', (upload_id, user_id)).fetchone()
+    return upload
+
+def update_upload_progress(upload_id, received):
+    """Stores how many bytes of an upload have been written."""
+    conn = get_db_connection()
+    conn.execute('UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?',
+                 (received, time.time(), upload_id))
+    conn.commit()
+
+def delete_upload_session(upload_id):
+    """Removes a finished or cancelled upload session."""
+    conn = get_db_connection()
+    conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    conn.commit()
+
+def get_expired_upload_sessions(max_age):
+    """Returns upload sessions that have not been touched for max_age seconds."""
+    conn = get_db_connection()
+    uploads = conn.execute('SELECT * FROM upload_sessions WHERE updated_at < ?', (time.time() - max_age,)).fetchall()
+    return uploads
+
+# --- Job Queues ---
+
+# Tables that hold background jobs, with the order due jobs are claimed in. Each has the columns status,
+# attempts, last_error, available_at, updated_at and generation, and the helpers below work on any of them.
+JOB_QUEUES = {
+    'ingest_jobs': 'priority, available_at',
+    'share_jobs': 'available_at',
+}
+
+def job_table(queue):
+    """Returns the table of a job queue, after checking it is one of JOB_QUEUES and so safe to put in SQL."""
+    if queue not in JOB_QUEUES:
+        raise ValueError(f"Unknown job queue: {queue}")
+    return queue
+
+def claim_jobs(queue, limit):
+    """Marks up to limit due jobs of a queue as running and returns them."""
+    table = job_table(queue)
+    now = time.time()
+    conn = get_db_connection()
+    with conn:
+        jobs = conn.execute(f'''
+            SELECT * FROM {table} WHERE status = 'pending' AND available_at <= ? ORDER BY {JOB_QUEUES[table]} LIMIT ?
+        ''', (now, limit)).fetchall()
+        conn.executemany(f"UPDATE {table} SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                         [(now, job['id']) for job in jobs])
+    return jobs
+
+def next_job_due(queue):
+    """Returns when the next pending job of a queue becomes due, or None if there is none."""
+    table = job_table(queue)
+    conn = get_db_connection()
+    row = conn.execute(f"SELECT MIN(available_at) AS due FROM {table} WHERE status = 'pending'").fetchone()
+    return row['due']
+
+def finish_job(queue, job, **fields):
+    """Marks a claimed job as done and stores fields (column -> value) with it.
+
+    Nothing is written if the job was queued again since it was claimed: that newer run finishes it.
+    """
+    table = job_table(queue)
+    assignments = ''.join(f', {column} = ?' for column in fields)
+    conn = get_db_connection()
+    conn.execute(f'''
+        UPDATE {table} SET status = 'done', last_error = NULL, updated_at = ?{assignments}
+        WHERE id = ? AND generation = ? AND status = 'running'
+    ''', (time.time(), *fields.values(), job['id'], job['generation']))
+    conn.commit()
+
+def fail_job(queue, job, error, retry_delay=None):
+    """Records a failed attempt of a claimed job. It is retried after retry_delay seconds, or marked failed if None.
+
+    Like finish_job, this leaves a job alone that was queued again since it was claimed.
+    """
+    table = job_table(queue)
+    now = time.time()
+    conn = get_db_connection()
+    if retry_delay is None:
+        conn.execute(f'''
+            UPDATE {table} SET status = 'failed', last_error = ?, updated_at = ?
+            WHERE id = ? AND generation = ? AND status = 'running'
+        ''', (error, now, job['id'], job['generation']))
+    else:
+        conn.execute(f'''
+            UPDATE {table} SET status = 'pending', last_error = ?, available_at = ?, updated_at = ?
+            WHERE id = ? AND generation = ? AND status = 'running'
+        ''', (error, now + retry_delay, now, job['id'], job['generation']))
+    conn.commit()
+
+def requeue_running_jobs(queue):
+    """Puts jobs of a queue that were running when the app stopped back in the queue."""
+    table = job_table(queue)
+    conn = get_db_connection()
+    conn.execute(f"UPDATE {table} SET status = 'pending' WHERE status = 'running'")
+    conn.commit()
+
+# --- Ingest Queue ---
+
+# Job priorities: uploads are worked on before files found by a library scan
+PRIORITY_UPLOAD = 0
+PRIORITY_SCAN = 1
+
+def enqueue_ingest_jobs(jobs, priority=PRIORITY_UPLOAD):
+    """Queues derived-data work for files. jobs is a list of (user_id, kind, filename, path) tuples.
+
+    A file that already has a job gets it reset to pending, in a new generation, even if it is running.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO ingest_jobs (user_id, kind, filename, path, status, priority, attempts, available_at, updated_at)
+            VALUES (?, ?, ?, ?, 'pending', ?, 0, ?, ?)
+            ON CONFLICT (user_id, kind, filename) DO UPDATE SET
+                path = excluded.path, status = 'pending', priority = excluded.priority, attempts = 0,
+                last_error = NULL, available_at = excluded.available_at, updated_at = excluded.updated_at,
+                generation = ingest_jobs.generation + 1
+        ''', [(user_id, kind, filename, path, priority, now, now) for user_id, kind, filename, path in jobs])
+
+def count_pending_ingest_jobs(priority=PRIORITY_UPLOAD):
+    """Returns how many ingest jobs of a priority are waiting or running."""
+    conn = get_db_connection()
+    count = conn.execute('''
+        SELECT COUNT(*) FROM ingest_jobs WHERE status IN ('pending', 'running') AND priority = ?
+    ''', (priority,)).fetchone()[0]
+    return count
+
+def get_ingest_job_counts():
+    """Returns a dict of job status -> number of jobs."""
+    conn = get_db_connection()
+    rows = conn.execute('SELECT status, COUNT(*) AS count FROM ingest_jobs GROUP BY status').fetchall()
+    return {row['status']: row['count'] for row in rows}
+
+def get_recent_failed_ingest_jobs(limit=20):
+    """Returns the most recently failed ingest jobs, with the owner's username."""
+    conn = get_db_connection()
+    jobs = conn.execute('''
+        SELECT ingest_jobs.*, users.username FROM ingest_jobs JOIN users ON users.id = ingest_jobs.user_id
+        WHERE ingest_jobs.status = 'failed' ORDER BY ingest_jobs.updated_at DESC LIMIT ?
+    ''', (limit,)).fetchall()
+    return jobs
+
+# --- Public Share Queue ---
+
+def create_share_job(job_id, user_id, filename, path, provider):
+    """Queues the upload of a user's file to a public image host."""
+    now = time.time()
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO share_jobs (id, user_id, filename, path, provider, available_at, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, user_id, filename, path, provider, now, now, now))
+    conn.commit()
+
+def get_share_job(job_id, user_id):
+    """Returns one of a user's share jobs, or None."""
+    conn = get_db_connection()
+    return conn.execute('SELECT * FROM share_jobs WHERE id = ? AND user_id = ?', (job_id, user_id)).fetchone()
+
+
+# Time every helper above for /metrics. Connection handling and schema setup are left out.
+instrument_functions(globals(), DB_DURATION, exclude={'connect_db', 'get_db_connection', 'reset_db_connection',
+                                                      'init_db', 'init_search_index', 'ensure_column',
+                                                      'build_search_query', 'job_table'})
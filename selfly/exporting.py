@@ -0,0 +1,261 @@
+# exporting.py
+import os
+import time
+import zlib
+import array
+import struct
+import hashlib
+from library import kind_directory
+from database import get_export_batch, get_export_selection, set_media_crc32
+
+# Rows read from the media index at a time while walking an export
+EXPORT_BATCH_SIZE = 500
+
+# Sizes, offsets and counts at or above these need the ZIP64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+# What goes in the classic fields when the real value is in a ZIP64 record
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP64_COUNT_MARKER = 0xFFFF
+
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+FLAG_DATA_DESCRIPTOR = 0x0008
+FLAG_UTF8 = 0x0800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+
+# Folder each kind of media goes in inside the archive
+ARCHIVE_FOLDERS = {'photo': 'photos', 'video': 'videos'}
+
+
+class ExportChanged(Exception):
+    """The library changed while an archive was being sent, so the rest of it would not match what was promised."""
+
+
+def dos_datetime(mtime):
+    """Converts an mtime to the (time, date) pair ZIP headers use, in UTC so archives come out the same everywhere."""
+    t = time.gmtime(min(max(mtime, 315532800), 4354819198))  # DOS dates run from 1980 to 2107
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipExport:
+    """A ZIP archive of some of a user's media, generated as a stream.
+
+    Files are STORED: photos and videos are compressed already, so deflating them again costs time
+    and saves next to nothing. The entries are read from the media index in batches each time the
+    archive is walked, and file data is read in chunks, so memory use does not depend on the size
+    of the library.
+
+    When the index has the CRC-32 of every file (the ingest worker computes it), the archive is
+    fully known before a byte is read: its length and ETag can be sent up front and any byte range
+    of it can be produced on its own, which is what lets downloads resume. Otherwise the CRCs are
+    worked out while sending, written after each file in a data descriptor, and the archive can
+    only be sent from the start.
+    """
+
+    def __init__(self, user, filenames=None, start=None, end=None, chunk_size=64 * 1024):
+        self.user = user
+        self.filenames = filenames
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.plan()
+
+    # --- Walking the entries ---
+
+    def rows(self):
+        """Yields the selected media rows, ordered by (kind, filename)."""
+        if self.filenames is not None:
+            yield from get_export_selection(self.user['id'], self.filenames)
+            return
+        after = None
+        while True:
+            rows = get_export_batch(self.user['id'], EXPORT_BATCH_SIZE, after, self.start, self.end)
+            yield from rows
+            if len(rows) < EXPORT_BATCH_SIZE:
+                return
+            after = (rows[-1]['kind'], rows[-1]['filename'])
+
+    def entries(self):
+        """Yields (row, archive name as bytes, path, offset of the local header) for every entry."""
+        offset = 0
+        for row in self.rows():
+            name = f"{ARCHIVE_FOLDERS[row['kind']]}/{row['filename']}".encode('utf-8')
+            path = os.path.join(kind_directory(self.user, row['kind']), row['filename'])
+            yield row, name, path, offset
+            offset += self.local_header_length(row, name) + row['size'] + self.descriptor_length(row)
+
+    def plan(self):
+        """Works out the mode, length and ETag of the archive."""
+        self.deterministic = True
+        self.count = 0
+        for row in self.rows():
+            self.deterministic = self.deterministic and row['crc32'] is not None
+            self.count += 1
+
+        digest = self.new_fingerprint()
+        self.central_offset = 0
+        self.central_size = 0
+        for row, name, _path, offset in self.entries():
+            self.add_to_fingerprint(digest, row, name)
+            self.central_offset = offset + self.local_header_length(row, name) + row['size'] + self.descriptor_length(row)
+            self.central_size += CENTRAL_HEADER.size + len(name) + len(self.central_extra(row, offset))
+        self.etag = digest.hexdigest()
+        self.length = self.central_offset + self.central_size + len(self.end_records())
+
+    def new_fingerprint(self):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(b'stored' if self.deterministic else b'descriptors')
+        return digest
+
+    def add_to_fingerprint(self, digest, row, name):
+        """Adds an entry to the hash that identifies the archive (its ETag). Stored CRCs only count when the
+        headers carry them: in descriptor mode the export itself fills them in as it goes."""
+        crc = row['crc32'] if self.deterministic else None
+        digest.update(b'%s\0%d\0%r\0%r\n' % (name, row['size'], row['mtime'], crc))
+
+    # --- Records ---
+
+    def local_header_length(self, row, name):
+        return LOCAL_HEADER.size + len(name) + (20 if row['size'] >= ZIP64_LIMIT else 0)
+
+    def descriptor_length(self, row):
+        if self.deterministic:
+            return 0
+        return 24 if row['size'] >= ZIP64_LIMIT else 16
+
+    def local_header(self, row, name):
+        zip64 = row['size'] >= ZIP64_LIMIT
+        clock, date = dos_datetime(row['mtime'])
+        flags = FLAG_UTF8
+        if self.deterministic:
+            crc, size = row['crc32'], row['size']
+        else:
+            # Filled in by the data descriptor after the file
+            flags |= FLAG_DATA_DESCRIPTOR
+            crc, size = 0, 0
+        extra = struct.pack('<HHQQ', 1, 16, size, size) if zip64 else b''
+        header_size = ZIP64_MARKER if zip64 else size
+        return LOCAL_HEADER.pack(0x04034b50, ZIP64_VERSION if zip64 else ZIP_VERSION, flags, 0, clock, date, crc,
+                                 header_size, header_size, len(name), len(extra)) + name + extra
+
+    def descriptor(self, row, crc):
+        if row['size'] >= ZIP64_LIMIT:
+            return struct.pack('<IIQQ', 0x08074b50, crc, row['size'], row['size'])
+        return struct.pack('<IIII', 0x08074b50, crc, row['size'], row['size'])
+
+    def central_extra(self, row, offset):
+        values = []
+        if row['size'] >= ZIP64_LIMIT:
+            values += [row['size'], row['size']]
+        if offset >= ZIP64_LIMIT:
+            values.append(offset)
+        if not values:
+            return b''
+        return struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values)
+
+    def central_header(self, row, name, offset, crc):
+        extra = self.central_extra(row, offset)
+        zip64 = bool(extra)
+        clock, date = dos_datetime(row['mtime'])
+        flags = FLAG_UTF8 | (0 if self.deterministic else FLAG_DATA_DESCRIPTOR)
+        size = ZIP64_MARKER if row['size'] >= ZIP64_LIMIT else row['size']
+        version = ZIP64_VERSION if zip64 else ZIP_VERSION
+        return CENTRAL_HEADER.pack(0x02014b50, version, version, flags, 0, clock, date, crc, size, size,
+                                   len(name), len(extra), 0, 0, 0, 0,
+                                   ZIP64_MARKER if offset >= ZIP64_LIMIT else offset) + name + extra
+
+    def end_records(self):
+        """The end of central directory record, preceded by the ZIP64 ones when the archive needs them."""
+        records = b''
+        count, central_size, central_offset = self.count, self.central_size, self.central_offset
+        if count >= ZIP64_COUNT_LIMIT or central_size >= ZIP64_LIMIT or central_offset >= ZIP64_LIMIT:
+            zip64_end_offset = self.central_offset + self.central_size
+            records += ZIP64_END_RECORD.pack(0x06064b50, ZIP64_END_RECORD.size - 12, ZIP64_VERSION, ZIP64_VERSION,
+                                             0, 0, self.count, self.count, self.central_size, self.central_offset)
+            records += ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+            count, central_size, central_offset = ZIP64_COUNT_MARKER, ZIP64_MARKER, ZIP64_MARKER
+        records += END_RECORD.pack(0x06054b50, 0, 0, count, count, central_size, central_offset, 0)
+        return records
+
+    # --- Streaming ---
+
+    def read_file(self, row, path, first, last):
+        """Yields bytes first..last of a file, after checking it is still the version that was indexed."""
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size != row['size'] or stat.st_mtime != row['mtime']:
+                raise ExportChanged(f"{path} changed since it was indexed")
+            f.seek(first)
+            remaining = last - first
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise ExportChanged(f"{path} got shorter while it was being sent")
+                remaining -= len(chunk)
+                yield chunk
+
+    def generate(self, start=0, stop=None):
+        """Yields the bytes of the archive from start up to stop. Only deterministic archives can start past 0."""
+        stop = self.length if stop is None else stop
+        if start and not self.deterministic:
+            raise ValueError("Only archives with known CRCs can be sent from an offset")
+        position = 0
+
+        def clip(data):
+            # The part of data (which starts at position) that falls inside start..stop
+            return data[max(start - position, 0):max(stop - position, 0)]
+
+        crcs = array.array('I')  # Worked out while sending, when the index did not have them
+        for row, name, path, _offset in self.entries():
+            if position >= stop:
+                return
+            header = self.local_header(row, name)
+            if position + len(header) > start:
+                yield clip(header)
+            position += len(header)
+
+            size = row['size']
+            if self.deterministic:
+                if position + size > start and position < stop:
+                    yield from self.read_file(row, path, max(start - position, 0), min(stop - position, size))
+            else:
+                crc = 0
+                for chunk in self.read_file(row, path, 0, size):
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+                crcs.append(crc)
+                # Keep it, so the next export of this file can be resumed
+                set_media_crc32(self.user['id'], row['kind'], row['filename'], row['size'], row['mtime'], crc)
+                position += size
+                descriptor = self.descriptor(row, crc)
+                yield descriptor
+                position += len(descriptor)
+                continue
+            position += size
+
+        if position >= stop:
+            return
+        digest = self.new_fingerprint()
+        for index, (row, name, _path, offset) in enumerate(self.entries()):
+            if self.deterministic:
+                crc = row['crc32']
+            elif index < len(crcs):
+                crc = crcs[index]
+            else:
+                raise ExportChanged("The selection changed while the archive was being sent")
+            self.add_to_fingerprint(digest, row, name)
+            header = self.central_header(row, name, offset, crc)
+            if position + len(header) > start:
+                yield clip(header)
+            position += len(header)
+            if position >= stop:
+                return
+        if digest.hexdigest() != self.etag:
+            raise ExportChanged("The selection changed while the archive was being sent")
+        yield clip(self.end_records())
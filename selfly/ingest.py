@@ -0,0 +1,132 @@
+# ingest.py
+import os
+import zlib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from thumbnails import ensure_thumbnail, ensure_variant, record_cache_write, PREFERRED_FORMATS
+from metadata import extract_metadata
+from similarity import dhash
+from previews import previews_available, ensure_poster, ensure_preview
+from database import update_media_details, store_metadata
+from jobs import JobWorker
+
+# Made ahead of time for every new photo, in the format most browsers negotiate: the admin
+# thumbnails and the dashboard grid's variants. Videos get their poster and preview clip.
+PREGENERATED_FORMAT = (PREFERRED_FORMATS or ['image/jpeg'])[0]
+PREGENERATED_THUMBNAILS = [(256, PREGENERATED_FORMAT)]
+PREGENERATED_VARIANTS = [(320, PREGENERATED_FORMAT), (640, PREGENERATED_FORMAT)]
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# --- Work done in the worker processes ---
+
+def hash_file(path):
+    """Returns the BLAKE2b content hash and the CRC-32 (for ZIP exports) of a file, read once in fixed-size chunks."""
+    digest = hashlib.blake2b(digest_size=32)
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+    return digest.hexdigest(), crc
+
+def process_media_file(path, kind, thumbnail_cache_dir):
+    """Does all the derived-data work for one file. Runs in a worker process.
+
+    Returns the details to store, the file version they belong to, and any thumbnails that were created.
+    """
+    stat = os.stat(path)
+    metadata = extract_metadata(path, kind)
+    content_hash, crc = hash_file(path)
+    details = {
+        'content_hash': content_hash,
+        'crc32': crc,
+        'width': metadata['width'],
+        'height': metadata['height'],
+        'captured_at': metadata['captured_at'],
+        'phash': dhash(path) if kind == 'photo' else None,
+        'camera': ' '.join(filter(None, [metadata.get('camera_make'), metadata.get('camera_model')])) or None,
+    }
+    created_thumbnails = []
+    if kind == 'photo':
+        for size, mimetype in PREGENERATED_THUMBNAILS:
+            thumb_path, created = ensure_thumbnail(path, size, mimetype, thumbnail_cache_dir, content_hash)
+            if created:
+                created_thumbnails.append(thumb_path)
+        for width, mimetype in PREGENERATED_VARIANTS:
+            variant_path, created = ensure_variant(path, width, mimetype, thumbnail_cache_dir, content_hash)
+            if created:
+                created_thumbnails.append(variant_path)
+    elif previews_available():
+        # A video ffmpeg cannot decode is still indexed; it just keeps the placeholder poster
+        for ensure in (ensure_poster, ensure_preview):
+            try:
+                derived_path, created = ensure(path, thumbnail_cache_dir, metadata.get('duration'), content_hash)
+            except OSError:
+                break
+            if created:
+                created_thumbnails.append(derived_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'details': details, 'metadata': metadata,
+            'thumbnails': created_thumbnails}
+
+# --- Dispatcher running in the app process ---
+
+class IngestWorker(JobWorker):
+    """Feeds queued ingest jobs to a process pool and stores what they derived."""
+
+    queue = 'ingest_jobs'
+    name = 'ingest'
+    # Keep at most two jobs per worker in flight so the rest stay visible in the queue
+    jobs_per_worker = 2
+
+    def __init__(self, app):
+        super().__init__(app, app.config['INGEST_WORKERS'], app.config['INGEST_MAX_ATTEMPTS'])
+
+    def make_pool(self):
+        # Start the worker processes right away, before the app has other threads running, so they
+        # are never forked while another thread holds a lock
+        pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        pool.submit(os.getpid).result()
+        return pool
+
+    def submit(self, job):
+        return self.pool.submit(process_media_file, job['path'], job['kind'], self.app.config['THUMBNAIL_CACHE_DIR'])
+
+    def retry_delay(self, attempt):
+        return 30 * 2 ** (attempt - 1)
+
+    def record_result(self, job, future):
+        """Stores a finished job's output, or schedules a retry with backoff if it failed."""
+        try:
+            result = future.result()
+        except Exception as e:
+            # A file that is gone will not come back, so that is not retried
+            self.record_failure(job, e, final=isinstance(e, FileNotFoundError))
+            return
+
+        store_metadata(job['path'], result['size'], result['mtime'], result['metadata'])
+        for thumb_path in result['thumbnails']:
+            record_cache_write(self.app.config['THUMBNAIL_CACHE_DIR'], thumb_path,
+                               self.app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+        if update_media_details(job['user_id'], job['kind'], job['filename'], result['size'], result['mtime'],
+                                result['details']):
+            self.finish(job)
+        else:
+            # The file was changed or renamed while it was processed, so the details belong to a version
+            # the index no longer has. Go again rather than leave the file without them.
+            self.record_failure(job, "The file changed while it was processed")
+
+
+_worker = None
+
+def start_ingest_worker(app):
+    """Starts the app's ingest worker, unless INGEST_WORKERS is 0."""
+    global _worker
+    if app.config['INGEST_WORKERS'] > 0:
+        _worker = IngestWorker(app)
+        _worker.start()
+
+def notify_ingest_worker():
+    """Wakes the ingest worker after new jobs were queued."""
+    if _worker is not None:
+        _worker.notify()
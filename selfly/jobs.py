@@ -0,0 +1,104 @@
+# jobs.py
+import time
+import threading
+from database import claim_jobs, next_job_due, finish_job, fail_job, requeue_running_jobs
+
+# How long an idle dispatcher sleeps before looking at the queue again without being woken
+IDLE_POLL_INTERVAL = 30
+
+
+class JobWorker:
+    """Works through one of the database job queues (see JOB_QUEUES) on a pool of workers.
+
+    A dispatcher thread claims due jobs, hands them to the pool and records the results as they come
+    back, so all the database work happens on that one thread. Failed attempts are retried with
+    backoff until max_attempts. Subclasses say how to run a job and what to do with its result.
+    """
+
+    queue = None  # The JOB_QUEUES table
+    name = None  # Used in thread names and log messages
+    jobs_per_worker = 1  # Jobs handed to the pool per worker at a time
+
+    def __init__(self, app, max_workers, max_attempts):
+        self.app = app
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.wakeup = threading.Event()
+        self.in_flight = {}  # future -> job
+        self.pool = None
+        self.thread = None
+
+    def make_pool(self):
+        """Returns the executor the jobs run on."""
+        raise NotImplementedError
+
+    def submit(self, job):
+        """Starts a claimed job on the pool and returns its future."""
+        raise NotImplementedError
+
+    def record_result(self, job, future):
+        """Stores the outcome of a job whose future is done, with finish() or record_failure()."""
+        raise NotImplementedError
+
+    def retry_delay(self, attempt):
+        """Seconds to wait before retrying after the given failed attempt."""
+        raise NotImplementedError
+
+    def start(self):
+        """Starts the pool and the dispatcher thread. Jobs left running by a previous run are retried."""
+        with self.app.app_context():
+            requeue_running_jobs(self.queue)
+        self.pool = self.make_pool()
+        self.thread = threading.Thread(target=self.run, name=f"{self.name}-dispatcher", daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """Tells the dispatcher there is new work, so it does not wait for the next poll."""
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                self.dispatch()
+            except RuntimeError:
+                # The interpreter is shutting down and the pool no longer takes work
+                return
+            except Exception as e:
+                # A busy database or similar should not kill the worker for good
+                self.app.logger.error(f"{self.name.capitalize()} dispatcher error: {e}")
+                time.sleep(5)
+
+    def dispatch(self):
+        """Records finished jobs, hands due ones to free workers, then sleeps until there is more to do."""
+        with self.app.app_context():
+            for future in [future for future in self.in_flight if future.done()]:
+                self.record_result(self.in_flight.pop(future), future)
+
+            free_slots = self.max_workers * self.jobs_per_worker - len(self.in_flight)
+            jobs = claim_jobs(self.queue, free_slots) if free_slots > 0 else []
+            for job in jobs:
+                future = self.submit(job)
+                self.in_flight[future] = job
+                future.add_done_callback(lambda _future: self.wakeup.set())
+            if jobs:
+                return
+            due = next_job_due(self.queue) if free_slots > 0 else None
+
+        timeout = IDLE_POLL_INTERVAL
+        if due is not None:
+            timeout = min(timeout, max(due - time.time(), 0.1))
+        self.wakeup.wait(timeout=timeout)
+        self.wakeup.clear()
+
+    def finish(self, job, **fields):
+        """Marks a job as done, storing fields (column -> value) with it."""
+        finish_job(self.queue, job, **fields)
+
+    def record_failure(self, job, error, final=False):
+        """Schedules a retry with backoff, or gives up if final is set or the job is out of attempts."""
+        attempt = job['attempts'] + 1
+        if final or attempt >= self.max_attempts:
+            fail_job(self.queue, job, str(error))
+        else:
+            fail_job(self.queue, job, str(error), retry_delay=self.retry_delay(attempt))
+        self.app.logger.warning(f"{self.name.capitalize()} job for {job['path']} failed (attempt {attempt}): {error}")
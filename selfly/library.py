@@ -0,0 +1,160 @@
+# library.py
+import os
+import threading
+from flask import current_app
+from metrics import DIR_SCAN_DURATION, DIR_SCAN_ENTRIES
+from database import (get_user_directories, get_all_users, get_indexed_media, apply_media_changes, upsert_media,
+                      enqueue_ingest_jobs, get_photos_missing_phash, rename_media, PRIORITY_UPLOAD,
+                      PRIORITY_SCAN)
+from ingest import notify_ingest_worker
+
+# File extensions that are stored in a user's video directory
+VIDEO_EXTENSIONS = ('mp4', 'mov', 'avi')
+
+# Held while a rescan started by start_rescan runs, so only one runs at a time
+_rescan_lock = threading.Lock()
+
+def is_allowed_media(filename):
+    """Check if a file has one of the app's allowed extensions."""
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+
+def media_kind(filename):
+    """Returns 'video' or 'photo' depending on the file extension."""
+    return 'video' if filename.lower().endswith(VIDEO_EXTENSIONS) else 'photo'
+
+def kind_directory(user_dirs, kind):
+    """Returns the directory a user keeps one kind of media in."""
+    return user_dirs['video_dir'] if kind == 'video' else user_dirs['photo_dir']
+
+def media_dirs(user_dirs):
+    """Returns (kind, directory) pairs for a user's configured directories."""
+    return [('photo', user_dirs['photo_dir']), ('video', user_dirs['video_dir'])]
+
+def scan_media_dir(directory, kind):
+    """Lists the media files of one kind in a directory as filename -> (size, mtime)."""
+    found = {}
+    if not directory or not os.path.isdir(directory):
+        return found
+    with DIR_SCAN_DURATION.time(kind=kind), os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or not is_allowed_media(entry.name) or media_kind(entry.name) != kind:
+                continue
+            stat = entry.stat()
+            found[entry.name] = (stat.st_size, stat.st_mtime)
+    DIR_SCAN_ENTRIES.inc(len(found), kind=kind)
+    return found
+
+def reconcile_user_media(user_id):
+    """Brings a user's rows in the media index in line with what is on disk."""
+    user_dirs = get_user_directories(user_id)
+    if not user_dirs:
+        return
+    for kind, directory in media_dirs(user_dirs):
+        reconcile_directory(user_id, kind, directory)
+
+def reconcile_directory(user_id, kind, directory):
+    """Brings the index of one of a user's directories in line with what is on disk."""
+    on_disk = scan_media_dir(directory, kind)
+    indexed = get_indexed_media(user_id, kind)
+    upserts = [(name, size, mtime, None) for name, (size, mtime) in on_disk.items()
+               if indexed.get(name) != (size, mtime)]
+    removals = [name for name in indexed if name not in on_disk]
+    apply_scanned_changes(user_id, kind, directory, upserts, removals)
+
+def apply_scanned_changes(user_id, kind, directory, upserts, removals):
+    """Applies index changes found on disk and queues the derived-data work for new or changed files."""
+    if upserts or removals:
+        apply_media_changes(user_id, kind, upserts, removals)
+    if upserts:
+        enqueue_ingest_jobs([(user_id, kind, name, os.path.join(directory, name)) for name, _size, _mtime, _hash in upserts],
+                            priority=PRIORITY_SCAN)
+        notify_ingest_worker()
+
+def sync_media_files(user_id, kind, directory, filenames):
+    """Updates the index for just the named files of a directory, e.g. after the watcher saw them change."""
+    indexed = get_indexed_media(user_id, kind, filenames)
+    upserts = []
+    removals = []
+    for name in filenames:
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            stat = None
+        if stat and os.path.isfile(os.path.join(directory, name)) and is_allowed_media(name) and media_kind(name) == kind:
+            if indexed.get(name) != (stat.st_size, stat.st_mtime):
+                upserts.append((name, stat.st_size, stat.st_mtime, None))
+        elif name in indexed:
+            removals.append(name)
+    apply_scanned_changes(user_id, kind, directory, upserts, removals)
+
+def rename_media_file(user_id, kind, directory, old_name, new_name):
+    """Follows a rename inside a directory without redoing the derived-data work."""
+    if is_allowed_media(new_name) and media_kind(new_name) == kind and \
+            rename_media(user_id, kind, old_name, new_name,
+                         os.path.join(directory, old_name), os.path.join(directory, new_name)):
+        return
+    # Not a file we had, or it no longer looks like media: handle it as a removal plus an addition
+    sync_media_files(user_id, kind, directory, [old_name, new_name])
+
+def reconcile_all_media():
+    """Runs the reconciliation scan for every user."""
+    for user in get_all_users():
+        reconcile_user_media(user['id'])
+    queue_missing_phashes()
+
+def start_rescan(app):
+    """Runs reconcile_all_media on a background thread, so no request waits for a full scan.
+
+    Returns False if a rescan is already running.
+    """
+    if not _rescan_lock.acquire(blocking=False):
+        return False
+
+    def rescan():
+        try:
+            with app.app_context():
+                reconcile_all_media()
+        except Exception as e:
+            app.logger.error(f"Library rescan failed: {e}")
+        finally:
+            _rescan_lock.release()
+
+    threading.Thread(target=rescan, name='library-rescan', daemon=True).start()
+    return True
+
+def queue_missing_phashes():
+    """Queues photos that were processed before perceptual hashes existed, so they get one."""
+    rows = get_photos_missing_phash()
+    if rows:
+        enqueue_ingest_jobs([(row['user_id'], 'photo', row['filename'], os.path.join(row['photo_dir'], row['filename']))
+                             for row in rows], priority=PRIORITY_SCAN)
+        notify_ingest_worker()
+
+def index_file(user_id, kind, filepath, content_hash=None):
+    """Adds a single file that was just written to the media index and queues its derived-data work."""
+    stat = os.stat(filepath)
+    filename = os.path.basename(filepath)
+    upsert_media(user_id, kind, filename, stat.st_size, stat.st_mtime, content_hash)
+    enqueue_ingest_jobs([(user_id, kind, filename, filepath)], priority=PRIORITY_UPLOAD)
+    notify_ingest_worker()
+
+def index_files(user_id, files):
+    """Adds a batch of just-written files to the media index, in one transaction per kind.
+
+    files is a list of (kind, filepath, content_hash) tuples, content_hash None if it is not known.
+    """
+    jobs = []
+    for kind in ('photo', 'video'):
+        upserts = []
+        for file_kind, filepath, content_hash in files:
+            if file_kind == kind:
+                stat = os.stat(filepath)
+                filename = os.path.basename(filepath)
+                upserts.append((filename, stat.st_size, stat.st_mtime, content_hash))
+                jobs.append((user_id, kind, filename, filepath))
+        if upserts:
+            apply_media_changes(user_id, kind, upserts, [])
+    if jobs:
+        enqueue_ingest_jobs(jobs, priority=PRIORITY_UPLOAD)
+        notify_ingest_worker()
@@ -0,0 +1,208 @@
+# metadata.py
+import os
+import math
+import time
+import struct
+import calendar
+from PIL import Image
+from metrics import IMAGE_DURATION, timed
+
+# EXIF tags we read from the main image directory (IFD0)
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+
+# Sub-directories and the tags we read from them
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+TAG_EXPOSURE_TIME = 0x829A
+TAG_F_NUMBER = 0x829D
+TAG_ISO = 0x8827
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_FOCAL_LENGTH = 0x920A
+TAG_LENS_MAKE = 0xA433
+TAG_LENS_MODEL = 0xA434
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+# MP4/MOV timestamps count seconds from 1904-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+# Containers that hold other boxes, which we descend into when looking for video metadata
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+
+def parse_exif_datetime(value):
+    """Turns an EXIF 'YYYY:MM:DD HH:MM:SS' string into a timestamp, or None if it is not valid."""
+    try:
+        return float(calendar.timegm(time.strptime(str(value).strip('\x00 ')[:19], '%Y:%m:%d %H:%M:%S')))
+    except ValueError:
+        return None
+
+def exif_text(value):
+    """Cleans up an EXIF string value, returning None for missing or blank values."""
+    if value is None:
+        return None
+    return str(value).strip('\x00 ') or None
+
+def exif_number(value):
+    """Turns an EXIF rational or integer into a float, or None if it is missing or not a finite number.
+
+    Pillow reads rationals with a zero denominator, which some cameras write for unknown values, as NaN.
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return number if math.isfinite(number) else None
+
+def gps_coordinate(dms, ref):
+    """Converts an EXIF degrees/minutes/seconds triple into signed decimal degrees."""
+    try:
+        parts = [exif_number(dms[i]) for i in range(3)]
+    except (TypeError, IndexError):
+        return None
+    if None in parts:
+        return None
+    degrees = parts[0] + parts[1] / 60 + parts[2] / 3600
+    return round(-degrees if str(ref).strip('\x00 ') in ('S', 'W') else degrees, 6)
+
+@timed(IMAGE_DURATION, operation='metadata')
+def extract_image_metadata(path):
+    """Reads dimensions and the interesting EXIF fields from an image."""
+    with Image.open(path) as img:
+        exif = img.getexif()
+        exif_ifd = exif.get_ifd(EXIF_IFD)
+        gps_ifd = exif.get_ifd(GPS_IFD)
+        captured = exif_ifd.get(TAG_DATETIME_ORIGINAL) or exif.get(TAG_DATETIME)
+        lens = ' '.join(filter(None, [exif_text(exif_ifd.get(TAG_LENS_MAKE)), exif_text(exif_ifd.get(TAG_LENS_MODEL))]))
+        metadata = {
+            'format': img.format,
+            'mode': img.mode,
+            'width': img.width,
+            'height': img.height,
+            'captured_at': parse_exif_datetime(captured) if captured else None,
+            'camera_make': exif_text(exif.get(TAG_MAKE)),
+            'camera_model': exif_text(exif.get(TAG_MODEL)),
+            'lens': lens or None,
+            'exposure_time': exif_number(exif_ifd.get(TAG_EXPOSURE_TIME)),
+            'f_number': exif_number(exif_ifd.get(TAG_F_NUMBER)),
+            'iso': exif_number(exif_ifd.get(TAG_ISO)),
+            'focal_length': exif_number(exif_ifd.get(TAG_FOCAL_LENGTH)),
+            'orientation': exif.get(TAG_ORIENTATION),
+            'gps_latitude': None,
+            'gps_longitude': None,
+        }
+        if GPS_LATITUDE in gps_ifd and GPS_LONGITUDE in gps_ifd:
+            metadata['gps_latitude'] = gps_coordinate(gps_ifd[GPS_LATITUDE], gps_ifd.get(GPS_LATITUDE_REF))
+            metadata['gps_longitude'] = gps_coordinate(gps_ifd[GPS_LONGITUDE], gps_ifd.get(GPS_LONGITUDE_REF))
+        return metadata
+
+# --- Video containers ---
+
+def iter_mp4_boxes(f, start, end):
+    """Yields (type, payload_start, payload_end) for each box between start and end, without reading payloads."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, min(offset + size, end)
+        offset += size
+
+def read_mp4_metadata(f, start, end, metadata, track=None):
+    """Walks the box tree collecting duration, creation time, resolution and codec."""
+    for box_type, payload_start, payload_end in iter_mp4_boxes(f, start, end):
+        if box_type in MP4_CONTAINER_BOXES:
+            if box_type == b'trak':
+                track = {}
+                read_mp4_metadata(f, payload_start, payload_end, metadata, track)
+                # Only the video track decides the resolution and codec
+                if track.get('handler') == b'vide':
+                    metadata['width'] = metadata['width'] or track.get('width')
+                    metadata['height'] = metadata['height'] or track.get('height')
+                    metadata['video_codec'] = metadata['video_codec'] or track.get('codec')
+                track = None
+            else:
+                read_mp4_metadata(f, payload_start, payload_end, metadata, track)
+            continue
+
+        f.seek(payload_start)
+        if box_type == b'mvhd':
+            version = f.read(4)[0]
+            if version == 1:
+                created, _modified, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+            else:
+                created, _modified, timescale, duration = struct.unpack('>IIII', f.read(16))
+            if timescale:
+                metadata['duration'] = round(duration / timescale, 3)
+            if created > MP4_EPOCH_OFFSET:
+                metadata['captured_at'] = float(created - MP4_EPOCH_OFFSET)
+        elif box_type == b'tkhd' and track is not None:
+            version = f.read(4)[0]
+            # Width and height are the last two 16.16 fixed-point fields of the box
+            f.seek(payload_start + (88 if version == 1 else 76))
+            width, height = struct.unpack('>II', f.read(8))
+            track['width'], track['height'] = width >> 16, height >> 16
+        elif box_type == b'hdlr' and track is not None:
+            f.seek(payload_start + 8)
+            track['handler'] = f.read(4)
+        elif box_type == b'stsd' and track is not None:
+            f.seek(payload_start + 12)
+            track['codec'] = f.read(4).decode('latin-1').strip() or None
+
+def read_avi_metadata(f, metadata):
+    """Reads the main AVI header and the first video stream header."""
+    f.seek(12)
+    data = f.read(64 * 1024)  # The header list sits at the start of the file
+    avih = data.find(b'avih')
+    if avih != -1 and avih + 48 <= len(data):
+        fields = struct.unpack('<10I', data[avih + 8:avih + 48])
+        micro_sec_per_frame, total_frames, width, height = fields[0], fields[4], fields[8], fields[9]
+        metadata['width'], metadata['height'] = width, height
+        if micro_sec_per_frame:
+            metadata['duration'] = round(total_frames * micro_sec_per_frame / 1000000, 3)
+    strh = data.find(b'strh')
+    while strh != -1 and strh + 16 <= len(data):
+        # Each stream header is 'strh', its size, the stream type and the codec
+        if data[strh + 8:strh + 12] == b'vids':
+            metadata['video_codec'] = data[strh + 12:strh + 16].decode('latin-1').strip('\x00 ') or None
+            break
+        strh = data.find(b'strh', strh + 4)
+
+def extract_video_metadata(path):
+    """Reads duration, resolution, codec and creation time from MP4/MOV/AVI headers, in pure Python."""
+    metadata = {'format': None, 'width': None, 'height': None, 'captured_at': None,
+                'duration': None, 'video_codec': None}
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        try:
+            if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+                metadata['format'] = 'AVI'
+                read_avi_metadata(f, metadata)
+            else:
+                metadata['format'] = 'QuickTime' if path.lower().endswith('.mov') else 'MP4'
+                read_mp4_metadata(f, 0, os.fstat(f.fileno()).st_size, metadata)
+        except (struct.error, IndexError):
+            # A truncated or unusual header; keep whatever was read before it
+            pass
+    return metadata
+
+def extract_metadata(path, kind):
+    """Extracts the stored metadata for a photo or video."""
+    if kind == 'video':
+        return extract_video_metadata(path)
+    return extract_image_metadata(path)
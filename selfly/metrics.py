@@ -0,0 +1,201 @@
+# metrics.py
+import sys
+import time
+import bisect
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# Latency buckets in seconds: requests and file work, and the much faster database helpers
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Base of the metric types: a name, help text and a set of label names."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+        REGISTRY.append(self)
+
+    def label_values(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines += self.render_samples(items)
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self, items):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(Metric):
+    """Counts observations (durations, usually) into cumulative buckets, plus their sum and count."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        key = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, amount)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One slot per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += amount
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the with block took."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render_samples(self, items):
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+# --- The app's metrics ---
+# Only work done in the app process is counted; the ingest worker processes keep their own (unreported) copies.
+
+REQUESTS = Counter('selfly_http_requests_total', 'HTTP requests handled.', ('endpoint', 'method', 'status'))
+REQUEST_DURATION = Histogram('selfly_http_request_duration_seconds',
+                             'Time spent in the request handler, not counting streaming the body.', ('endpoint',))
+BYTES_SERVED = Counter('selfly_http_response_bytes_total', 'Response body bytes with a known length.', ('endpoint',))
+DB_DURATION = Histogram('selfly_db_call_duration_seconds', 'Time spent in database helper functions.',
+                        ('function',), buckets=DB_BUCKETS)
+DIR_SCAN_DURATION = Histogram('selfly_dir_scan_duration_seconds', 'Time spent listing a media directory.', ('kind',))
+DIR_SCAN_ENTRIES = Counter('selfly_dir_scan_files_total', 'Media files seen while listing directories.', ('kind',))
+IMAGE_DURATION = Histogram('selfly_image_open_duration_seconds', 'Time spent opening and decoding images with Pillow.',
+                           ('operation',))
+FILE_SEND_DURATION = Histogram('selfly_file_send_duration_seconds',
+                               'Time spent preparing a file response (sending happens while streaming).', ('source',))
+CACHE_REQUESTS = Counter('selfly_cache_requests_total', 'Cache lookups by outcome (hit or miss).', ('cache', 'result'))
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+def timed(histogram, **labels):
+    """Decorator that observes each call's duration in histogram."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+def instrument_functions(namespace, histogram, exclude=()):
+    """Wraps every public function defined in a module's namespace with a timer labelled with its name.
+
+    Called at the bottom of the module, so the names other modules import are the timed ones.
+    """
+    module_name = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if (callable(value) and getattr(value, '__module__', None) == module_name and not name.startswith('_')
+                and name not in exclude and not isinstance(value, type)):
+            namespace[name] = timed(histogram, function=name)(value)
+
+
+# --- Sampling profiler ---
+
+class SamplingProfiler:
+    """Samples one thread's stack at a fixed interval while a request runs.
+
+    The result is in the collapsed-stack format that flamegraph.pl and speedscope read: one line per
+    distinct stack, frames joined with ';' from the outermost, followed by the number of samples.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or self.stopped.is_set():
+                # Gone, or already in stop(), which is not part of the request
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        """Stops sampling and returns the collapsed stacks as text."""
+        self.stopped.set()
+        self.thread.join()
+        lines = [f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,111 @@
+# previews.py
+import io
+import os
+import shutil
+import threading
+import subprocess
+from functools import lru_cache
+from PIL import Image, ImageDraw
+from thumbnails import ensure_cached
+
+# ffmpeg is optional: without it videos get a generic poster and no preview clip
+FFMPEG = shutil.which('ffmpeg')
+
+POSTER_WIDTH = 640
+# Preview clips: a few seconds, small, silent and low bitrate, so they can play on hover in the grid
+PREVIEW_WIDTH = 320
+PREVIEW_SECONDS = 3
+PREVIEW_FPS = 12
+
+# Give up on a file that takes ffmpeg longer than this
+FFMPEG_TIMEOUT = 120
+
+
+_failed_lock = threading.Lock()
+_failed = set()  # (path, mtime_ns) of videos ffmpeg could not handle, so they are not retried on every request
+
+
+def previews_available():
+    """True when posters and preview clips can be extracted from videos."""
+    return FFMPEG is not None
+
+def seek_position(duration):
+    """Where to take the poster frame and start the preview: a little way in, past fades from black."""
+    if not duration:
+        return 1.0
+    return round(min(duration * 0.1, 5.0), 3)
+
+def run_ffmpeg(args, dest_path):
+    """Runs ffmpeg with output to a temp file, then moves it to dest_path atomically."""
+    tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    try:
+        subprocess.run([FFMPEG, '-nostdin', '-v', 'error', '-y'] + args + [tmp_path],
+                       check=True, capture_output=True, timeout=FFMPEG_TIMEOUT)
+        # ffmpeg exits cleanly without writing a frame when it seeks past the end
+        if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
+            raise OSError(f"ffmpeg produced no output for {dest_path}")
+        os.replace(tmp_path, dest_path)
+    except subprocess.CalledProcessError as e:
+        raise OSError(f"ffmpeg failed: {e.stderr.decode('utf-8', 'replace').strip()}") from e
+    except subprocess.TimeoutExpired as e:
+        raise OSError(f"ffmpeg timed out after {FFMPEG_TIMEOUT}s") from e
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def render_poster(src_path, dest_path, duration=None):
+    """Extracts one frame as a JPEG poster, falling back to the first frame for very short videos."""
+    scale = f"scale='min({POSTER_WIDTH},iw)':-2"
+    try:
+        run_ffmpeg(['-ss', str(seek_position(duration)), '-i', src_path, '-frames:v', '1', '-vf', scale,
+                    '-q:v', '4', '-f', 'image2', '-c:v', 'mjpeg'], dest_path)
+    except OSError:
+        run_ffmpeg(['-i', src_path, '-frames:v', '1', '-vf', scale, '-q:v', '4', '-f', 'image2', '-c:v', 'mjpeg'],
+                   dest_path)
+
+def render_preview(src_path, dest_path, duration=None):
+    """Encodes a short, silent, low-bitrate H.264 clip that browsers can start playing right away."""
+    start = seek_position(duration) if duration and duration > PREVIEW_SECONDS * 2 else 0
+    run_ffmpeg(['-ss', str(start), '-i', src_path, '-t', str(PREVIEW_SECONDS), '-an',
+                '-vf', f"scale='min({PREVIEW_WIDTH},iw)':-2,fps={PREVIEW_FPS}",
+                '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '32', '-maxrate', '300k', '-bufsize', '600k',
+                '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-f', 'mp4'], dest_path)
+
+def ensure_poster(src_path, cache_dir, duration=None, content_hash=None):
+    """Makes sure a video's poster is in the cache. Returns (path, created); needs ffmpeg."""
+    return ensure_cached(src_path, f"poster{POSTER_WIDTH}", 'image/jpeg', cache_dir,
+                         lambda dest_path: render_poster(src_path, dest_path, duration), 'poster', content_hash)
+
+def ensure_preview(src_path, cache_dir, duration=None, content_hash=None):
+    """Makes sure a video's preview clip is in the cache. Returns (path, created); needs ffmpeg."""
+    return ensure_cached(src_path, f"preview{PREVIEW_WIDTH}", 'video/mp4', cache_dir,
+                         lambda dest_path: render_preview(src_path, dest_path, duration), 'preview', content_hash)
+
+def get_derived(ensure, src_path, cache_dir, content_hash=None):
+    """Runs ensure_poster or ensure_preview for a request. Returns (path, created), or (None, False)
+    when there is no ffmpeg or it already failed on this version of the file."""
+    if FFMPEG is None:
+        return None, False
+    failure_key = (src_path, os.stat(src_path).st_mtime_ns)
+    if failure_key in _failed:
+        return None, False
+    try:
+        return ensure(src_path, cache_dir, content_hash=content_hash)
+    except OSError:
+        with _failed_lock:
+            _failed.add(failure_key)
+        raise
+
+@lru_cache(maxsize=1)
+def placeholder_poster():
+    """A generic poster (a play symbol on grey) for videos ffmpeg cannot read, or when it is not installed."""
+    width, height = POSTER_WIDTH, POSTER_WIDTH * 9 // 16
+    img = Image.new('RGB', (width, height), (55, 65, 81))
+    draw = ImageDraw.Draw(img)
+    cx, cy, r = width // 2, height // 2, height // 6
+    draw.ellipse((cx - r * 1.6, cy - r * 1.6, cx + r * 1.6, cy + r * 1.6), fill=(31, 41, 55))
+    draw.polygon([(cx - r * 0.6, cy - r), (cx - r * 0.6, cy + r), (cx + r, cy)], fill=(229, 231, 235))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
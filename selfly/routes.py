@@ -1,12 +1,30 @@
 # routes.py
 import os
-from flask import Blueprint, render_template, request, redirect, url_for, session, abort, send_from_directory, current_app, jsonify
+import json
+import time
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from flask import Blueprint, render_template, request, redirect, url_for, session, abort, send_file, current_app, jsonify, g, stream_with_context
 from functools import wraps
-from database import get_user_by_username, get_user_by_id, add_new_user, get_user_directories, get_db_connection, check_for_users, get_all_users, delete_user, update_user_password, update_user_admin_status, get_setting, add_setting
+from database import get_user_by_username, get_user_by_id, add_new_user, get_db_connection, check_for_users, get_all_users, delete_user, update_user_password, update_user_admin_status, get_setting, add_setting, get_media_page, delete_media, count_pending_ingest_jobs, get_ingest_job_counts, get_recent_failed_ingest_jobs, get_media_item, get_stored_metadata, store_metadata, get_upload_session, get_perceptual_hashes, get_all_users_with_stats, get_admin_media_page, get_timeline, TIMELINE_PERIODS, get_media_tags, set_media_annotations, search_media, get_share_job, get_phash_version
+from library import media_kind, kind_directory, index_file, index_files, start_rescan
+from thumbnails import THUMBNAIL_SIZES, VARIANT_WIDTHS, get_thumbnail, get_variant, variant_widths, negotiate_format, record_cache_write
+from metadata import extract_metadata, exif_number
+from sharing import get_share_provider, queue_share
+from metrics import (REQUESTS, REQUEST_DURATION, BYTES_SERVED, FILE_SEND_DURATION, SamplingProfiler, count_cache,
+                     render_metrics)
+from previews import previews_available, get_derived, ensure_poster, ensure_preview, placeholder_poster
+from similarity import find_near_duplicates, MAX_DISTANCE
+from watcher import watch_user_media
+from uploads import start_upload, write_chunk, finish_upload, cancel_upload, UploadBusy, save_file, save_batch, existing_copy
+from serving import media_version, last_modified_for, is_not_modified, not_modified_response, cache_control_for, send_media_file, resolve_ranges
+from exporting import ZipExport, ExportChanged
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.exceptions import ServiceUnavailable
 from PIL import Image # For image metadata
-import requests # For uploading to external services
-import base64 # For Base64 encoding for ImageBB
+import base64 # For pagination cursors
 
 # Create a Blueprint for the main routes
 main_bp = Blueprint('main', __name__)
@@ -18,11 +36,56 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+@main_bp.before_request
+def start_request_timer():
+    """Notes when the request started; registered first so the other hooks are timed too."""
+    g.request_started = time.perf_counter()
+
+@main_bp.before_request
+def load_current_user():
+    """Loads the logged-in user once per request into flask.g.
+
+    The user row also carries the photo and video directories, so g.user_dirs is the same row.
+    """
+    g.user = get_user_by_id(session['user_id']) if 'user_id' in session else None
+    g.user_dirs = g.user
+
+@main_bp.before_request
+def start_profiler():
+    """Samples this request's stack when an admin adds ?profile=1 and METRICS_PROFILER is on."""
+    g.profiler = None
+    if (current_app.config['METRICS_PROFILER'] and request.args.get('profile') == '1'
+            and g.user and g.user['is_admin']):
+        g.profiler = SamplingProfiler(threading.get_ident(), current_app.config['METRICS_PROFILER_INTERVAL'])
+        g.profiler.start()
+
+@main_bp.after_request
+def record_request_metrics(response):
+    """Counts the request and its time and bytes for /metrics, and returns the profile if one was taken."""
+    endpoint = request.endpoint or 'unknown'
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if response.content_length:
+        BYTES_SERVED.inc(response.content_length, endpoint=endpoint)
+
+    profiler = g.get('profiler')
+    if profiler is not None:
+        g.profiler = None
+        # Collapsed stacks, for flamegraph.pl or speedscope, instead of the page
+        response.close()
+        response = current_app.response_class(profiler.stop(), mimetype='text/plain')
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
 def login_required(f):
     """A decorator to protect routes that require authentication."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if g.user is None:
+            # Covers sessions of users that have since been deleted, too
+            session.pop('user_id', None)
             return redirect(url_for('main.login'))
         return f(*args, **kwargs)
     return decorated_function
@@ -31,44 +94,139 @@ def admin_required(f):
     """A decorator to protect routes that only admins can access."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = get_user_by_id(session.get('user_id'))
+        user = g.user
         if not user or not user['is_admin']:
             abort(403)  # Forbidden
         return f(*args, **kwargs)
     return decorated_function
 
+def check_ingest_backlog():
+    """Refuse new work while the ingest queue is backed up, so the client retries later."""
+    if count_pending_ingest_jobs() >= current_app.config['INGEST_MAX_PENDING']:
+        raise ServiceUnavailable("Too many uploads are still being processed. Please try again shortly.",
+                                 retry_after=30)
+
+# Media rows per page in the admin listing
+ADMIN_MEDIA_PER_PAGE = 60
+
+def parse_date_arg(name, end_of_day=False):
+    """Reads a YYYY-MM-DD query argument as a UTC timestamp; end_of_day gives the start of the next day."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    except ValueError:
+        abort(400, description=f"{name} must be a date like 2024-01-31.")
+    return day.timestamp() + (86400 if end_of_day else 0)
+
+def admin_media_filters():
+    """Reads the admin media listing filters from the query string.
+
+    user_id, kind ('photo' or 'video'), from and to (dates, inclusive), min_mb and max_mb (sizes in MB).
+    """
+    kind = request.args.get('kind') or None
+    if kind not in (None, 'photo', 'video'):
+        abort(400, description="kind must be photo or video.")
+    min_mb = request.args.get('min_mb', type=float)
+    max_mb = request.args.get('max_mb', type=float)
+    return {
+        'user_id': request.args.get('user_id', type=int),
+        'kind': kind,
+        'start': parse_date_arg('from'),
+        'end': parse_date_arg('to', end_of_day=True),
+        'min_size': int(min_mb * 1024 * 1024) if min_mb is not None else None,
+        'max_size': int(max_mb * 1024 * 1024) if max_mb is not None else None,
+    }
+
+def get_admin_media(filters, per_page, cursor=None):
+    """Returns one page of the admin media listing, plus the cursor for the next page."""
+    after = decode_cursor(cursor, int) if cursor else None
+    rows = get_admin_media_page(per_page + 1, after=after, **filters)
+    page = rows[:per_page]
+    next_cursor = encode_cursor(page[-1], 'id') if len(rows) > per_page else None
+    return page, next_cursor
+
 # Helper function to render templates with common context
 def render_page(template, **kwargs):
     username = None
     is_admin = False
-    if 'user_id' in session:
-        user = get_user_by_id(session['user_id'])
-        if user:
-            username = user['username']
-            is_admin = bool(user['is_admin'])
+    user = g.get('user')
+    if user:
+        username = user['username']
+        is_admin = bool(user['is_admin'])
     return render_template(template, username=username, is_admin=is_admin, **kwargs)
 
-def get_user_media(user_id):
-    """Scans the user's directories and returns a list of media files."""
-    user_media = []
-    user_dirs = get_user_directories(user_id)
-    if not user_dirs:
-        return []
+def encode_cursor(row, tiebreak='filename', order_by='sort_key'):
+    """Turns the last row of a page into an opaque cursor for the next page."""
+    raw = json.dumps([row[order_by], row[tiebreak]]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
 
-    photo_dir = user_dirs['photo_dir']
-    if photo_dir and os.path.exists(photo_dir):
-        for filename in os.listdir(photo_dir):
-            if allowed_file(filename) and not filename.endswith(('mp4', 'mov', 'avi')):
-                user_media.append(filename)
+def decode_cursor(cursor, tiebreak_type=str):
+    """Turns a cursor from encode_cursor back into a (sort_key, tiebreak) tuple."""
+    try:
+        sort_key, tiebreak = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(sort_key), tiebreak_type(tiebreak)
+    except (ValueError, TypeError):
+        abort(400, description="Invalid cursor.")
+
+def get_user_media(user_id, per_page, cursor=None, start=None, end=None):
+    """Returns one page of the user's media from the media index, plus the cursor for the next page."""
+    after = decode_cursor(cursor) if cursor else None
+    # Fetch one extra row to know whether there is another page
+    rows = get_media_page(user_id, per_page + 1, after, start, end)
+    page = rows[:per_page]
+    next_cursor = encode_cursor(page[-1]) if len(rows) > per_page else None
+    return page, next_cursor
 
-    video_dir = user_dirs['video_dir']
-    if video_dir and os.path.exists(video_dir):
-        for filename in os.listdir(video_dir):
-            if allowed_file(filename) and filename.endswith(('mp4', 'mov', 'avi')):
-                user_media.append(filename)
-    
-    # Reverse the list to show the most recent files first
-    return sorted(user_media, reverse=True)
+
+def media_item_json(row):
+    """Describes an indexed file for the dashboard grid, including the version used in its URLs."""
+    return {
+        'filename': row['filename'],
+        'kind': row['kind'],
+        'version': media_version(row['size'], row['mtime'], row['content_hash']),
+    }
+
+def format_metadata(filename, size, data):
+    """Turns stored metadata into the labelled fields shown in the metadata panel."""
+    # Metadata stored before zero-denominator EXIF rationals were dropped can hold NaN for these
+    data = dict(data)
+    for field in ('exposure_time', 'f_number', 'iso', 'focal_length', 'gps_latitude', 'gps_longitude', 'duration'):
+        data[field] = exif_number(data.get(field))
+    metadata = {'Filename': filename}
+    if data.get('width') and data.get('height'):
+        metadata['Dimensions'] = f"{data['width']}x{data['height']}"
+    metadata['Format'] = data.get('format')
+    if data.get('mode'):
+        metadata['Mode'] = data['mode']
+    metadata['Size'] = f"{size / (1024 * 1024):.2f} MB"
+    if data.get('captured_at'):
+        metadata['Captured'] = datetime.fromtimestamp(data['captured_at'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    camera = ' '.join(filter(None, [data.get('camera_make'), data.get('camera_model')]))
+    if camera:
+        metadata['Camera'] = camera
+    if data.get('lens'):
+        metadata['Lens'] = data['lens']
+    if data.get('exposure_time') and data['exposure_time'] > 0:
+        exposure = data['exposure_time']
+        metadata['Exposure'] = f"1/{round(1 / exposure)} s" if exposure < 1 else f"{exposure:g} s"
+    if data.get('f_number'):
+        metadata['Aperture'] = f"f/{data['f_number']:g}"
+    if data.get('iso'):
+        metadata['ISO'] = f"{data['iso']:g}"
+    if data.get('focal_length'):
+        metadata['Focal Length'] = f"{data['focal_length']:g} mm"
+    if data.get('gps_latitude') is not None and data.get('gps_longitude') is not None:
+        metadata['GPS'] = f"{data['gps_latitude']}, {data['gps_longitude']}"
+    if data.get('orientation'):
+        metadata['Orientation'] = data['orientation']
+    if data.get('duration') is not None:
+        minutes, seconds = divmod(data['duration'], 60)
+        metadata['Duration'] = f"{int(minutes)}:{seconds:05.2f}"
+    if data.get('video_codec'):
+        metadata['Codec'] = data['video_codec']
+    return metadata
 
 
 # --- Routes ---
@@ -106,6 +264,7 @@ def signup():
         video_dir = request.form['video_dir']
         if add_new_user(username, password, photo_dir, video_dir):
             user = get_user_by_username(username)
+            watch_user_media(user['id'])
             session['user_id'] = user['id']
             return redirect(url_for('main.dashboard'))
         else:
@@ -125,6 +284,7 @@ def first_admin_signup():
         video_dir = request.form['video_dir']
         if add_new_user(username, password, photo_dir, video_dir, is_admin=True):
             user = get_user_by_username(username)
+            watch_user_media(user['id'])
             session['user_id'] = user['id']
             return redirect(url_for('main.dashboard'))
         else:
@@ -143,123 +303,227 @@ def logout():
 def dashboard():
     """Displays the user's uploaded files from their configured directories."""
     # We will only load the first page of files here
-    files = get_user_media(session['user_id'])
-    
-    # Determine the number of files per page
     per_page = 20
-    first_page_files = files[:per_page]
-    has_more = len(files) > per_page
+    rows, next_cursor = get_user_media(session['user_id'], per_page)
+    first_page_files = [media_item_json(row) for row in rows]
 
-    return render_page('dashboard.html', files=first_page_files, has_more=has_more)
+    return render_page('dashboard.html', files=first_page_files, has_more=next_cursor is not None,
+                       next_cursor=next_cursor, video_previews=previews_available())
 
 @main_bp.route('/api/media')
 @login_required
 def api_media():
-    """API endpoint for endless scrolling, returning a paginated list of media."""
+    """API endpoint for endless scrolling, returning the page of media after the given cursor.
+
+    ?from= and ?to= (dates, inclusive) limit the results to media taken in that range.
+    """
     user_id = session['user_id']
-    all_files = get_user_media(user_id)
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 20, type=int)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
 
-    start = (page - 1) * per_page
-    end = start + per_page
-    
-    paginated_files = all_files[start:end]
+    rows, next_cursor = get_user_media(user_id, per_page, request.args.get('cursor'),
+                                       parse_date_arg('from'), parse_date_arg('to', end_of_day=True))
 
-    has_more = end < len(all_files)
-    
     return jsonify({
-        'files': paginated_files,
-        'has_more': has_more
+        'files': [row['filename'] for row in rows],
+        'items': [media_item_json(row) for row in rows],
+        'has_more': next_cursor is not None,
+        'next_cursor': next_cursor
+    })
+
+@main_bp.route('/api/timeline')
+@login_required
+def api_timeline():
+    """Returns how many photos and videos the user has per year, month or day, newest first.
+
+    ?granularity= is year, month (the default) or day; ?from= and ?to= (dates) limit the range.
+    """
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in TIMELINE_PERIODS:
+        abort(400, description="granularity must be year, month or day.")
+    for name in ('from', 'to'):
+        parse_date_arg(name)  # Validates the format
+    rows = get_timeline(g.user['id'], granularity, request.args.get('from') or None, request.args.get('to') or None)
+    return jsonify({
+        'granularity': granularity,
+        'buckets': [{'period': row['period'], 'count': row['count']} for row in rows],
+    })
+
+# Limits on what users can attach to a file
+MAX_TAGS = 50
+MAX_TAG_LENGTH = 50
+MAX_CAPTION_LENGTH = 2000
+MAX_PLACE_LENGTH = 200
+
+def clean_text(value, max_length):
+    """Trims a caption or place, turning blank values into None."""
+    if value is None:
+        return None
+    return str(value).strip()[:max_length] or None
+
+def clean_tags(tags):
+    """Normalizes a list of tags: trimmed, lowercase, no duplicates, bounded in number and length."""
+    if not isinstance(tags, list):
+        abort(400, description="tags must be a list of strings.")
+    cleaned = []
+    for tag in tags:
+        tag = ' '.join(str(tag).split()).lower()[:MAX_TAG_LENGTH]
+        if tag and tag not in cleaned:
+            cleaned.append(tag)
+    return cleaned[:MAX_TAGS]
+
+def annotations_json(item):
+    """Describes the caption, place and tags of an indexed file."""
+    return {
+        'filename': item['filename'],
+        'caption': item['caption'],
+        'place': item['place'],
+        'camera': item['camera'],
+        'tags': get_media_tags(item['id']),
+    }
+
+@main_bp.route('/api/annotations/<path:filename>', methods=['GET', 'PUT'])
+@login_required
+def media_annotations(filename):
+    """Reads or replaces the caption, place and tags of one of the user's files.
+
+    PUT takes JSON with any of 'caption', 'place' and 'tags' (a list); fields left out keep their value.
+    """
+    item = get_media_item(g.user['id'], filename)
+    if not item:
+        abort(404)
+    if request.method == 'PUT':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400, description="Expected a JSON object.")
+        caption = clean_text(data.get('caption', item['caption']), MAX_CAPTION_LENGTH)
+        place = clean_text(data.get('place', item['place']), MAX_PLACE_LENGTH)
+        tags = clean_tags(data['tags']) if 'tags' in data else get_media_tags(item['id'])
+        set_media_annotations(item['id'], caption, place, tags)
+        item = get_media_item(g.user['id'], filename)
+    return jsonify(annotations_json(item))
+
+@main_bp.route('/api/search')
+@login_required
+def api_search():
+    """Searches the user's media by filename, caption, tags, camera and place.
+
+    Every word of ?q= has to match the start of a word in one of those fields. Results are ranked
+    by relevance (bm25) and paged with ?cursor=, like /api/media.
+    """
+    text = request.args.get('q', '')[:200]
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    after = decode_cursor(request.args['cursor'], int) if request.args.get('cursor') else None
+    rows = search_media(g.user['id'], text, per_page + 1, after)
+    page = rows[:per_page]
+    next_cursor = encode_cursor(page[-1], 'id', order_by='score') if len(rows) > per_page else None
+    return jsonify({
+        'items': [dict(media_item_json(row), caption=row['caption']) for row in page],
+        'has_more': next_cursor is not None,
+        'next_cursor': next_cursor,
     })
 
 @main_bp.route('/api/metadata/<filename>')
 @login_required
 def get_metadata(filename):
-    """API endpoint to get metadata for a specific image file."""
-    user = get_user_by_id(session['user_id'])
-    user_dirs = get_user_directories(user['id'])
-    
-    # Check if the file is a photo
-    if not filename.endswith(('png', 'jpg', 'jpeg', 'gif')):
-        abort(400, description="Invalid file type for metadata.")
+    """API endpoint to get metadata for a specific photo or video."""
+    user = g.user
+    user_dirs = g.user_dirs
 
-    # Get the file path
-    file_path = os.path.join(user_dirs['photo_dir'], filename)
-    if not os.path.exists(file_path):
+    # The media index tells us the kind and current version of the file without touching it
+    item = get_media_item(user['id'], filename)
+    if item:
+        kind, size, mtime = item['kind'], item['size'], item['mtime']
+    else:
+        # Not indexed yet (e.g. just copied in), so look at the file itself
+        kind = media_kind(filename)
+
+    directory = kind_directory(user_dirs, kind)
+    file_path = safe_join(directory, filename) if directory else None
+    if not file_path:
         abort(404)
+    if not item:
+        if not os.path.isfile(file_path):
+            abort(404)
+        stat = os.stat(file_path)
+        size, mtime = stat.st_size, stat.st_mtime
 
-    # Use Pillow to get image metadata
-    try:
-        with Image.open(file_path) as img:
-            metadata = {
-                'Filename': filename,
-                'Dimensions': f"{img.width}x{img.height}",
-                'Format': img.format,
-                'Mode': img.mode,
-                'Size': f"{os.path.getsize(file_path) / (1024 * 1024):.2f} MB",
-            }
-            # You can add more metadata here if needed
-            return jsonify(metadata)
-    except Exception as e:
-        current_app.logger.error(f"Error reading metadata for {filename}: {e}")
-        abort(500, description="Could not read file metadata.")
+    data = get_stored_metadata(file_path, size, mtime)
+    count_cache('metadata', hit=data is not None)
+    if data is None:
+        # Not processed by the ingest worker yet, so extract it now and keep it for next time
+        try:
+            data = extract_metadata(file_path, kind)
+        except FileNotFoundError:
+            abort(404)
+        except Exception as e:
+            current_app.logger.error(f"Error reading metadata for {filename}: {e}")
+            abort(500, description="Could not read file metadata.")
+        store_metadata(file_path, size, mtime, data)
+
+    return jsonify(format_metadata(filename, size, data))
 
 
 @main_bp.route('/api/upload-public/<filename>', methods=['POST'])
 @login_required
 def upload_public(filename):
     """
-    API endpoint to upload a file to a public, free image host (ImageBB) and return the link.
+    API endpoint to upload a photo to a public, free image host (ImageBB by default).
     WARNING: This makes the image public.
+
+    The upload runs in the background; poll the returned status URL for the link.
     """
-    user = get_user_by_id(session['user_id'])
-    user_dirs = get_user_directories(user['id'])
+    user = g.user
+    user_dirs = g.user_dirs
+    if not user_dirs['photo_dir'] or media_kind(filename) != 'photo':
+        abort(404)
 
-    file_path = os.path.join(user_dirs['photo_dir'], filename)
-    if not os.path.exists(file_path):
+    file_path = safe_join(user_dirs['photo_dir'], filename)
+    if not file_path or not os.path.isfile(file_path):
         abort(404)
-        
-    # Open the file and encode it in Base64
-    try:
-        with open(file_path, 'rb') as f:
-            encoded_string = base64.b64encode(f.read()).decode('utf-8')
-        
-        # ImageBB API endpoint and API key
-        api_key = get_setting('imagebb_api_key')
-        if not api_key:
-            abort(500, description="ImageBB API key not configured. Please set it in admin settings.")
 
-        api_url = f"https://api.imgbb.com/1/upload?key={api_key}"
-        
-        # Send the Base64 encoded image to ImageBB
-        payload = {'image': encoded_string}
-        response = requests.post(api_url, data=payload)
-        response.raise_for_status() # Raise an exception for bad status codes
-
-        result = response.json()
-        if result['success']:
-            public_link = result['data']['url']
-            return jsonify({'public_link': public_link})
-        else:
-            current_app.logger.error(f"ImageBB upload failed: {result.get('error', {}).get('message', 'Unknown error')}")
-            abort(500, description="Failed to upload image to public service.")
-            
-    except requests.exceptions.RequestException as e:
-        current_app.logger.error(f"Failed to upload {filename} to ImageBB: {e}")
-        abort(500, description="Failed to upload image to public service.")
+    # Catch a missing API key now rather than in the background
+    provider = get_share_provider(current_app.config)
+    error = provider.configuration_error()
+    if error:
+        abort(500, description=error)
+
+    job_id = queue_share(user['id'], filename, file_path, provider.name)
+    response = jsonify(share_job_json(get_share_job(job_id, user['id'])))
+    response.status_code = 202
+    response.headers['Location'] = url_for('main.share_job_status', job_id=job_id)
+    return response
+
+@main_bp.route('/api/share-jobs/<job_id>')
+@login_required
+def share_job_status(job_id):
+    """Reports the progress of a public upload; public_link is set once it is done."""
+    job = get_share_job(job_id, g.user['id'])
+    if not job:
+        abort(404)
+    return jsonify(share_job_json(job))
+
+def share_job_json(job):
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'public_link': job['public_url'],
+        'error': job['last_error'],
+        'status_url': url_for('main.share_job_status', job_id=job['id']),
+    }
 
 
 @main_bp.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload_file():
     """Handles file uploads by saving them to the user's configured directory."""
-    user = get_user_by_id(session['user_id'])
-    user_dirs = get_user_directories(user['id'])
+    user = g.user
+    user_dirs = g.user_dirs
     if not user_dirs:
         abort(500, description="User directories not configured.")
         
     if request.method == 'POST':
+        check_ingest_backlog()
         if 'file' not in request.files:
             return redirect(request.url)
         file = request.files['file']
@@ -269,47 +533,407 @@ def upload_file():
         filename = secure_filename(file.filename)
         
         # Determine the correct directory based on file type
-        if filename.endswith(('mp4', 'mov', 'avi')):
+        kind = media_kind(filename)
+        if kind == 'video':
             upload_dir = user_dirs['video_dir']
         else:
             upload_dir = user_dirs['photo_dir']
             
         if upload_dir and os.path.exists(upload_dir):
-            filepath = os.path.join(upload_dir, filename)
-            file.save(filepath)
+            try:
+                status, filepath, content_hash = save_file(file.stream, kind, user['id'], upload_dir, filename,
+                                                           current_app.config['DEDUPE_MODE'])
+            except ValueError:
+                return redirect(request.url)
+            if status != 'duplicate':
+                index_file(user['id'], kind, filepath, content_hash)
             return redirect(url_for('main.dashboard'))
         else:
             abort(500, description="Upload directory not found or configured.")
 
     return render_page('upload.html')
 
+@main_bp.route('/api/upload-batch', methods=['POST'])
+@login_required
+def upload_batch():
+    """Saves many files from one multipart request and reports the outcome of each.
+
+    Every part named 'files' is one upload. Files are checked and written concurrently, then indexed
+    together, and the response lists a result per file in the order they were sent.
+    """
+    user_dirs = g.user_dirs
+    check_ingest_backlog()
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({"error": "No files were sent"}), 400
+    if len(files) > current_app.config['UPLOAD_BATCH_MAX_FILES']:
+        return jsonify({"error": f"At most {current_app.config['UPLOAD_BATCH_MAX_FILES']} files per batch"}), 413
+
+    dedupe_mode = current_app.config['DEDUPE_MODE']
+    results = []
+    pending = []
+    seen = set()
+    for file in files:
+        filename = secure_filename(file.filename or '')
+        result = {'filename': file.filename, 'saved_as': None, 'status': 'error', 'error': None, 'duplicate': False}
+        results.append(result)
+        if not filename or not allowed_file(filename):
+            result['error'] = "File type not allowed"
+            continue
+        kind = media_kind(filename)
+        upload_dir = kind_directory(user_dirs, kind)
+        if not upload_dir or not os.path.isdir(upload_dir):
+            result['error'] = "Upload directory not found or configured"
+            continue
+        if (kind, filename) in seen:
+            result['error'] = "Duplicate file name in this batch"
+            continue
+        seen.add((kind, filename))
+        pending.append((result, (file.stream, kind, g.user['id'], upload_dir, filename, dedupe_mode)))
+
+    outcomes = save_batch([item for _result, item in pending], current_app.config['UPLOAD_BATCH_WORKERS'])
+    saved = []
+    stored = {}  # content_hash -> path, for the files this batch added
+    for (result, item), outcome in zip(pending, outcomes):
+        if isinstance(outcome, str):
+            result['error'] = outcome
+            continue
+        status, path, content_hash = outcome
+        if status != 'duplicate' and dedupe_mode != 'off' and content_hash in stored:
+            # Identical files in one batch are stored at the same time, so store_file can't see the other copy
+            os.remove(path)
+            status, path = 'duplicate', stored[content_hash]
+        # A duplicate is reported as the file the library already has
+        result.update(status='ok', saved_as=os.path.basename(path), duplicate=status == 'duplicate')
+        if status != 'duplicate':
+            stored[content_hash] = path
+            saved.append((item[1], path, content_hash))
+    if saved:
+        index_files(g.user['id'], saved)
+
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    return jsonify({'saved': len(saved), 'duplicates': len(results) - len(saved) - failed, 'failed': failed,
+                    'results': results})
+
+# --- Resumable Uploads ---
+
+def upload_session_json(upload):
+    """Describes an upload session for the chunked upload API."""
+    return {
+        'upload_id': upload['id'],
+        'filename': upload['filename'],
+        'size': upload['total_size'],
+        'offset': upload['received'],
+    }
+
+def upload_conflict(upload):
+    """A 409 carrying the upload session, so the client knows the offset to continue from."""
+    response = jsonify(upload_session_json(upload))
+    response.status_code = 409
+    return response
+
+def find_duplicate(content_hash):
+    """Looks for content in the current user's library by its BLAKE2b hash.
+
+    Returns the JSON answer for the client if the file is already there, otherwise None. Only the
+    user's own library is searched: matching another user's file by hash alone would hand out their
+    content to anyone who knows its hash.
+    """
+    if not content_hash or current_app.config['DEDUPE_MODE'] == 'off':
+        return None
+    path = existing_copy(str(content_hash).lower(), g.user['id'])
+    if not path:
+        return None
+    return {'exists': True, 'filename': os.path.basename(path), 'content_hash': str(content_hash).lower()}
+
+@main_bp.route('/api/uploads/check/<content_hash>', methods=['GET'])
+@login_required
+def check_upload(content_hash):
+    """Tells a client whether it still needs to upload a file with this BLAKE2b-256 hex hash."""
+    existing = find_duplicate(content_hash)
+    if existing:
+        return jsonify(existing)
+    return jsonify({'exists': False, 'content_hash': content_hash.lower()}), 404
+
+@main_bp.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Starts a resumable upload. Expects JSON with the filename and total size in bytes."""
+    user_dirs = g.user_dirs
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    size = data.get('size')
+    if not filename or not allowed_file(filename):
+        abort(400, description="Missing or unsupported filename.")
+    if not isinstance(size, int) or size < 0:
+        abort(400, description="The total size in bytes is required.")
+
+    # A client that sends the file's hash can skip uploading content the library already has
+    existing = find_duplicate(data.get('content_hash'))
+    if existing:
+        return jsonify(existing)
+    check_ingest_backlog()
+
+    kind = media_kind(filename)
+    upload_dir = kind_directory(user_dirs, kind)
+    if not upload_dir or not os.path.exists(upload_dir):
+        abort(500, description="Upload directory not found or configured.")
+
+    upload_id = start_upload(g.user['id'], kind, filename, size, upload_dir)
+    response = jsonify(upload_session_json(get_upload_session(upload_id, g.user['id'])))
+    response.status_code = 201
+    response.headers['Location'] = url_for('main.upload_status', upload_id=upload_id)
+    return response
+
+@main_bp.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Returns how much of an upload has arrived, which is where the client should resume."""
+    upload = get_upload_session(upload_id, g.user['id'])
+    if not upload:
+        abort(404)
+    return jsonify(upload_session_json(upload))
+
+@main_bp.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    """Receives the next chunk of an upload as the raw request body, starting at ?offset=."""
+    upload = get_upload_session(upload_id, g.user['id'])
+    if not upload:
+        abort(404)
+
+    offset = request.args.get('offset', type=int)
+    if offset != upload['received']:
+        # The client is out of step (e.g. after a dropped connection): tell it where to continue
+        return upload_conflict(upload)
+    if request.content_length is None:
+        abort(411)
+    if offset + request.content_length > upload['total_size']:
+        abort(413, description="Chunk goes past the declared upload size.")
+
+    try:
+        write_chunk(upload, request.stream, request.content_length)
+    except UploadBusy:
+        # Another request is writing to this upload; the client can retry from the offset we report
+        response = upload_conflict(get_upload_session(upload_id, g.user['id']))
+        response.headers['Retry-After'] = '1'
+        return response
+    return jsonify(upload_session_json(get_upload_session(upload_id, g.user['id'])))
+
+@main_bp.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """Moves a complete upload into the user's library."""
+    upload = get_upload_session(upload_id, g.user['id'])
+    if not upload:
+        abort(404)
+    if upload['received'] != upload['total_size']:
+        return upload_conflict(upload)
+
+    try:
+        status, final_path, content_hash = finish_upload(upload, current_app.config['DEDUPE_MODE'])
+    except UploadBusy:
+        response = upload_conflict(upload)
+        response.headers['Retry-After'] = '1'
+        return response
+    if status != 'duplicate':
+        index_file(g.user['id'], upload['kind'], final_path, content_hash)
+    return jsonify({'filename': os.path.basename(final_path), 'content_hash': content_hash,
+                    'duplicate': status == 'duplicate'})
+
+@main_bp.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def delete_upload(upload_id):
+    """Cancels an upload and throws away what was received."""
+    upload = get_upload_session(upload_id, g.user['id'])
+    if not upload:
+        abort(404)
+    cancel_upload(upload)
+    return '', 204
+
 @main_bp.route('/media/<path:filename>')
 @login_required
 def serve_media(filename):
-    """Serves media files directly from the configured directories."""
-    user = get_user_by_id(session['user_id'])
-    user_dirs = get_user_directories(user['id'])
+    """Serves media files directly from the configured directories, with cache validators."""
+    user = g.user
+    user_dirs = g.user_dirs
     if not user_dirs:
         abort(403)
-    
-    photo_dir = user_dirs['photo_dir']
-    video_dir = user_dirs['video_dir']
 
-    # Check if the file is in the user's photo or video directory
-    if photo_dir and os.path.exists(os.path.join(photo_dir, filename)):
-        return send_from_directory(photo_dir, filename)
-    elif video_dir and os.path.exists(os.path.join(video_dir, filename)):
-        return send_from_directory(video_dir, filename)
-    
-    # If the file is not found in the user's directories, return 404
-    abort(404)
+    # The media index knows where the file is and which version it is, so revalidation needs no disk access
+    item = get_media_item(user['id'], filename)
+    if item:
+        directory = kind_directory(user_dirs, item['kind'])
+        version = media_version(item['size'], item['mtime'], item['content_hash'])
+        mtime = item['mtime']
+    else:
+        # Not indexed yet, so look for it on disk
+        directory = None
+        for candidate in (user_dirs['photo_dir'], user_dirs['video_dir']):
+            path = safe_join(candidate, filename) if candidate else None
+            if path and os.path.isfile(path):
+                directory = candidate
+                stat = os.stat(path)
+                version = media_version(stat.st_size, stat.st_mtime)
+                mtime = stat.st_mtime
+                break
+        if directory is None:
+            # If the file is not found in the user's directories, return 404
+            abort(404)
+
+    last_modified = last_modified_for(mtime)
+    if is_not_modified(version, last_modified):
+        return not_modified_response(version, last_modified)
+
+    file_path = safe_join(directory, filename)
+    if not file_path:
+        abort(404)
+    return send_media_file(file_path, version, last_modified)
+
+@main_bp.route('/thumb/<int:size>/<path:filename>')
+@login_required
+def serve_thumbnail(filename, size):
+    """Serves a resized copy of one of the user's photos from the thumbnail cache."""
+    return thumbnail_response(g.user, filename, size)
+
+@main_bp.route('/admin/thumb/<int:user_id>/<int:size>/<path:filename>')
+@login_required
+@admin_required
+def admin_thumbnail(user_id, filename, size):
+    """Serves a thumbnail of any user's photo, for the admin pages."""
+    user = get_user_by_id(user_id)
+    if not user:
+        abort(404)
+    return thumbnail_response(user, filename, size)
+
+@main_bp.route('/variant/<int:width>/<path:filename>')
+@login_required
+def serve_variant(filename, width):
+    """Serves one of the responsive widths of a user's photo, for srcset."""
+    if width not in VARIANT_WIDTHS:
+        abort(404)
+    return resized_photo_response(g.user, filename, get_variant, width)
+
+def current_media_item(user, filename, src_path):
+    """Returns the index row of a user's file, or None if the file changed since it was indexed."""
+    item = get_media_item(user['id'], filename)
+    if item:
+        stat = os.stat(src_path)
+        if stat.st_size != item['size'] or stat.st_mtime != item['mtime']:
+            return None
+    return item
+
+def source_version(item, src_path):
+    """Returns (version, last_modified) of a user's file, from its index row or, if it has none, from disk.
+
+    Copies made from the file are validated against these, not against their cache entry, whose mtime
+    changes every time the cache touches it.
+    """
+    if item:
+        return media_version(item['size'], item['mtime'], item['content_hash']), last_modified_for(item['mtime'])
+    stat = os.stat(src_path)
+    return media_version(stat.st_size, stat.st_mtime), last_modified_for(stat.st_mtime)
+
+def thumbnail_response(user, filename, size):
+    """Builds the thumbnail response for one of a user's photos."""
+    if size not in THUMBNAIL_SIZES:
+        abort(404)
+    return resized_photo_response(user, filename, get_thumbnail, size)
+
+def resized_photo_response(user, filename, get_resized, size):
+    """Serves a cached resized copy of a user's photo, made by get_resized in the best format the browser takes."""
+    if media_kind(filename) != 'photo':
+        abort(404)
+    if not user['photo_dir']:
+        abort(403)
+
+    src_path = safe_join(user['photo_dir'], filename)
+    if not src_path or not os.path.isfile(src_path):
+        abort(404)
+
+    item = current_media_item(user, filename, src_path)
+    mimetype = negotiate_format(request.accept_mimetypes)
+    version, last_modified = source_version(item, src_path)
+    etag = f"{version}-{size}-{mimetype.rpartition('/')[2]}"
+    if is_not_modified(etag, last_modified):
+        response = not_modified_response(version, last_modified, etag)
+        response.vary.add('Accept')
+        return response
+
+    try:
+        resized_path = get_resized(src_path, size, mimetype,
+                                   current_app.config['THUMBNAIL_CACHE_DIR'],
+                                   current_app.config['THUMBNAIL_CACHE_MAX_BYTES'],
+                                   item['content_hash'] if item else None)
+    except (OSError, Image.DecompressionBombError) as e:
+        current_app.logger.error(f"Error resizing {filename} to {size}: {e}")
+        abort(404)
+
+    with FILE_SEND_DURATION.time(source='resized'):
+        response = send_file(resized_path, mimetype=mimetype, etag=etag, last_modified=last_modified)
+    response.vary.add('Accept')
+    # Copies requested with the source file's version never change, so they can be cached for good
+    response.headers['Cache-Control'] = cache_control_for(version)
+    return response
+
+@main_bp.route('/poster/<path:filename>')
+@login_required
+def serve_poster(filename):
+    """Serves a still frame of one of the user's videos, or a generic poster when none can be made."""
+    return video_asset_response(g.user, filename, ensure_poster, 'image/jpeg')
+
+@main_bp.route('/preview/<path:filename>')
+@login_required
+def serve_preview(filename):
+    """Serves the short silent preview clip of one of the user's videos. 404 when ffmpeg is not available."""
+    return video_asset_response(g.user, filename, ensure_preview, 'video/mp4')
+
+def video_asset_response(user, filename, ensure, mimetype):
+    """Serves a cached file derived from a user's video by ensure (see previews.py)."""
+    if media_kind(filename) != 'video':
+        abort(404)
+    if not user['video_dir']:
+        abort(403)
+
+    src_path = safe_join(user['video_dir'], filename)
+    if not src_path or not os.path.isfile(src_path):
+        abort(404)
+
+    item = current_media_item(user, filename, src_path)
+    version, last_modified = source_version(item, src_path)
+    etag = f"{version}-{mimetype.rpartition('/')[2]}"
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(version, last_modified, etag)
+
+    try:
+        derived_path, created = get_derived(ensure, src_path, current_app.config['THUMBNAIL_CACHE_DIR'],
+                                            item['content_hash'] if item else None)
+    except OSError as e:
+        current_app.logger.error(f"Error extracting from video {filename}: {e}")
+        derived_path, created = None, False
+
+    if derived_path is None:
+        if ensure is not ensure_poster:
+            abort(404)
+        # Not cached for long, so the real poster shows up once the video can be processed
+        response = current_app.response_class(placeholder_poster(), mimetype='image/jpeg')
+        response.headers['Cache-Control'] = 'private, max-age=300'
+        return response
+
+    if created:
+        record_cache_write(current_app.config['THUMBNAIL_CACHE_DIR'], derived_path,
+                           current_app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+    with FILE_SEND_DURATION.time(source='video_asset'):
+        response = send_file(derived_path, mimetype=mimetype, etag=etag, last_modified=last_modified)
+    response.headers['Cache-Control'] = cache_control_for(version)
+    return response
 
 @main_bp.route('/view/<path:filename>')
 @login_required
 def view_media(filename):
     """Displays a single photo or video."""
-    user = get_user_by_id(session['user_id'])
-    user_dirs = get_user_directories(user['id'])
+    user = g.user
+    user_dirs = g.user_dirs
     if not user_dirs:
         abort(403)
 
@@ -317,23 +941,34 @@ def view_media(filename):
     video_dir = user_dirs['video_dir']
     
     # Check if the user has permissions to view the file
-    is_owner = (photo_dir and os.path.exists(os.path.join(photo_dir, filename))) or \
+    item = get_media_item(user['id'], filename)
+    is_owner = item is not None or \
+               (photo_dir and os.path.exists(os.path.join(photo_dir, filename))) or \
                (video_dir and os.path.exists(os.path.join(video_dir, filename)))
     
     if not is_owner and not user['is_admin']:
         abort(403)
-        
-    return render_page('view_media.html', filename=filename)
+
+    # Link the file with its version so the browser can cache it for good
+    version = media_version(item['size'], item['mtime'], item['content_hash']) if item else None
+    # Smaller copies for smaller screens; animated GIFs would lose their animation, so they are always sent as is
+    widths, original_width = [], None
+    if media_kind(filename) == 'photo' and not filename.lower().endswith('.gif'):
+        widths = variant_widths(item['width'], item['height']) if item else list(VARIANT_WIDTHS)
+        if item and item['width'] and item['height']:
+            original_width = max(item['width'], item['height'])
+    return render_page('view_media.html', filename=filename, version=version,
+                       variant_widths=widths, original_width=original_width)
 
 @main_bp.route('/delete/<path:filename>')
 @login_required
 def delete_file(filename):
     """Deletes a file if the user has permission."""
-    user = get_user_by_id(session['user_id'])
+    user = g.user
     if not user:
         abort(403)
 
-    user_dirs = get_user_directories(user['id'])
+    user_dirs = g.user_dirs
     if not user_dirs:
         abort(403)
         
@@ -349,32 +984,217 @@ def delete_file(filename):
         
     if file_path and (user['is_admin'] or os.path.dirname(file_path) in [photo_dir, video_dir]):
         os.remove(file_path)
+        delete_media(user['id'], filename)
     else:
         abort(403) # Forbidden
             
     return redirect(url_for('main.dashboard'))
 
+# --- Exports ---
+
+# Most filenames one export request can select; bigger exports go by date range or the whole library
+MAX_EXPORT_SELECTION = 5000
+
+@main_bp.route('/export', methods=['GET', 'POST'])
+@login_required
+def export_media():
+    """Downloads the user's media as a ZIP: the files named by filename (repeatable), those taken between
+    from and to (YYYY-MM-DD), or the whole library."""
+    return export_response(g.user)
+
+@main_bp.route('/admin/export/<int:user_id>')
+@login_required
+@admin_required
+def admin_export(user_id):
+    """Downloads any user's library as a ZIP."""
+    user = get_user_by_id(user_id)
+    if not user:
+        abort(404)
+    return export_response(user)
+
+def export_response(user):
+    """Streams a ZIP of some of a user's media, with Range support when the archive is deterministic."""
+    filenames = request.values.getlist('filename') or None
+    if filenames and len(filenames) > MAX_EXPORT_SELECTION:
+        abort(400, description=f"Select at most {MAX_EXPORT_SELECTION} files, or export by date instead.")
+    start = parse_date_arg('from')
+    end = parse_date_arg('to', end_of_day=True)
+
+    export = ZipExport(user, filenames, start, end, current_app.config['MEDIA_STREAM_CHUNK_SIZE'])
+    if not export.count:
+        abort(404, description="There is nothing to export.")
+    # The archive is only validated by its ETag, a hash of its entries. Dates say nothing useful here: deleting a
+    # file or adding an older one changes the archive without making any mtime newer.
+    if export.deterministic and request.if_none_match.contains(export.etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(export.etag)
+        return response
+
+    ranges = None
+    if export.deterministic and 'Range' in request.headers and export_if_range_matches(export.etag):
+        ranges = resolve_ranges(request.headers['Range'], export.length)
+    if ranges == []:
+        response = current_app.response_class(status=416)
+        response.headers['Content-Range'] = f"bytes */{export.length}"
+        return response
+    # Several ranges of an archive are not worth a multipart response; those clients get all of it
+    partial = bool(ranges) and len(ranges) == 1
+    start_byte, stop = ranges[0] if partial else (0, export.length)
+
+    response = current_app.response_class(stream_with_context(stream_export(export, start_byte, stop)),
+                                          status=206 if partial else 200, mimetype='application/zip',
+                                          direct_passthrough=True)
+    response.content_length = stop - start_byte
+    if partial:
+        response.headers['Content-Range'] = f"bytes {start_byte}-{stop - 1}/{export.length}"
+    if export.deterministic:
+        # Only an archive whose every byte is known up front can be resumed
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.set_etag(export.etag)
+    else:
+        response.headers['Accept-Ranges'] = 'none'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers.set('Content-Disposition', 'attachment', filename=f"selfly-{user['username']}.zip")
+    return response
+
+def export_if_range_matches(etag):
+    """Checks If-Range for an export. Only the archive's strong ETag counts; a date or weak tag never matches."""
+    if_range = request.headers.get('If-Range')
+    return if_range is None or if_range.strip() == f'"{etag}"'
+
+def stream_export(export, start, stop):
+    """Yields the archive, stopping short (so the client sees an incomplete download) if the library changes."""
+    try:
+        yield from export.generate(start, stop)
+    except (ExportChanged, OSError) as e:
+        current_app.logger.warning(f"Export for {export.user['username']} stopped: {e}")
+
 @main_bp.route('/admin')
 @login_required
 @admin_required
 def admin_dashboard():
-    """Displays a simple admin page with a list of all uploads from all configured directories."""
-    all_photos = []
-    # Find all users and their directories
-    users = get_all_users()
-    for user_row in users:
-        user_dirs = get_user_directories(user_row['id'])
-        if user_dirs:
-            if user_dirs['photo_dir'] and os.path.exists(user_dirs['photo_dir']):
-                for filename in os.listdir(user_dirs['photo_dir']):
-                    if allowed_file(filename) and not filename.endswith(('mp4', 'mov', 'avi')):
-                        all_photos.append({'filename': filename, 'username': user_row['username']})
-            if user_dirs['video_dir'] and os.path.exists(user_dirs['video_dir']):
-                for filename in os.listdir(user_dirs['video_dir']):
-                    if allowed_file(filename) and filename.endswith(('mp4', 'mov', 'avi')):
-                        all_photos.append({'filename': filename, 'username': user_row['username']})
-    
-    return render_page('admin.html', photos=all_photos, all_users=users)
+    """Displays the admin page: users with their library totals, and a filterable page of everyone's media."""
+    filters = admin_media_filters()
+    rows, next_cursor = get_admin_media(filters, ADMIN_MEDIA_PER_PAGE, request.args.get('cursor'))
+    next_page_url = None
+    if next_cursor:
+        next_page_url = url_for('main.admin_dashboard', **{**request.args.to_dict(), 'cursor': next_cursor})
+    return render_page('admin.html', media=rows, next_page_url=next_page_url, filters=request.args,
+                       all_users=get_all_users_with_stats(),
+                       ingest_counts=get_ingest_job_counts(), failed_jobs=get_recent_failed_ingest_jobs())
+
+@main_bp.route('/api/admin/media')
+@login_required
+@admin_required
+def admin_media_api():
+    """Returns a page of everyone's media, filtered like the admin dashboard listing."""
+    per_page = max(1, min(request.args.get('per_page', ADMIN_MEDIA_PER_PAGE, type=int), 500))
+    rows, next_cursor = get_admin_media(admin_media_filters(), per_page, request.args.get('cursor'))
+    return jsonify({
+        'items': [{
+            'id': row['id'],
+            'user_id': row['user_id'],
+            'username': row['username'],
+            'filename': row['filename'],
+            'kind': row['kind'],
+            'size': row['size'],
+            'taken': row['sort_key'],
+            'version': media_version(row['size'], row['mtime'], row['content_hash']),
+        } for row in rows],
+        'has_more': next_cursor is not None,
+        'next_cursor': next_cursor,
+    })
+
+def near_duplicate_groups():
+    """Finds groups of similar photos for the admin duplicate views, from the request's query arguments.
+
+    ?distance= is the largest number of differing hash bits that still counts as a near-duplicate,
+    ?user_id= limits the search to one user and ?limit= caps the number of groups returned.
+    """
+    distance = request.args.get('distance', current_app.config['DUPLICATE_MAX_DISTANCE'], type=int)
+    if not 0 <= distance <= MAX_DISTANCE:
+        abort(400, description=f"distance must be between 0 and {MAX_DISTANCE}.")
+    limit = max(1, min(request.args.get('limit', 200, type=int), 1000))
+    groups = cached_near_duplicates(request.args.get('user_id', type=int), distance)
+    return distance, len(groups), groups[:limit]
+
+# Near-duplicate groups by (user_id, distance), each with the phash version it was computed at.
+# Grouping a large library takes seconds, so it is only redone after the hashes change.
+_duplicate_groups = {}
+_duplicate_groups_lock = threading.Lock()
+# Most (user_id, distance) results kept at once
+DUPLICATE_CACHE_ENTRIES = 16
+
+def cached_near_duplicates(user_id, distance):
+    """Returns the near-duplicate groups of one user's photos (or everyone's), biggest groups first."""
+    key = (user_id, distance)
+    version = get_phash_version()
+    cached = _duplicate_groups.get(key)
+    if cached and cached[0] == version:
+        count_cache('duplicates', hit=True)
+        return cached[1]
+    # One grouping at a time, so concurrent requests after a change wait for it rather than redo it
+    with _duplicate_groups_lock:
+        version = get_phash_version()
+        cached = _duplicate_groups.get(key)
+        if cached and cached[0] == version:
+            count_cache('duplicates', hit=True)
+            return cached[1]
+        count_cache('duplicates', hit=False)
+        groups = find_near_duplicates(get_perceptual_hashes(user_id), distance)
+        # Biggest groups first; they free up the most space
+        groups.sort(key=lambda group: (-len(group), group[0][0]['user_id'], group[0][0]['filename']))
+        for stale in [k for k, (v, _) in _duplicate_groups.items() if v != version]:
+            del _duplicate_groups[stale]
+        if len(_duplicate_groups) >= DUPLICATE_CACHE_ENTRIES:
+            del _duplicate_groups[next(iter(_duplicate_groups))]
+        _duplicate_groups[key] = (version, groups)
+        return groups
+
+def duplicate_group_json(group):
+    """The API form of one near-duplicate group."""
+    hash_counts = Counter(row['content_hash'] for row, _distance in group if row['content_hash'])
+    return [{
+        'user_id': row['user_id'],
+        'username': row['username'],
+        'filename': row['filename'],
+        'size': row['size'],
+        'distance': row_distance,
+        # Byte-for-byte the same as another photo in the group
+        'exact_duplicate': hash_counts[row['content_hash']] > 1 if row['content_hash'] else False,
+    } for row, row_distance in group]
+
+@main_bp.route('/api/admin/duplicates')
+@login_required
+@admin_required
+def duplicates_api():
+    """Lists groups of near-duplicate photos across the library, by perceptual hash."""
+    distance, total, groups = near_duplicate_groups()
+    return jsonify({
+        'distance': distance,
+        'total_groups': total,
+        'groups': [duplicate_group_json(group) for group in groups],
+    })
+
+@main_bp.route('/admin/duplicates')
+@login_required
+@admin_required
+def admin_duplicates():
+    """Shows groups of near-duplicate photos across the library."""
+    distance, total, groups = near_duplicate_groups()
+    return render_page('admin_duplicates.html', groups=groups, total_groups=total, distance=distance,
+                       max_distance=MAX_DISTANCE, all_users=get_all_users(),
+                       selected_user=request.args.get('user_id', type=int))
+
+@main_bp.route('/metrics')
+@login_required
+@admin_required
+def metrics():
+    """Request, database, file and cache metrics in the Prometheus text format."""
+    response = current_app.response_class(render_metrics(), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @main_bp.route('/admin/settings', methods=['GET', 'POST'])
 @login_required
@@ -399,9 +1219,22 @@ def create_user_admin():
     photo_dir = request.form['photo_dir']
     video_dir = request.form['video_dir']
     is_admin = 'is_admin' in request.form
-    add_new_user(username, password, photo_dir, video_dir, is_admin)
+    if add_new_user(username, password, photo_dir, video_dir, is_admin):
+        watch_user_media(get_user_by_username(username)['id'])
     return redirect(url_for('main.admin_dashboard'))
 
+@main_bp.route('/admin/rescan', methods=['POST'])
+@login_required
+@admin_required
+def rescan_media_admin():
+    """Re-runs the reconciliation scan so files added outside the app show up.
+
+    A full scan of every library takes far too long for a request, so it runs in the background and
+    this answers 202 right away. 'started' is false if a rescan was already running.
+    """
+    started = start_rescan(current_app._get_current_object())
+    return jsonify({'started': started}), 202
+
 @main_bp.route('/admin/delete_user/<int:user_id>')
 @login_required
 @admin_required
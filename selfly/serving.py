@@ -0,0 +1,205 @@
+# serving.py
+import os
+import re
+import secrets
+import mimetypes
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import request, current_app, abort
+from werkzeug.wsgi import wrap_file
+from metrics import FILE_SEND_DURATION, count_cache, timed
+
+# Cache policy for URLs that carry the file's version (?v=...), which never change content
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# Cache policy for unversioned URLs: keep a copy, but check with us (cheaply, via 304) before using it
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+
+def media_version(size, mtime, content_hash=None):
+    """Returns a short token that changes whenever the file's content does.
+
+    The content hash is used once the ingest worker has computed it, the size and mtime before that.
+    """
+    if content_hash:
+        return content_hash[:32]
+    return f"{int(mtime * 1000000):x}-{size:x}"
+
+def last_modified_for(mtime):
+    """Turns a file mtime into the datetime used for Last-Modified."""
+    return datetime.fromtimestamp(int(mtime), timezone.utc)
+
+def is_not_modified(etag, last_modified):
+    """Checks the request's conditional headers against a file's validators.
+
+    If-None-Match takes precedence over If-Modified-Since, as RFC 9110 requires.
+    """
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        not_modified = last_modified <= request.if_modified_since
+    else:
+        return False
+    # A revalidation: a hit means the browser's copy is current and only a 304 goes out
+    count_cache('browser', hit=not_modified)
+    return not_modified
+
+def cache_control_for(version):
+    """Picks the Cache-Control value depending on whether the URL was versioned with the current version."""
+    if version and request.args.get('v') == version:
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
+
+def apply_cache_headers(response, version, last_modified, etag=None):
+    """Sets the ETag, Last-Modified and Cache-Control headers on a media response.
+
+    The ETag is the version unless the response is a copy derived from the file, which passes its own.
+    """
+    response.set_etag(etag or version)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control_for(version)
+    return response
+
+def not_modified_response(version, last_modified, etag=None):
+    """Builds an empty 304 response carrying the same validators and cache policy as a full one."""
+    return apply_cache_headers(current_app.response_class(status=304), version, last_modified, etag)
+
+# --- Sending files ---
+
+# More ranges than this in one request is almost certainly abuse, so the whole file is sent instead
+MAX_RANGES = 16
+
+ASCII_DIGITS = re.compile(r'[0-9]*')
+
+
+def resolve_ranges(range_header, length):
+    """Turns a Range header into a sorted list of (start, stop) byte offsets, stop exclusive.
+
+    Returns None when the header should be ignored (malformed, not bytes, or too many ranges) and an
+    empty list when none of the ranges can be satisfied. Suffix ranges (bytes=-500) and open-ended
+    ranges (bytes=500-) are supported, and overlapping or adjacent ranges are merged.
+    """
+    units, _, range_set = range_header.partition('=')
+    specs = range_set.split(',')
+    if units.strip().lower() != 'bytes' or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        # ASCII digits only: str.isdigit() also takes characters like '²' that int() rejects
+        if not dash or not (first or last) or not ASCII_DIGITS.fullmatch(first) or not ASCII_DIGITS.fullmatch(last):
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            start, stop = max(length - int(last), 0), length
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = min(int(last) + 1, length) if last else length
+        if start < stop:
+            ranges.append((start, stop))
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def if_range_matches(etag, last_modified):
+    """Checks If-Range; a Range header only applies if the client's copy is still current."""
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return last_modified <= if_range.date
+    return True
+
+def read_range(path, start, stop, chunk_size):
+    """Yields the bytes of a file between start and stop, never holding more than chunk_size in memory."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def multipart_ranges(path, ranges, parts, boundary, chunk_size):
+    """Yields a multipart/byteranges body; parts holds the header block for each range."""
+    for (start, stop), part_header in zip(ranges, parts):
+        yield part_header
+        yield from read_range(path, start, stop, chunk_size)
+        yield b'\r\n'
+    yield f"--{boundary}--\r\n".encode('ascii')
+
+def offload_response(path, mimetype):
+    """Hands the transfer to the front proxy with X-Sendfile or X-Accel-Redirect, if one is configured."""
+    mode = current_app.config['MEDIA_SENDFILE']
+    response = current_app.response_class(mimetype=mimetype)
+    if mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    elif mode == 'x-accel-redirect':
+        prefix = current_app.config['MEDIA_ACCEL_REDIRECT_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = quote(prefix + os.path.abspath(path))
+    else:
+        return None
+    return response
+
+@timed(FILE_SEND_DURATION, source='media')
+def send_media_file(path, version, last_modified):
+    """Sends a media file with Range support, using the front proxy or bounded-buffer streaming.
+
+    Whole files go through the server's wsgi.file_wrapper, which uses sendfile() where the server
+    supports it. Range requests are streamed in MEDIA_STREAM_CHUNK_SIZE pieces, so memory use does
+    not depend on the size of the file or the requested range.
+    """
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    response = offload_response(path, mimetype)
+    if response is not None:
+        # The proxy does the Range handling and the actual transfer
+        return apply_cache_headers(response, version, last_modified)
+
+    try:
+        length = os.path.getsize(path)
+    except OSError:
+        abort(404)
+    chunk_size = current_app.config['MEDIA_STREAM_CHUNK_SIZE']
+
+    ranges = None
+    if 'Range' in request.headers and if_range_matches(version, last_modified):
+        ranges = resolve_ranges(request.headers['Range'], length)
+
+    if ranges == []:
+        response = current_app.response_class(status=416)
+        response.headers['Content-Range'] = f"bytes */{length}"
+    elif not ranges:
+        f = open(path, 'rb')
+        response = current_app.response_class(wrap_file(request.environ, f, chunk_size), mimetype=mimetype,
+                                              direct_passthrough=True)
+        response.content_length = length
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response = current_app.response_class(read_range(path, start, stop, chunk_size), status=206,
+                                              mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{length}"
+        response.content_length = stop - start
+    else:
+        boundary = secrets.token_hex(16)
+        parts = [(f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                  f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n").encode('ascii')
+                 for start, stop in ranges]
+        body_length = sum(len(part) + (stop - start) + 2 for part, (start, stop) in zip(parts, ranges))
+        body_length += len(f"--{boundary}--\r\n")
+        response = current_app.response_class(multipart_ranges(path, ranges, parts, boundary, chunk_size),
+                                              status=206, direct_passthrough=True,
+                                              content_type=f"multipart/byteranges; boundary={boundary}")
+        response.content_length = body_length
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    return apply_cache_headers(response, version, last_modified)
@@ -0,0 +1,208 @@
+# sharing.py
+import os
+import uuid
+import base64
+import random
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from database import get_setting, create_share_job
+from jobs import JobWorker
+
+# Bytes of the file encoded at a time; a multiple of 3, so the pieces join up into valid Base64
+ENCODE_CHUNK_SIZE = 3 * 16 * 1024
+
+# First retry delay in seconds, doubled on every further attempt
+RETRY_BASE_DELAY = 5
+
+
+class ShareError(Exception):
+    """A failed upload to a public host. retryable says whether trying again later may work."""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class Base64MultipartBody:
+    """A multipart/form-data request body with one file sent as a Base64 text field.
+
+    The file is read and encoded a chunk at a time as the body is sent, so memory use stays flat
+    however big the file is. The length is known up front, so requests sends a Content-Length.
+    """
+
+    def __init__(self, path, field, fields=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                       for name, value in (fields or {}).items())
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"\r\n\r\n'
+        tail = f"\r\n--{boundary}--\r\n".encode('ascii')
+        size = os.path.getsize(path)
+        self.length = len(head.encode('utf-8')) + 4 * ((size + 2) // 3) + len(tail)
+        self.file = open(path, 'rb')
+        self.buffer = head.encode('utf-8')
+        self.tail = tail
+        self.finished = False
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and not self.finished:
+            chunk = self.file.read(ENCODE_CHUNK_SIZE)
+            if chunk:
+                self.buffer += base64.b64encode(chunk)
+            else:
+                self.buffer += self.tail
+                self.finished = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+# --- Providers ---
+
+class ShareProvider:
+    """A public image host. Subclasses implement upload and register themselves in PROVIDERS."""
+
+    name = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds the provider from the app config (and settings; called inside an app context)."""
+        return cls()
+
+    def configuration_error(self):
+        """Returns why the provider cannot be used, or None if it is ready."""
+        return None
+
+    def upload(self, session, path, filename, timeout):
+        """Uploads a file with the given requests session and returns its public URL. Raises ShareError."""
+        raise NotImplementedError
+
+
+class ImageBBProvider(ShareProvider):
+    """Uploads to ImageBB (https://api.imgbb.com/), or anything that speaks its API at IMAGEBB_API_URL."""
+
+    name = 'imagebb'
+
+    def __init__(self, api_url, api_key):
+        self.api_url = api_url
+        self.api_key = api_key
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['IMAGEBB_API_URL'], get_setting('imagebb_api_key'))
+
+    def configuration_error(self):
+        if not self.api_key:
+            return "ImageBB API key not configured. Please set it in admin settings."
+        return None
+
+    def upload(self, session, path, filename, timeout):
+        error = self.configuration_error()
+        if error:
+            raise ShareError(error)
+        # The key goes in the body rather than the URL, so it does not end up in error messages and logs
+        body = Base64MultipartBody(path, 'image', {'key': self.api_key, 'name': os.path.splitext(filename)[0]})
+        try:
+            response = session.post(self.api_url, data=body,
+                                    headers={'Content-Type': body.content_type}, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            # Connection problems and timeouts; the host may be back later
+            raise ShareError(f"Request to ImageBB failed: {e}", retryable=True) from e
+        finally:
+            body.close()
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise ShareError(f"ImageBB returned HTTP {response.status_code}", retryable=True)
+        try:
+            result = response.json()
+        except ValueError:
+            raise ShareError(f"ImageBB returned an unreadable response (HTTP {response.status_code})",
+                             retryable=response.ok)
+        if not response.ok or not result.get('success'):
+            message = (result.get('error') or {}).get('message', f"HTTP {response.status_code}")
+            raise ShareError(f"ImageBB upload failed: {message}")
+        return result['data']['url']
+
+
+PROVIDERS = {provider.name: provider for provider in (ImageBBProvider,)}
+
+def get_share_provider(config, name=None):
+    """Returns the provider called name, or the configured SHARE_PROVIDER."""
+    name = name or config['SHARE_PROVIDER']
+    if name not in PROVIDERS:
+        raise ShareError(f"Unknown share provider: {name}")
+    return PROVIDERS[name].from_config(config)
+
+
+# --- Background uploads ---
+
+def make_session(pool_size):
+    """Builds a requests session whose connections are kept alive and shared by the upload threads."""
+    session = requests.Session()
+    # Retries are the job queue's business, with backoff, rather than the adapter's
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class ShareWorker(JobWorker):
+    """Runs queued public-share uploads on a small thread pool, retrying failures with backoff."""
+
+    queue = 'share_jobs'
+    name = 'share'
+
+    def __init__(self, app):
+        super().__init__(app, app.config['SHARE_WORKERS'], app.config['SHARE_MAX_ATTEMPTS'])
+        self.timeout = (app.config['SHARE_CONNECT_TIMEOUT'], app.config['SHARE_READ_TIMEOUT'])
+        self.session = make_session(self.max_workers)
+
+    def make_pool(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='share-upload')
+
+    def submit(self, job):
+        return self.pool.submit(self.upload, job)
+
+    def upload(self, job):
+        """Uploads one file and returns its public URL. Runs on an upload thread."""
+        with self.app.app_context():
+            provider = get_share_provider(self.app.config, job['provider'])
+            return provider.upload(self.session, job['path'], job['filename'], self.timeout)
+
+    def retry_delay(self, attempt):
+        # Exponential backoff with jitter, so retries of a burst do not hit the host together
+        return RETRY_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.75, 1.25)
+
+    def record_result(self, job, future):
+        """Stores the public link of a finished upload, or schedules a retry if the host may recover."""
+        try:
+            public_url = future.result()
+        except Exception as e:
+            self.record_failure(job, e, final=not (isinstance(e, ShareError) and e.retryable))
+            return
+        self.finish(job, public_url=public_url)
+
+
+_worker = None
+
+def start_share_worker(app):
+    """Starts the app's public-share upload worker."""
+    global _worker
+    _worker = ShareWorker(app)
+    _worker.start()
+
+def queue_share(user_id, filename, path, provider_name):
+    """Queues the upload of a file to a public host and returns the job id."""
+    job_id = uuid.uuid4().hex
+    create_share_job(job_id, user_id, filename, path, provider_name)
+    if _worker is not None:
+        _worker.notify()
+    return job_id
@@ -0,0 +1,243 @@
+# similarity.py
+from PIL import Image, ImageOps
+from metrics import IMAGE_DURATION, timed
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional; the pure Python path gives the same hashes
+    numpy = None
+
+# dHash compares each pixel of a small grayscale copy with its right-hand neighbour: 8x8 = 64 bits
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HASH_MASK = (1 << HASH_BITS) - 1
+
+# Largest distance the similarity index searches for (see band_layout)
+MAX_DISTANCE = 7
+
+
+@timed(IMAGE_DURATION, operation='phash')
+def dhash(path):
+    """Returns the 64-bit difference hash of an image as a signed integer, ready for SQLite.
+
+    The image is turned upright first, so a copy that had its EXIF rotation applied hashes the same.
+    """
+    with Image.open(path) as img:
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        img = ImageOps.exif_transpose(img).convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX)
+    if numpy is not None:
+        pixels = numpy.asarray(img, dtype=numpy.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        value = int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+    else:
+        pixels = img.tobytes()
+        value = 0
+        for row in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1)
+            for col in range(HASH_SIZE):
+                value = (value << 1) | (pixels[offset + col + 1] > pixels[offset + col])
+    return to_signed(value)
+
+def to_signed(value):
+    """Maps an unsigned 64-bit hash onto SQLite's signed INTEGER range."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+def hamming_distance(a, b):
+    """Number of differing bits between two hashes."""
+    return ((a ^ b) & HASH_MASK).bit_count()
+
+def band_layout(max_distance):
+    """Picks how many bands the index splits hashes into, and how far each band is searched.
+
+    Two hashes at most max_distance apart differ by at most max_distance // bands bits in at least
+    one band (pigeonhole). Exact band matches are cheapest, so small distances use 4 bands of 16
+    bits; larger ones search one bit around wider bands, which keeps the buckets small.
+    """
+    bands = 4 if max_distance <= 3 or max_distance >= 6 else 3
+    return bands, max_distance // bands
+
+def flip_masks(width, radius):
+    """Returns the XOR masks that turn a band value into every value within radius bits of it."""
+    masks = [0]
+    if radius >= 1:
+        masks += [1 << i for i in range(width)]
+    return masks
+
+
+class HashIndex:
+    """Finds hashes within a Hamming distance of each other without comparing every pair.
+
+    Multi-index hashing: the 64 bits are split into bands, and only hashes whose bands match (or
+    nearly match) are compared; see band_layout. With NumPy the candidates of a whole band are
+    found and compared at once, which is what keeps large libraries at the larger distances fast.
+    """
+
+    def __init__(self, max_distance):
+        if not 0 <= max_distance <= MAX_DISTANCE:
+            raise ValueError(f"max_distance must be between 0 and {MAX_DISTANCE}")
+        self.max_distance = max_distance
+        band_count, self.radius = band_layout(max_distance)
+        widths = [HASH_BITS // band_count + (1 if band < HASH_BITS % band_count else 0)
+                  for band in range(band_count)]
+        # (shift, mask) of each band
+        self.bands = [(sum(widths[:band]), (1 << width) - 1) for band, width in enumerate(widths)]
+        self.masks = [flip_masks(width, self.radius) for width in widths]
+        self.hashes = []
+
+    def add(self, value):
+        """Adds a hash and returns its position in the index."""
+        self.hashes.append(value & HASH_MASK)  # Work on the unsigned form
+        return len(self.hashes) - 1
+
+    def groups(self):
+        """Clusters the indexed hashes into groups of near-duplicates (lists of positions, size 2 or more).
+
+        Groups come in the order of their first position, and list their positions in order.
+        """
+        if numpy is not None:
+            return self.array_groups()
+        return self.table_groups()
+
+    def table_groups(self):
+        """groups() in pure Python, with a lookup table per band.
+
+        Work is driven by the distinct band values rather than by every hash, so each table is
+        probed once per value it holds.
+        """
+        tables = [{} for _ in self.bands]
+        for position, value in enumerate(self.hashes):
+            for (shift, mask), table in zip(self.bands, tables):
+                table.setdefault((value >> shift) & mask, []).append(position)
+
+        parent = list(range(len(self.hashes)))
+
+        def root(position):
+            while parent[position] != position:
+                parent[position] = parent[parent[position]]
+                position = parent[position]
+            return position
+
+        hashes = self.hashes
+        max_distance = self.max_distance
+        for table, masks in zip(tables, self.masks):
+            for key, members in table.items():
+                for flip in masks:
+                    other_key = key ^ flip
+                    if other_key < key:
+                        continue  # This pair of buckets is handled from the other side
+                    others = table.get(other_key)
+                    if not others:
+                        continue
+                    for i, a in enumerate(members):
+                        value = hashes[a]
+                        for b in (members[i + 1:] if flip == 0 else others):
+                            # Comparing hashes is cheaper than finding roots, so do that first
+                            if (value ^ hashes[b]).bit_count() <= max_distance:
+                                root_a, root_b = root(a), root(b)
+                                if root_a != root_b:
+                                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        clusters = {}
+        for position in range(len(self.hashes)):
+            clusters.setdefault(root(position), []).append(position)
+        return [members for members in clusters.values() if len(members) > 1]
+
+    def array_groups(self):
+        """groups() with NumPy: each band and flip mask is one pass over sorted arrays.
+
+        Identical hashes are folded together first, so many copies of one photo are compared once
+        rather than pair by pair.
+        """
+        values, copies_of = numpy.unique(numpy.array(self.hashes, dtype=numpy.uint64), return_inverse=True)
+        parent = {}  # Only values with a close neighbour get an entry
+
+        def root(position):
+            while parent.setdefault(position, position) != position:
+                parent[position] = parent[parent[position]]
+                position = parent[position]
+            return position
+
+        for firsts, seconds in self.close_pairs(values):
+            for a, b in zip(firsts.tolist(), seconds.tolist()):
+                root_a, root_b = root(a), root(b)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        # Label every position with its cluster, keep the labels shared by more than one position and
+        # split those positions up by label
+        cluster_of = numpy.arange(len(values))
+        if parent:
+            linked = numpy.fromiter(parent, dtype=numpy.int64, count=len(parent))
+            cluster_of[linked] = [root(value) for value in linked.tolist()]
+        labels = cluster_of[copies_of.ravel()]
+        positions = numpy.flatnonzero(numpy.bincount(labels, minlength=len(values))[labels] > 1)
+        positions = positions[numpy.argsort(labels[positions], kind='stable')]
+        boundaries = numpy.flatnonzero(numpy.diff(labels[positions])) + 1
+        groups = [members.tolist() for members in numpy.split(positions, boundaries)] if len(positions) else []
+        groups.sort(key=lambda members: members[0])
+        return groups
+
+    def close_pairs(self, values):
+        """Yields (a, b) arrays of indices into values whose hashes are within max_distance bits.
+
+        values must be sorted and distinct. Every close pair turns up at least once.
+        """
+        for (shift, mask), masks in zip(self.bands, self.masks):
+            keys = (values >> numpy.uint64(shift)) & numpy.uint64(mask)
+            order = numpy.argsort(keys, kind='stable')
+            by_key = values[order]
+            bucket_keys, bucket_starts, bucket_sizes = numpy.unique(keys[order], return_index=True,
+                                                                    return_counts=True)
+            bucket_of = numpy.repeat(numpy.arange(len(bucket_keys)), bucket_sizes)  # per sorted position
+            # Bands are at most 22 bits wide, so a direct lookup table from key to bucket stays small
+            bucket_at = numpy.full(mask + 1, -1, dtype=numpy.int32)
+            bucket_at[bucket_keys] = numpy.arange(len(bucket_keys), dtype=numpy.int32)
+            for flip in masks:
+                if flip == 0:
+                    # Every later member of the same bucket
+                    starts = numpy.arange(1, len(order) + 1)
+                    counts = (bucket_starts + bucket_sizes)[bucket_of] - starts
+                    firsts, seconds = expand_ranges(starts, counts)
+                else:
+                    # Every member of the bucket flip bits away, if that comes later (it is handled from
+                    # the other side otherwise). Only buckets that have such a partner are expanded.
+                    targets = bucket_keys ^ numpy.uint64(flip)
+                    found = bucket_at[targets]
+                    hits = numpy.flatnonzero((found >= 0) & (targets > bucket_keys))
+                    partners = found[hits]
+                    owner, firsts = expand_ranges(bucket_starts[hits], bucket_sizes[hits])
+                    pair_of, seconds = expand_ranges(bucket_starts[partners][owner], bucket_sizes[partners][owner])
+                    firsts = firsts[pair_of]
+                close = popcount(by_key[firsts] ^ by_key[seconds]) <= self.max_distance
+                yield order[firsts[close]], order[seconds[close]]
+
+
+def expand_ranges(starts, counts):
+    """Lists the ranges starts[i] ... starts[i] + counts[i] - 1 one after another.
+
+    Returns the i each entry came from and the entries themselves, as two arrays.
+    """
+    which = numpy.repeat(numpy.arange(len(counts)), counts)
+    offsets = numpy.arange(len(which)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return which, starts[which] + offsets
+
+def popcount(values):
+    """Number of set bits in each element of a uint64 array."""
+    if hasattr(numpy, 'bitwise_count'):  # NumPy 2.0 and later
+        return numpy.bitwise_count(values)
+    return numpy.unpackbits(values.view(numpy.uint8)).reshape(len(values), 64).sum(axis=1)
+
+
+def find_near_duplicates(rows, max_distance):
+    """Groups media rows (with a 'phash' column) whose perceptual hashes are within max_distance bits.
+
+    Returns a list of groups, each a list of (row, distance from the group's first row).
+    """
+    index = HashIndex(max_distance)
+    for row in rows:
+        index.add(row['phash'])
+    groups = []
+    for members in index.groups():
+        first = rows[members[0]]['phash']
+        groups.append([(rows[m], hamming_distance(first, rows[m]['phash'])) for m in members])
+    return groups
@@ -0,0 +1,230 @@
+# thumbnails.py
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+from PIL import Image, ImageOps, features
+from metrics import IMAGE_DURATION, count_cache, timed
+
+# The only thumbnail sizes we generate (longest edge, in pixels)
+THUMBNAIL_SIZES = (256, 512, 1024)
+
+# Widths of the responsive variants offered through srcset. A variant is never wider than its source.
+VARIANT_WIDTHS = (320, 640, 960, 1280, 1920, 2560)
+
+# Pillow save format, file extension and quality for each output mimetype
+THUMBNAIL_FORMATS = {
+    'image/webp': ('WEBP', 'webp', 80),
+    'image/jpeg': ('JPEG', 'jpg', 80),
+}
+# AVIF is much smaller at the same quality, but needs a Pillow built with libavif
+if features.check('avif'):
+    THUMBNAIL_FORMATS['image/avif'] = ('AVIF', 'avif', 60)
+
+# Output formats in order of preference; JPEG is what every browser gets when it names nothing better
+PREFERRED_FORMATS = [mimetype for mimetype in ('image/avif', 'image/webp') if mimetype in THUMBNAIL_FORMATS]
+
+# Other derived files kept in the same cache (see previews.py)
+DERIVED_EXTENSIONS = {'video/mp4': 'mp4'}
+
+_cache_lock = threading.Lock()
+_cache_bytes = None  # Total size of the cache directory, computed on first use
+
+_render_locks_lock = threading.Lock()
+_render_locks = {}  # cache path -> [lock, number of threads using it]
+
+
+def negotiate_format(accept_mimetypes):
+    """Picks the output mimetype for a request's Accept header.
+
+    Only formats the browser names explicitly count: most send */* too, which says nothing about
+    whether they can actually display AVIF or WebP.
+    """
+    accepted = {value for value, quality in accept_mimetypes if quality > 0}
+    for mimetype in PREFERRED_FORMATS:
+        if mimetype in accepted:
+            return mimetype
+    return 'image/jpeg'
+
+def thumbnail_key(src_path, size, mimetype, content_hash=None):
+    """Builds the cache key for a thumbnail from the source file's content and the requested output.
+
+    Entries are keyed by the content hash once the ingest worker has computed it, so renaming or touching
+    a file keeps its thumbnails and identical files share them. Until then the file's path, size and
+    mtime stand in for its content.
+    """
+    if content_hash:
+        ident = f"{content_hash}|{size}|{mimetype}"
+    else:
+        stat = os.stat(src_path)
+        ident = f"{os.path.abspath(src_path)}|{stat.st_size}|{stat.st_mtime_ns}|{size}|{mimetype}"
+    return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+def cache_path_for(cache_dir, key, mimetype):
+    """Returns where a cached file for the given key lives, fanned out into sub-directories."""
+    extension = THUMBNAIL_FORMATS[mimetype][1] if mimetype in THUMBNAIL_FORMATS else DERIVED_EXTENSIONS[mimetype]
+    return os.path.join(cache_dir, key[:2], f"{key}.{extension}")
+
+@timed(IMAGE_DURATION, operation='resize')
+def render_thumbnail(src_path, dest_path, box, mimetype):
+    """Decodes the source image, shrinks it to fit the (width, height) box and writes it atomically to dest_path.
+
+    The EXIF orientation is applied, so the result is upright and carries no rotation flag.
+    """
+    pil_format, _extension, quality = THUMBNAIL_FORMATS[mimetype]
+    with Image.open(src_path) as img:
+        # Let the JPEG decoder downscale while decoding, which is much cheaper than a full decode.
+        # The image may still be rotated, so the smaller side of the box must fit either way round.
+        draft_size = min(box)
+        img.draft('RGB', (draft_size, draft_size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(box)
+        if pil_format == 'JPEG' and img.mode != 'RGB':
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            img.save(tmp_path, pil_format, quality=quality)
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+@contextmanager
+def render_lock(dest_path):
+    """Lets only one thread at a time render a given cache file.
+
+    When a cold cache gets many requests for the same image at once, the first one decodes it and
+    the others wait and then find the file in the cache, instead of all decoding it in parallel.
+    """
+    with _render_locks_lock:
+        entry = _render_locks.setdefault(dest_path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _render_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _render_locks[dest_path]
+
+def ensure_cached(src_path, label, mimetype, cache_dir, render, cache_name='thumbnail', content_hash=None):
+    """Makes sure a file derived from src_path exists in the cache, calling render(dest_path) to make it.
+    Returns (path, created).
+
+    label tells apart the different outputs made from the same source, e.g. thumbnails and variants;
+    cache_name is what hits and misses are counted under in /metrics, and content_hash is the source's
+    BLAKE2b hash if known (see thumbnail_key).
+    This does no cache accounting, so it is safe to call from ingest worker processes.
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    key = thumbnail_key(src_path, label, mimetype, content_hash)
+    dest_path = cache_path_for(cache_dir, key, mimetype)
+    if os.path.exists(dest_path):
+        # Touch the file so eviction treats it as recently used
+        os.utime(dest_path)
+        count_cache(cache_name, hit=True)
+        return dest_path, False
+
+    with render_lock(dest_path):
+        # Another request may have rendered it while we waited
+        if os.path.exists(dest_path):
+            count_cache(cache_name, hit=True)
+            return dest_path, False
+        count_cache(cache_name, hit=False)
+        render(dest_path)
+    return dest_path, True
+
+def ensure_rendered(src_path, label, box, mimetype, cache_dir, cache_name, content_hash=None):
+    """Makes sure a copy of src_path resized to fit box exists in the cache. Returns (path, created)."""
+    return ensure_cached(src_path, label, mimetype, cache_dir,
+                         lambda dest_path: render_thumbnail(src_path, dest_path, box, mimetype), cache_name,
+                         content_hash)
+
+def ensure_thumbnail(src_path, size, mimetype, cache_dir, content_hash=None):
+    """Makes sure a thumbnail (longest edge at most size) exists in the cache. Returns (path, created)."""
+    return ensure_rendered(src_path, size, (size, size), mimetype, cache_dir, 'thumbnail', content_hash)
+
+def ensure_variant(src_path, width, mimetype, cache_dir, content_hash=None):
+    """Makes sure a responsive variant (at most width pixels wide) exists in the cache. Returns (path, created)."""
+    # Only the width is limited, however tall the image is
+    return ensure_rendered(src_path, f"w{width}", (width, width * 100), mimetype, cache_dir, 'variant',
+                           content_hash)
+
+def get_thumbnail(src_path, size, mimetype, cache_dir, max_bytes, content_hash=None):
+    """Returns the path of a cached thumbnail, generating it first if needed."""
+    dest_path, created = ensure_thumbnail(src_path, size, mimetype, cache_dir, content_hash)
+    if created:
+        record_cache_write(cache_dir, dest_path, max_bytes)
+    return dest_path
+
+def get_variant(src_path, width, mimetype, cache_dir, max_bytes, content_hash=None):
+    """Returns the path of a cached responsive variant, generating it first if needed."""
+    dest_path, created = ensure_variant(src_path, width, mimetype, cache_dir, content_hash)
+    if created:
+        record_cache_write(cache_dir, dest_path, max_bytes)
+    return dest_path
+
+def variant_widths(width, height):
+    """Returns the variant widths worth offering for an image of the given size.
+
+    The stored size is before EXIF rotation, so the longer side is used as the upright width could be either.
+    """
+    if not width or not height:
+        return list(VARIANT_WIDTHS)
+    longest = max(width, height)
+    return [w for w in VARIANT_WIDTHS if w < longest] or [VARIANT_WIDTHS[0]]
+
+def cache_size(cache_dir):
+    """Adds up the size of every file in the cache directory."""
+    total = 0
+    for root, _dirs, files in os.walk(cache_dir):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def record_cache_write(cache_dir, written_path, max_bytes):
+    """Accounts for a newly written cache file and evicts old entries when the cache is over budget."""
+    global _cache_bytes
+    cache_dir = os.path.abspath(cache_dir)
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = cache_size(cache_dir)
+        elif os.path.exists(written_path):
+            _cache_bytes += os.path.getsize(written_path)
+        if _cache_bytes > max_bytes:
+            _cache_bytes = evict_lru(cache_dir, int(max_bytes * 0.9), keep=written_path)
+
+def evict_lru(cache_dir, target_bytes, keep=None):
+    """Deletes least recently used cache files until the cache fits in target_bytes. Returns the new size.
+
+    The file at keep (the one just written) is never evicted.
+    """
+    entries = []
+    for root, _dirs, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in sorted(entries):
+        if total <= target_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,273 @@
+# uploads.py
+import os
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from metrics import IMAGE_DURATION
+from database import (create_upload_session, update_upload_progress, delete_upload_session, get_expired_upload_sessions,
+                      find_media_by_hash)
+
+# Chunks are streamed to disk in pieces of this size, so memory use per upload stays bounded
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Temporary files live next to their final location, hidden and with an extension the library scan ignores
+TEMP_PREFIX = '.selfly-upload-'
+TEMP_SUFFIX = '.part'
+
+# Running content hashes of in-progress uploads: upload id -> (bytes hashed so far, hash object)
+_hashers = {}
+# Uploads that currently have a chunk being written
+_writing = set()
+_hashers_lock = threading.Lock()
+
+
+class UploadBusy(Exception):
+    """Raised when a chunk arrives for an upload that is already receiving another one."""
+
+
+def new_hasher():
+    """Returns the hash object used for content hashes (the same BLAKE2b the ingest worker uses)."""
+    return hashlib.blake2b(digest_size=32)
+
+def start_upload(user_id, kind, filename, total_size, target_dir):
+    """Creates an upload session and its empty temporary file. Returns the session id."""
+    upload_id = secrets.token_urlsafe(16)
+    temp_path = os.path.join(target_dir, f"{TEMP_PREFIX}{upload_id}{TEMP_SUFFIX}")
+    open(temp_path, 'wb').close()
+    create_upload_session(upload_id, user_id, kind, filename, temp_path, total_size)
+    with _hashers_lock:
+        _hashers[upload_id] = (0, new_hasher())
+    return upload_id
+
+def hasher_for(upload):
+    """Returns the running hash for an upload, rebuilding it from the temp file if the app restarted."""
+    with _hashers_lock:
+        hashed, hasher = _hashers.pop(upload['id'], (0, None))
+    if hasher is None or hashed != upload['received']:
+        hasher = new_hasher()
+        with open(upload['temp_path'], 'rb') as f:
+            remaining = upload['received']
+            while remaining > 0:
+                chunk = f.read(min(WRITE_BUFFER_SIZE, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+    return hasher
+
+def write_chunk(upload, stream, length):
+    """Appends length bytes from stream to the upload's temp file and returns the new offset.
+
+    Data is copied in WRITE_BUFFER_SIZE pieces and hashed as it arrives. If the client disconnects
+    part way, the bytes that did arrive are kept, so the next attempt resumes from there.
+    """
+    with _hashers_lock:
+        if upload['id'] in _writing:
+            raise UploadBusy(upload['id'])
+        _writing.add(upload['id'])
+
+    offset = upload['received']
+    hasher = None
+    try:
+        hasher = hasher_for(upload)
+        with open(upload['temp_path'], 'r+b') as f:
+            f.seek(offset)
+            # Drop anything past the confirmed offset left by an earlier interrupted write
+            f.truncate()
+            remaining = min(length, upload['total_size'] - offset)
+            while remaining > 0:
+                chunk = stream.read(min(WRITE_BUFFER_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                hasher.update(chunk)
+                offset += len(chunk)
+                remaining -= len(chunk)
+    finally:
+        # If the temp file could not even be read back, nothing was written and there is no hash to keep
+        if hasher is not None:
+            update_upload_progress(upload['id'], offset)
+        with _hashers_lock:
+            if hasher is not None:
+                _hashers[upload['id']] = (offset, hasher)
+            _writing.discard(upload['id'])
+    return offset
+
+def finish_upload(upload, dedupe_mode):
+    """Moves a completed upload into the library with store_file, then closes its session.
+
+    Returns (status, path, content_hash) as store_file does. If storing fails the session stays, so
+    its temp file is still cleaned up by expire_uploads and the client can try again.
+    """
+    with _hashers_lock:
+        if upload['id'] in _writing:
+            raise UploadBusy(upload['id'])
+        _writing.add(upload['id'])
+    try:
+        content_hash = hasher_for(upload).hexdigest()
+        status, path = store_file(upload['temp_path'], content_hash, upload['user_id'],
+                                  os.path.dirname(upload['temp_path']), upload['filename'], dedupe_mode)
+        delete_upload_session(upload['id'])
+    finally:
+        with _hashers_lock:
+            _writing.discard(upload['id'])
+    return status, path, content_hash
+
+def cancel_upload(upload):
+    """Throws away an upload session and its temp file."""
+    with _hashers_lock:
+        _hashers.pop(upload['id'], None)
+    if os.path.exists(upload['temp_path']):
+        os.remove(upload['temp_path'])
+    delete_upload_session(upload['id'])
+
+def expire_uploads(max_age):
+    """Cancels upload sessions that have not received data for max_age seconds."""
+    for upload in get_expired_upload_sessions(max_age):
+        cancel_upload(upload)
+
+# --- Storing finished uploads ---
+
+def new_temp_path(directory):
+    """Returns a fresh temp file path in directory."""
+    return os.path.join(directory, f"{TEMP_PREFIX}{secrets.token_urlsafe(8)}{TEMP_SUFFIX}")
+
+def write_temp_file(stream, directory):
+    """Copies a stream into a new temp file in directory, hashing it on the way.
+
+    Returns (temp_path, content_hash).
+    """
+    hasher = new_hasher()
+    temp_path = new_temp_path(directory)
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(WRITE_BUFFER_SIZE), b''):
+                f.write(chunk)
+                hasher.update(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, hasher.hexdigest()
+
+def unique_name(filename, attempt):
+    """Returns the filename to try on the given attempt: photo.jpg, photo_1.jpg, photo_2.jpg, ..."""
+    if attempt == 0:
+        return filename
+    stem, dot, ext = filename.rpartition('.')
+    return f"{stem}_{attempt}.{ext}" if dot else f"{filename}_{attempt}"
+
+def link_into_place(source, directory, filename):
+    """Hardlinks source into directory under filename, or the first free numbered variant of it.
+
+    Existing files are never replaced, even if another upload claims the same name at the same moment.
+    Returns the path that was created.
+    """
+    for attempt in range(10000):
+        target = os.path.join(directory, unique_name(filename, attempt))
+        try:
+            os.link(source, target)
+            return target
+        except FileExistsError:
+            continue
+    raise FileExistsError(f"No free name for {filename}")
+
+def place_file(temp_path, directory, filename):
+    """Moves a finished temp file to directory/filename without overwriting anything. Returns the final path."""
+    try:
+        target = link_into_place(temp_path, directory, filename)
+    except FileExistsError:
+        raise
+    except OSError:
+        # The filesystem has no hardlinks; claim the name with an exclusive create and rename over it
+        for attempt in range(10000):
+            target = os.path.join(directory, unique_name(filename, attempt))
+            try:
+                os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            os.replace(temp_path, target)
+            return target
+        raise FileExistsError(f"No free name for {filename}")
+    os.remove(temp_path)
+    return target
+
+def existing_copy(content_hash, user_id=None):
+    """Returns the path of an indexed file with this content, or None.
+
+    With a user_id only that user's library is searched, otherwise every library is.
+    """
+    for row in find_media_by_hash(content_hash, user_id):
+        path = os.path.join(row['video_dir'] if row['kind'] == 'video' else row['photo_dir'], row['filename'])
+        try:
+            if os.path.getsize(path) == row['size']:
+                return path
+        except OSError:
+            continue
+    return None
+
+def store_file(temp_path, content_hash, user_id, directory, filename, dedupe_mode):
+    """Puts a hashed temp file into a user's library, following the DEDUPE_MODE setting.
+
+    'off' always keeps the file. 'skip' drops it if the user already has the same content. 'hardlink'
+    does the same and, if another user has the content, links to their copy so the bytes are stored
+    once. Returns (status, path): status is 'saved', 'linked' or 'duplicate', and path is the file
+    that now holds the content in the user's library.
+    """
+    if dedupe_mode in ('skip', 'hardlink'):
+        duplicate = existing_copy(content_hash, user_id)
+        if duplicate:
+            os.remove(temp_path)
+            return 'duplicate', duplicate
+    if dedupe_mode == 'hardlink':
+        source = existing_copy(content_hash)
+        if source:
+            try:
+                target = link_into_place(source, directory, filename)
+            except FileExistsError:
+                raise
+            except OSError:
+                pass  # Different filesystem, or no hardlink support: keep our own copy
+            else:
+                os.remove(temp_path)
+                return 'linked', target
+    return 'saved', place_file(temp_path, directory, filename)
+
+def save_file(stream, kind, user_id, directory, filename, dedupe_mode):
+    """Checks an uploaded file, hashes it while writing it to disk and stores it with store_file.
+
+    Photos must open as an image; anything else raises ValueError and nothing is stored.
+    Returns (status, path, content_hash).
+    """
+    if kind == 'photo':
+        try:
+            with IMAGE_DURATION.time(operation='verify'), Image.open(stream) as img:
+                img.verify()
+        except Exception:
+            raise ValueError("Not a valid image")
+        stream.seek(0)
+    temp_path, content_hash = write_temp_file(stream, directory)
+    try:
+        status, path = store_file(temp_path, content_hash, user_id, directory, filename, dedupe_mode)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return status, path, content_hash
+
+def save_batch(items, max_workers):
+    """Saves several uploaded files concurrently.
+
+    items is a list of save_file argument tuples. Returns, in the same order, either the
+    (status, path, content_hash) result or the error message for each item.
+    """
+    def save(item):
+        try:
+            return save_file(*item)
+        except (OSError, ValueError) as e:
+            return str(e)
+
+    if len(items) <= 1:
+        return [save(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(save, items))
@@ -0,0 +1,297 @@
+# watcher.py
+import os
+import stat
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+from database import get_all_users
+from library import media_dirs, reconcile_directory, reconcile_user_media, sync_media_files, rename_media_file
+
+# inotify event flags (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# What we watch a media directory for. IN_CREATE catches hardlinks, which get no IN_CLOSE_WRITE; other
+# files are only picked up once they are closed, so the ingest worker never reads half a file.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+# How often the list of user directories is re-read from the database
+REFRESH_INTERVAL = 60
+# After the first event, wait this long for more, so a burst of files is handled as one batch
+EVENT_BATCH_DELAY = 0.5
+
+
+class Inotify:
+    """A minimal ctypes binding for Linux inotify."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.libc = libc
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """Starts watching a path and returns its watch descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def remove_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Waits up to timeout seconds for events and returns them as (wd, mask, cookie, name) tuples."""
+        events = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return events
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MediaWatcher:
+    """Keeps the media index in sync with the user directories while the app runs.
+
+    Directories are watched with inotify where possible. Everything else is polled: a directory's
+    mtime changes whenever a file is added, removed or renamed in it, so a poll only rescans the
+    directories whose mtime moved since the last checkpoint. (Files rewritten in place do not move
+    it; sync tools write a temp file and rename it, which does.)
+    """
+
+    def __init__(self, app, mode):
+        self.app = app
+        self.mode = mode
+        self.poll_interval = app.config['MEDIA_WATCHER_POLL_INTERVAL']
+        self.inotify = None
+        self.owners = {}  # directory -> [(user_id, kind)] that keep media there
+        self.watches = {}  # directory -> inotify watch descriptor
+        self.watched_dirs = {}  # watch descriptor -> directory
+        self.checkpoints = {}  # directory -> mtime_ns at the last poll
+        self.refresh_requested = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Adds the watches (or poll checkpoints) right away, then handles events on a background thread."""
+        if self.mode in ('auto', 'inotify'):
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                # Not Linux, or out of inotify instances
+                self.app.logger.warning(f"inotify is not available ({e}), polling media directories instead")
+        # The startup scan runs after this, so files added while it runs are caught by the watches
+        self.refresh(initial=True)
+        self.thread = threading.Thread(target=self.run, name='media-watcher', daemon=True)
+        self.thread.start()
+
+    def request_refresh(self):
+        """Asks the watcher to re-read the user directories, e.g. after a user was added."""
+        self.refresh_requested.set()
+
+    def run(self):
+        next_refresh = time.monotonic() + REFRESH_INTERVAL
+        next_poll = time.monotonic() + self.poll_interval
+        while True:
+            try:
+                now = time.monotonic()
+                if self.refresh_requested.is_set() or now >= next_refresh:
+                    self.refresh_requested.clear()
+                    self.refresh()
+                    next_refresh = now + REFRESH_INTERVAL
+                if now >= next_poll:
+                    self.poll()
+                    next_poll = now + self.poll_interval
+                if self.inotify is not None:
+                    events = self.inotify.read_events(timeout=1)
+                    if events:
+                        time.sleep(EVENT_BATCH_DELAY)
+                        events += self.inotify.read_events(timeout=0)
+                        self.handle_events(events)
+                else:
+                    self.refresh_requested.wait(timeout=1)
+            except Exception as e:
+                # A busy database or similar should not kill the watcher for good
+                self.app.logger.error(f"Media watcher error: {e}")
+                time.sleep(5)
+
+    def refresh(self, initial=False):
+        """Picks up added, changed and removed user directories."""
+        owners = {}
+        with self.app.app_context():
+            for user in get_all_users():
+                for kind, directory in media_dirs(user):
+                    if directory and os.path.isdir(directory):
+                        owners.setdefault(directory, []).append((user['id'], kind))
+
+        for directory in list(self.watches):
+            if directory not in owners:
+                self.unwatch(directory)
+        for directory in list(self.checkpoints):
+            if directory not in owners:
+                del self.checkpoints[directory]
+
+        for directory, dir_owners in owners.items():
+            if directory not in self.watches and self.inotify is not None:
+                try:
+                    wd = self.inotify.add_watch(directory, WATCH_MASK)
+                    self.watches[directory] = wd
+                    self.watched_dirs[wd] = directory
+                except OSError as e:
+                    # Usually the per-user watch limit; this directory gets polled instead
+                    self.app.logger.warning(f"Cannot watch {directory} ({e}), polling it instead")
+            if directory not in self.watches and directory not in self.checkpoints:
+                # Polling starts from the state the scan below (or the startup scan) sees
+                self.checkpoints[directory] = self.dir_mtime(directory)
+            new_owners = [owner for owner in dir_owners if owner not in self.owners.get(directory, [])]
+            # The first time round the startup scan indexes every directory
+            if new_owners and not initial:
+                with self.app.app_context():
+                    for user_id, kind in new_owners:
+                        reconcile_directory(user_id, kind, directory)
+        self.owners = owners
+
+    def unwatch(self, directory):
+        wd = self.watches.pop(directory)
+        self.watched_dirs.pop(wd, None)
+        self.inotify.remove_watch(wd)
+
+    @staticmethod
+    def dir_mtime(directory):
+        try:
+            return os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self):
+        """Rescans the polled directories whose mtime changed since the last poll."""
+        for directory, checkpoint in list(self.checkpoints.items()):
+            mtime = self.dir_mtime(directory)
+            if mtime is None or mtime == checkpoint:
+                continue
+            self.checkpoints[directory] = mtime
+            with self.app.app_context():
+                for user_id, kind in self.owners.get(directory, []):
+                    reconcile_directory(user_id, kind, directory)
+
+    @staticmethod
+    def created_whole(path):
+        """Whether a file that just appeared is complete already: a hardlink or symlink to an existing file."""
+        try:
+            info = os.lstat(path)
+        except OSError:
+            return False
+        return info.st_nlink > 1 or stat.S_ISLNK(info.st_mode)
+
+    def handle_events(self, events):
+        """Applies a batch of inotify events to the media index."""
+        changed = {}  # directory -> names that were added, changed or removed
+        moved_from = {}  # rename cookie -> (directory, old name)
+        renames = []
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; rescan everything we watch
+                for directory in self.watches:
+                    changed[directory] = None
+                continue
+            directory = self.watched_dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # The directory itself went away; the next refresh sorts out what to watch
+                if mask & IN_IGNORED:
+                    self.watches.pop(directory, None)
+                    self.watched_dirs.pop(wd, None)
+                self.request_refresh()
+                continue
+            if mask & IN_ISDIR or not name:
+                continue
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (directory, name)
+                continue
+            if mask & IN_CREATE and not self.created_whole(os.path.join(directory, name)):
+                # Still being written; its IN_CLOSE_WRITE follows once it is done
+                continue
+            if mask & IN_MOVED_TO and cookie in moved_from:
+                old_directory, old_name = moved_from.pop(cookie)
+                if old_directory == directory:
+                    renames.append((directory, old_name, name))
+                    continue
+                changed.setdefault(old_directory, set())
+                if changed[old_directory] is not None:
+                    changed[old_directory].add(old_name)
+            names = changed.setdefault(directory, set())
+            if names is not None:
+                names.add(name)
+        # Moved out of the watched directories, or the other half of the rename is not here yet
+        for directory, name in moved_from.values():
+            names = changed.setdefault(directory, set())
+            if names is not None:
+                names.add(name)
+
+        with self.app.app_context():
+            for directory, old_name, new_name in renames:
+                for user_id, kind in self.owners.get(directory, []):
+                    rename_media_file(user_id, kind, directory, old_name, new_name)
+            for directory, names in changed.items():
+                for user_id, kind in self.owners.get(directory, []):
+                    if names is None:
+                        reconcile_directory(user_id, kind, directory)
+                    else:
+                        sync_media_files(user_id, kind, directory, names)
+
+
+_watcher = None
+
+def start_media_watcher(app):
+    """Starts watching the user directories, according to the MEDIA_WATCHER setting."""
+    global _watcher
+    mode = app.config['MEDIA_WATCHER']
+    if mode != 'off':
+        _watcher = MediaWatcher(app, 'poll' if mode == 'poll' else mode)
+        _watcher.start()
+
+def watch_user_media(user_id):
+    """Makes sure a new user's directories get indexed and watched.
+
+    With the watcher running this only wakes it up, so the initial scan happens in the background
+    instead of on the request that created the user.
+    """
+    if _watcher is not None:
+        _watcher.request_refresh()
+    else:
+        reconcile_user_media(user_id)
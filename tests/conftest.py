@@ -0,0 +1,68 @@
+"""Shared fixtures: one app for the whole run, working in a temporary directory."""
+import os
+import sys
+import time
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'selfly'))
+
+
+@pytest.fixture(scope='session')
+def workspace(tmp_path_factory):
+    """The directory the app runs in, with the admin's photo and video directories."""
+    path = tmp_path_factory.mktemp('selfly')
+    (path / 'photos').mkdir()
+    (path / 'videos').mkdir()
+    return path
+
+@pytest.fixture(scope='session')
+def app(workspace):
+    # app.py sets everything up on import, with the database and caches in the working directory
+    os.chdir(workspace)
+    os.environ['SELFLY_INGEST_WORKERS'] = '1'
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+@pytest.fixture(scope='session')
+def client(app, workspace):
+    """A test client logged in as the first admin, who owns workspace/photos and workspace/videos."""
+    client = app.test_client()
+    client.post('/first-admin-signup', data={'username': 'admin', 'password': 'admin',
+                                             'photo_dir': str(workspace / 'photos'),
+                                             'video_dir': str(workspace / 'videos')})
+    return client
+
+@pytest.fixture(scope='session')
+def wait_for_ingest(app):
+    """Waits until the ingest worker has no pending or running jobs left."""
+    from database import get_ingest_job_counts
+
+    def wait_for_ingest():
+        with app.app_context():
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                counts = get_ingest_job_counts()
+                if not counts.get('pending') and not counts.get('running'):
+                    return
+                time.sleep(0.1)
+        raise TimeoutError("The ingest worker did not finish")
+    return wait_for_ingest
+
+@pytest.fixture(scope='session')
+def add_photos(app, client, workspace, wait_for_ingest):
+    """Writes photos into the admin's library, indexes them and waits for the ingest worker to finish."""
+    from database import get_user_by_username
+    from library import reconcile_user_media
+
+    def add_photos(photos):
+        """photos is a list of filenames, which get plain coloured images, or a dict of filename -> image."""
+        if not isinstance(photos, dict):
+            photos = {name: Image.new('RGB', (64, 48), (index * 5 % 256, 80, 160)) for index, name in enumerate(photos)}
+        for name, image in photos.items():
+            image.save(workspace / 'photos' / name)
+        with app.app_context():
+            reconcile_user_media(get_user_by_username('admin')['id'])
+        wait_for_ingest()
+    return add_photos
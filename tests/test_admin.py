@@ -0,0 +1,25 @@
+"""Admin pages and actions."""
+import threading
+import library
+
+
+def test_rescan_runs_in_the_background(client, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_reconcile_all_media():
+        started.set()
+        release.wait(timeout=10)
+    monkeypatch.setattr(library, 'reconcile_all_media', slow_reconcile_all_media)
+
+    response = client.post('/admin/rescan')
+    assert response.status_code == 202
+    assert response.get_json() == {'started': True}
+    assert started.wait(timeout=5)
+
+    # The request did not wait for the scan, and a second one does not start another
+    assert client.post('/admin/rescan').get_json() == {'started': False}
+    release.set()
+    for thread in threading.enumerate():
+        if thread.name == 'library-rescan':
+            thread.join(timeout=5)
+    assert client.post('/admin/rescan').get_json() == {'started': True}
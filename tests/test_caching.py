@@ -0,0 +1,87 @@
+"""Cache validators and Cache-Control on originals and thumbnails."""
+import time
+import pytest
+from PIL import Image
+from database import get_user_by_username, get_media_item
+from serving import media_version, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+
+JPEG = {'Accept': 'image/jpeg'}
+
+
+def current_version(app, filename):
+    with app.app_context():
+        item = get_media_item(get_user_by_username('admin')['id'], filename)
+        return media_version(item['size'], item['mtime'], item['content_hash'])
+
+def revalidate(client, url, response, **headers):
+    return client.get(url, headers=dict(headers, **{'If-None-Match': response.headers['ETag']}))
+
+
+@pytest.fixture(scope='module')
+def version(app, add_photos):
+    add_photos({'cached.jpg': Image.new('RGB', (600, 400), (30, 60, 90))})
+    return current_version(app, 'cached.jpg')
+
+
+def test_original_etag_is_the_version(client, version):
+    response = client.get('/media/cached.jpg')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == f'"{version}"'
+    assert response.headers['Cache-Control'] == REVALIDATE_CACHE_CONTROL
+    assert 'Last-Modified' in response.headers
+
+def test_original_not_modified(client, version):
+    response = client.get('/media/cached.jpg')
+    not_modified = revalidate(client, '/media/cached.jpg', response)
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert not_modified.headers['ETag'] == response.headers['ETag']
+    assert not_modified.headers['Cache-Control'] == REVALIDATE_CACHE_CONTROL
+
+    assert client.get('/media/cached.jpg', headers={'If-None-Match': '"stale"'}).status_code == 200
+
+def test_versioned_original_is_immutable(client, version):
+    url = f"/media/cached.jpg?v={version}"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+
+    not_modified = revalidate(client, url, response)
+    assert not_modified.status_code == 304
+    assert not_modified.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+
+    # A URL with an old version must not be cached for good
+    assert client.get('/media/cached.jpg?v=old').headers['Cache-Control'] == REVALIDATE_CACHE_CONTROL
+
+def test_thumbnail_not_modified(client, version):
+    url = f"/thumb/256/cached.jpg?v={version}"
+    response = client.get(url, headers=JPEG)
+    assert response.status_code == 200
+    assert response.headers['ETag']
+    assert response.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+    assert 'Accept' in response.headers['Vary']
+
+    not_modified = revalidate(client, url, response, **JPEG)
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert not_modified.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+
+    unversioned = client.get('/thumb/256/cached.jpg', headers=JPEG)
+    assert unversioned.headers['Cache-Control'] == REVALIDATE_CACHE_CONTROL
+    assert revalidate(client, '/thumb/256/cached.jpg', unversioned, **JPEG).status_code == 304
+
+def test_changed_file_gets_a_new_version(app, client, add_photos, version):
+    original = client.get('/media/cached.jpg')
+    thumbnail = client.get('/thumb/256/cached.jpg', headers=JPEG)
+
+    time.sleep(0.05)
+    add_photos({'cached.jpg': Image.new('RGB', (300, 200), (250, 10, 10))})
+    new_version = current_version(app, 'cached.jpg')
+    assert new_version != version
+
+    response = revalidate(client, '/media/cached.jpg', original)
+    assert response.status_code == 200
+    assert response.headers['ETag'] == f'"{new_version}"'
+    assert revalidate(client, '/thumb/256/cached.jpg', thumbnail, **JPEG).status_code == 200
+    # The old version's URL is no longer marked immutable
+    assert client.get(f"/media/cached.jpg?v={version}").headers['Cache-Control'] == REVALIDATE_CACHE_CONTROL
@@ -0,0 +1,104 @@
+"""Uploads whose content is already in a library, found by BLAKE2b hash."""
+import hashlib
+import io
+import os
+import pytest
+from PIL import Image
+from database import add_new_user
+
+
+def photo(seed):
+    """PNG bytes that differ for every seed."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 24), (seed % 256, seed // 256 % 256, 7)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def upload(client, name, data):
+    response = client.post('/api/upload-batch', data={'files': (io.BytesIO(data), name)},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()['results'][0]
+
+def blake2b(data):
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+@pytest.fixture
+def dedupe_mode(app, monkeypatch):
+    def set_mode(mode):
+        monkeypatch.setitem(app.config, 'DEDUPE_MODE', mode)
+    return set_mode
+
+@pytest.fixture
+def other_user(app, tmp_path):
+    """A second user with their own library, logged in on their own client."""
+    for name in ('photos', 'videos'):
+        (tmp_path / name).mkdir()
+    with app.app_context():
+        add_new_user(tmp_path.name, 'other', str(tmp_path / 'photos'), str(tmp_path / 'videos'))
+    client = app.test_client()
+    client.post('/login', data={'username': tmp_path.name, 'password': 'other'})
+    return client, tmp_path / 'photos'
+
+
+def test_same_content_under_another_name_is_skipped(client, workspace, dedupe_mode):
+    dedupe_mode('skip')
+    data = photo(1)
+    assert upload(client, 'original.png', data)['duplicate'] is False
+
+    result = upload(client, 'again.png', data)
+    assert result['status'] == 'ok'
+    assert result['duplicate'] is True
+    assert result['saved_as'] == 'original.png'
+    assert not (workspace / 'photos' / 'again.png').exists()
+
+def test_check_finds_content_by_hash(client, dedupe_mode):
+    dedupe_mode('skip')
+    data = photo(2)
+    assert client.get(f"/api/uploads/check/{blake2b(data)}").status_code == 404
+
+    upload(client, 'checked.png', data)
+    response = client.get(f"/api/uploads/check/{blake2b(data).upper()}")
+    assert response.status_code == 200
+    assert response.get_json() == {'exists': True, 'filename': 'checked.png', 'content_hash': blake2b(data)}
+
+    # A resumable upload of the same content is answered without sending any bytes
+    response = client.post('/api/uploads', json={'filename': 'resumed.png', 'size': len(data),
+                                                 'content_hash': blake2b(data)})
+    assert response.get_json()['exists'] is True
+
+def test_off_keeps_every_copy(client, workspace, dedupe_mode):
+    dedupe_mode('off')
+    data = photo(3)
+    upload(client, 'kept.png', data)
+    result = upload(client, 'kept-again.png', data)
+    assert result['duplicate'] is False
+    assert (workspace / 'photos' / 'kept-again.png').read_bytes() == data
+
+def test_other_users_content_is_not_skipped(client, other_user, dedupe_mode):
+    dedupe_mode('skip')
+    other_client, other_photos = other_user
+    data = photo(4)
+    upload(client, 'mine.png', data)
+
+    assert other_client.get(f"/api/uploads/check/{blake2b(data)}").status_code == 404
+    assert upload(other_client, 'theirs.png', data)['duplicate'] is False
+    assert (other_photos / 'theirs.png').read_bytes() == data
+
+def test_hardlink_shares_another_users_copy(client, workspace, other_user, dedupe_mode):
+    dedupe_mode('hardlink')
+    other_client, other_photos = other_user
+    data = photo(5)
+    upload(client, 'shared.png', data)
+
+    result = upload(other_client, 'linked.png', data)
+    assert result == {'filename': 'linked.png', 'saved_as': 'linked.png', 'status': 'ok', 'error': None,
+                      'duplicate': False}
+    original, linked = workspace / 'photos' / 'shared.png', other_photos / 'linked.png'
+    assert os.path.samefile(original, linked)
+    assert os.stat(original).st_nlink == 2
+
+    # Once linked, the content is the other user's own and a further upload is skipped
+    result = upload(other_client, 'linked-again.png', data)
+    assert (result['duplicate'], result['saved_as']) == (True, 'linked.png')
+    assert os.stat(original).st_nlink == 2
@@ -0,0 +1,71 @@
+"""The admin near-duplicate listing."""
+import random
+import pytest
+from PIL import Image, ImageDraw
+import routes
+from similarity import HashIndex, MAX_DISTANCE
+
+
+def pattern(seed):
+    """An image with enough structure that unrelated seeds get clearly different perceptual hashes."""
+    image = Image.new('RGB', (90, 80), 'white')
+    draw = ImageDraw.Draw(image)
+    for i in range(9):
+        shade = (seed * 37 + i * 71) % 256
+        draw.rectangle((i * 10, 0, i * 10 + 9, 80), fill=(shade, shade, shade))
+    return image
+
+def group_for(groups, filename):
+    return next(group for group in groups if any(row['filename'] == filename for row in group))
+
+
+def test_exact_duplicates_are_flagged_against_each_other(client, add_photos):
+    original = pattern(1)
+    brighter = original.point(lambda value: min(value + 3, 255))
+    add_photos({'dup-a.png': original, 'dup-b.png': brighter, 'dup-c.png': original})
+
+    groups = client.get('/api/admin/duplicates?limit=1000').get_json()['groups']
+    group = group_for(groups, 'dup-b.png')
+    flags = {row['filename']: row['exact_duplicate'] for row in group}
+    assert flags == {'dup-a.png': True, 'dup-b.png': False, 'dup-c.png': True}
+
+def test_reference_photo_is_not_its_own_exact_duplicate(client, add_photos):
+    original = pattern(2)
+    add_photos({'near-a.png': original, 'near-b.png': original.point(lambda value: min(value + 3, 255))})
+
+    groups = client.get('/api/admin/duplicates?limit=1000').get_json()['groups']
+    group = group_for(groups, 'near-a.png')
+    assert [row['exact_duplicate'] for row in group] == [False, False]
+
+def test_groups_are_cached_until_hashes_change(client, add_photos, monkeypatch):
+    calls = []
+    find_near_duplicates = routes.find_near_duplicates
+    monkeypatch.setattr(routes, 'find_near_duplicates', lambda *args: calls.append(1) or find_near_duplicates(*args))
+
+    client.get('/api/admin/duplicates?distance=4')
+    client.get('/api/admin/duplicates?distance=4')
+    client.get('/admin/duplicates?distance=4')
+    assert len(calls) == 1
+
+    add_photos({'cache-a.png': pattern(3)})
+    groups = client.get('/api/admin/duplicates?distance=4&limit=1000').get_json()['groups']
+    assert len(calls) == 2
+    assert not any(row['filename'] == 'cache-a.png' for group in groups for row in group)
+    add_photos({'cache-b.png': pattern(3)})
+    groups = client.get('/api/admin/duplicates?distance=4&limit=1000').get_json()['groups']
+    assert len(calls) == 3
+    assert {row['filename'] for row in group_for(groups, 'cache-a.png')} == {'cache-a.png', 'cache-b.png'}
+
+@pytest.mark.parametrize('distance', range(MAX_DISTANCE + 1))
+def test_numpy_and_pure_python_grouping_agree(distance):
+    pytest.importorskip('numpy')
+    rng = random.Random(distance)
+    # Clusters of hashes a few bits apart, some of them identical, plus unrelated ones
+    bases = [rng.getrandbits(64) for _ in range(200)]
+    index = HashIndex(distance)
+    for _ in range(3000):
+        value = rng.choice(bases)
+        for bit in rng.sample(range(64), rng.randrange(0, 12)):
+            value ^= 1 << bit
+        index.add(value - (1 << 64) if value >> 63 else value)
+    assert index.array_groups() == index.table_groups()
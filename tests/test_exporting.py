@@ -0,0 +1,129 @@
+"""ZIP exports."""
+import io
+import os
+import zipfile
+import pytest
+import exporting
+from database import get_db_connection
+
+NAMES = [f'export-{i:02d}.jpg' for i in range(12)]
+
+
+@pytest.fixture(scope='module')
+def export_url(add_photos):
+    add_photos(NAMES)
+    return '/export?' + '&'.join(f'filename={name}' for name in NAMES)
+
+@pytest.fixture
+def without_crcs(app):
+    """Forgets the stored CRCs of the test photos, so the export has to use data descriptors."""
+    def forget():
+        with app.app_context():
+            conn = get_db_connection()
+            conn.executemany('UPDATE media SET crc32 = NULL WHERE filename = ?', [(name,) for name in NAMES])
+            conn.commit()
+    return forget
+
+def read_archive(data, workspace):
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    assert archive.namelist() == [f'photos/{name}' for name in NAMES]
+    for name in NAMES:
+        assert archive.read(f'photos/{name}') == (workspace / 'photos' / name).read_bytes()
+    return archive
+
+
+def test_deterministic_export(client, workspace, export_url):
+    response = client.get(export_url)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['ETag']
+    assert 'Last-Modified' not in response.headers
+    assert response.content_length == len(response.data)
+    read_archive(response.data, workspace)
+
+def test_ranged_resume(client, export_url):
+    full = client.get(export_url)
+    length = len(full.data)
+    pieces = []
+    for first, last in [(0, 999), (1000, length // 2), (length // 2 + 1, length - 1)]:
+        response = client.get(export_url, headers={'Range': f'bytes={first}-{last}', 'If-Range': full.headers['ETag']})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes {first}-{last}/{length}'
+        pieces.append(response.data)
+    assert b''.join(pieces) == full.data
+
+def test_unsatisfiable_range(client, export_url):
+    length = len(client.get(export_url).data)
+    response = client.get(export_url, headers={'Range': f'bytes={length}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{length}'
+
+@pytest.mark.parametrize('if_range', ['"stale"', 'Sat, 01 Jan 2000 00:00:00 GMT', 'Fri, 01 Jan 2100 00:00:00 GMT'])
+def test_range_needs_the_strong_etag(client, export_url, if_range):
+    response = client.get(export_url, headers={'Range': 'bytes=0-99', 'If-Range': if_range})
+    assert response.status_code == 200
+    assert response.content_length == len(response.data) > 100
+
+def test_weak_etag_does_not_resume(client, export_url):
+    etag = client.get(export_url).headers['ETag']
+    response = client.get(export_url, headers={'Range': 'bytes=0-99', 'If-Range': 'W/' + etag})
+    assert response.status_code == 200
+
+def test_revalidation_uses_the_etag_only(client, export_url):
+    etag = client.get(export_url).headers['ETag']
+    assert client.get(export_url, headers={'If-None-Match': etag}).status_code == 304
+    response = client.get(export_url, headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert response.status_code == 200
+
+def test_removed_file_changes_the_etag(client, export_url):
+    etag = client.get(export_url).headers['ETag']
+    response = client.get(export_url.rsplit('&', 1)[0], headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_descriptor_export(client, workspace, export_url, without_crcs):
+    deterministic = client.get(export_url).data
+    without_crcs()
+    response = client.get(export_url, headers={'Range': 'bytes=100-'})
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'none'
+    assert 'ETag' not in response.headers
+    assert response.content_length == len(response.data)
+    read_archive(response.data, workspace)
+
+    # The CRCs worked out while sending were stored, so the next export is resumable again
+    again = client.get(export_url)
+    assert again.headers['Accept-Ranges'] == 'bytes'
+    assert again.data == deterministic
+
+@pytest.mark.parametrize('mode', ['deterministic', 'descriptors'])
+def test_zip64_records(client, workspace, export_url, without_crcs, monkeypatch, mode):
+    if mode == 'descriptors':
+        without_crcs()
+    # Small limits stand in for the 4 GiB and 65535 entry ones, so every kind of ZIP64 record is written
+    monkeypatch.setattr(exporting, 'ZIP64_LIMIT', 500)
+    monkeypatch.setattr(exporting, 'ZIP64_COUNT_LIMIT', 10)
+    response = client.get(export_url)
+    assert b'PK\x06\x06' in response.data and b'PK\x06\x07' in response.data
+    assert response.content_length == len(response.data)
+    archive = read_archive(response.data, workspace)
+    assert all(info.file_size > 500 for info in archive.infolist())
+
+    if mode == 'deterministic':
+        length = len(response.data)
+        pieces = [client.get(export_url, headers={'Range': f'bytes={first}-{min(first + 999, length - 1)}'}).data
+                  for first in range(0, length, 1000)]
+        assert b''.join(pieces) == response.data
+
+def test_changed_file_stops_the_export(client, workspace, export_url):
+    response = client.get(export_url, buffered=False)
+    path = workspace / 'photos' / NAMES[-1]
+    stat = path.stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    try:
+        data = b''.join(response.response)
+    finally:
+        response.close()
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+    assert len(data) < response.content_length
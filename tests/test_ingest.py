@@ -0,0 +1,85 @@
+"""The ingest queue and worker."""
+import time
+from concurrent.futures import Future
+import pytest
+from PIL import Image
+import jobs
+from database import (get_db_connection, get_user_by_username, get_media_item, upsert_media, claim_jobs,
+                      enqueue_ingest_jobs)
+from library import index_file
+from ingest import IngestWorker, process_media_file, notify_ingest_worker
+
+
+@pytest.fixture
+def paused_worker(app, client, monkeypatch):
+    """Keeps the app's job workers from claiming jobs, so the test can play the ingest worker's part."""
+    monkeypatch.setattr(jobs, 'claim_jobs', lambda queue, limit: [])
+    yield IngestWorker(app)
+    monkeypatch.undo()
+    notify_ingest_worker()
+
+def claim(filename):
+    claimed = claim_jobs('ingest_jobs', 100)
+    assert [job['filename'] for job in claimed] == [filename]
+    return claimed[0]
+
+def job_row(job):
+    return get_db_connection().execute('SELECT * FROM ingest_jobs WHERE id = ?', (job['id'],)).fetchone()
+
+def finished(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def test_job_queued_again_while_running_is_not_finished_by_the_old_run(app, workspace, paused_worker,
+                                                                        wait_for_ingest, monkeypatch):
+    path = workspace / 'photos' / 'rewritten.jpg'
+    Image.new('RGB', (40, 30), (1, 2, 3)).save(path)
+    with app.app_context():
+        user_id = get_user_by_username('admin')['id']
+        index_file(user_id, 'photo', str(path))
+        job = claim('rewritten.jpg')
+        old_result = process_media_file(str(path), 'photo', app.config['THUMBNAIL_CACHE_DIR'])
+
+        # The file is written again while the first run is still going, and the watcher queues it again
+        time.sleep(0.05)
+        Image.new('RGB', (300, 200), (200, 100, 0)).save(path)
+        index_file(user_id, 'photo', str(path))
+        paused_worker.record_result(job, finished(old_result))
+
+        assert job_row(job)['status'] == 'pending'
+        assert get_media_item(user_id, 'rewritten.jpg')['content_hash'] is None
+
+    # Once the worker picks the job up again, the new version gets its derived data
+    monkeypatch.undo()
+    notify_ingest_worker()
+    wait_for_ingest()
+    with app.app_context():
+        item = get_media_item(user_id, 'rewritten.jpg')
+        assert item['content_hash'] is not None
+        assert (item['width'], item['height']) == (300, 200)
+
+def test_result_for_a_changed_file_is_retried(app, workspace, paused_worker, wait_for_ingest):
+    path = workspace / 'photos' / 'changed.jpg'
+    Image.new('RGB', (40, 30), (4, 5, 6)).save(path)
+    with app.app_context():
+        user_id = get_user_by_username('admin')['id']
+        index_file(user_id, 'photo', str(path))
+        job = claim('changed.jpg')
+        old_result = process_media_file(str(path), 'photo', app.config['THUMBNAIL_CACHE_DIR'])
+
+        # The index catches up with the new version, but nothing queues the file again
+        time.sleep(0.05)
+        Image.new('RGB', (120, 90), (9, 9, 9)).save(path)
+        stat = path.stat()
+        upsert_media(user_id, 'photo', 'changed.jpg', stat.st_size, stat.st_mtime)
+        paused_worker.record_result(job, finished(old_result))
+
+        row = job_row(job)
+        assert row['status'] == 'pending'
+        assert row['available_at'] > time.time()
+        assert get_media_item(user_id, 'changed.jpg')['content_hash'] is None
+
+        # Don't wait out the backoff
+        enqueue_ingest_jobs([(user_id, 'photo', 'changed.jpg', str(path))])
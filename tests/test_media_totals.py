@@ -0,0 +1,90 @@
+"""The per-user stats and timeline totals that triggers on media keep up to date."""
+from datetime import datetime, timezone
+import pytest
+from database import (get_db_connection, add_new_user, get_user_by_username, get_all_users_with_stats, upsert_media,
+                      delete_media, rename_media, apply_media_changes, delete_user, update_media_details, get_timeline)
+
+
+def at(*date):
+    return datetime(*date, 12, tzinfo=timezone.utc).timestamp()
+
+def stats(user_id):
+    rows = get_db_connection().execute('SELECT kind, file_count, total_bytes FROM user_media_stats WHERE user_id = ?',
+                                       (user_id,)).fetchall()
+    return {row['kind']: (row['file_count'], row['total_bytes']) for row in rows if row['file_count']}
+
+def timeline(user_id, granularity='month'):
+    return {row['period']: row['count'] for row in get_timeline(user_id, granularity)}
+
+def details(captured_at):
+    return {'content_hash': None, 'crc32': None, 'width': 1, 'height': 1, 'captured_at': captured_at,
+            'phash': None, 'camera': None}
+
+
+@pytest.fixture
+def user_id(app, tmp_path):
+    with app.app_context():
+        add_new_user(tmp_path.name, 'totals', str(tmp_path / 'photos'), str(tmp_path / 'videos'))
+        yield get_user_by_username(tmp_path.name)['id']
+
+
+def test_insert_and_delete(user_id):
+    upsert_media(user_id, 'photo', 'a.jpg', 100, at(2024, 1, 15))
+    upsert_media(user_id, 'photo', 'b.jpg', 50, at(2024, 1, 20))
+    upsert_media(user_id, 'video', 'c.mp4', 1000, at(2024, 2, 1))
+    assert stats(user_id) == {'photo': (2, 150), 'video': (1, 1000)}
+    assert timeline(user_id) == {'2024-02': 1, '2024-01': 2}
+    assert timeline(user_id, 'day') == {'2024-02-01': 1, '2024-01-20': 1, '2024-01-15': 1}
+
+    user = next(user for user in get_all_users_with_stats() if user['id'] == user_id)
+    assert (user['photo_count'], user['video_count'], user['total_bytes']) == (2, 1, 1150)
+
+    delete_media(user_id, 'b.jpg')
+    delete_media(user_id, 'c.mp4')
+    assert stats(user_id) == {'photo': (1, 100)}
+    assert timeline(user_id, 'day') == {'2024-01-15': 1}
+
+def test_changed_file_updates_size_and_day(user_id):
+    upsert_media(user_id, 'photo', 'a.jpg', 100, at(2024, 1, 15))
+    upsert_media(user_id, 'photo', 'a.jpg', 250, at(2024, 1, 15))
+    assert stats(user_id) == {'photo': (1, 250)}
+    assert timeline(user_id) == {'2024-01': 1}
+
+    # Rewritten in March: the file moves to the new month, and the old one is dropped
+    upsert_media(user_id, 'photo', 'a.jpg', 250, at(2024, 3, 2))
+    assert stats(user_id) == {'photo': (1, 250)}
+    assert timeline(user_id) == {'2024-03': 1}
+    assert timeline(user_id, 'day') == {'2024-03-02': 1}
+
+def test_capture_date_moves_file_across_months(user_id):
+    upsert_media(user_id, 'photo', 'a.jpg', 100, at(2024, 5, 31))
+    upsert_media(user_id, 'photo', 'b.jpg', 100, at(2024, 5, 31))
+    update_media_details(user_id, 'photo', 'a.jpg', 100, at(2024, 5, 31), details(at(2019, 12, 24)))
+    assert timeline(user_id) == {'2024-05': 1, '2019-12': 1}
+    assert timeline(user_id, 'year') == {'2024': 1, '2019': 1}
+    assert stats(user_id) == {'photo': (2, 200)}
+
+def test_rename_keeps_totals(user_id):
+    upsert_media(user_id, 'photo', 'a.jpg', 100, at(2024, 1, 15))
+    upsert_media(user_id, 'photo', 'b.jpg', 30, at(2024, 2, 15))
+    assert rename_media(user_id, 'photo', 'a.jpg', 'renamed.jpg', '/x/a.jpg', '/x/renamed.jpg')
+    assert stats(user_id) == {'photo': (2, 130)}
+    assert timeline(user_id) == {'2024-02': 1, '2024-01': 1}
+
+    # Renaming over another file replaces it
+    assert rename_media(user_id, 'photo', 'renamed.jpg', 'b.jpg', '/x/renamed.jpg', '/x/b.jpg')
+    assert stats(user_id) == {'photo': (1, 100)}
+    assert timeline(user_id) == {'2024-01': 1}
+
+def test_batch_changes(user_id):
+    apply_media_changes(user_id, 'photo', [('a.jpg', 10, at(2024, 1, 1), None), ('b.jpg', 20, at(2024, 1, 2), None)], [])
+    apply_media_changes(user_id, 'photo', [('a.jpg', 15, at(2024, 4, 1), None), ('c.jpg', 5, at(2024, 4, 2), None)],
+                        ['b.jpg'])
+    assert stats(user_id) == {'photo': (2, 20)}
+    assert timeline(user_id) == {'2024-04': 2}
+
+def test_deleting_the_user_clears_totals(user_id):
+    upsert_media(user_id, 'photo', 'a.jpg', 100, at(2024, 1, 15))
+    delete_user(user_id)
+    assert stats(user_id) == {}
+    assert timeline(user_id) == {}
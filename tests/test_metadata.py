@@ -0,0 +1,56 @@
+"""Photo metadata and the metadata API."""
+import math
+from PIL import Image, TiffImagePlugin
+import routes
+from metadata import extract_image_metadata
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+
+def photo_with_zero_denominators(path):
+    """Writes a JPEG whose exposure, aperture and GPS latitude are rationals with a zero denominator."""
+    image = Image.new('RGB', (40, 30))
+    exif = image.getexif()
+    exif_ifd = exif.get_ifd(EXIF_IFD)
+    exif_ifd[0x829A] = TiffImagePlugin.IFDRational(1, 0)   # Exposure time
+    exif_ifd[0x829D] = TiffImagePlugin.IFDRational(0, 0)   # F-number
+    exif_ifd[0x920A] = TiffImagePlugin.IFDRational(50, 1)  # Focal length
+    gps_ifd = exif.get_ifd(GPS_IFD)
+    gps_ifd[1], gps_ifd[3] = 'N', 'E'
+    gps_ifd[2] = (TiffImagePlugin.IFDRational(10, 0), TiffImagePlugin.IFDRational(1, 1), TiffImagePlugin.IFDRational(1, 1))
+    gps_ifd[4] = (1.0, 2.0, 3.0)
+    image.save(path, exif=exif)
+
+
+def test_zero_denominator_rationals_are_missing(tmp_path):
+    photo_with_zero_denominators(tmp_path / 'zero.jpg')
+    metadata = extract_image_metadata(tmp_path / 'zero.jpg')
+    assert metadata['exposure_time'] is None
+    assert metadata['f_number'] is None
+    assert metadata['focal_length'] == 50.0
+    assert metadata['gps_latitude'] is None
+
+def test_stored_nan_values_are_not_shown():
+    formatted = routes.format_metadata('old.jpg', 1000, {'format': 'JPEG', 'exposure_time': math.nan,
+                                                         'f_number': math.inf, 'iso': 100.0})
+    assert 'Exposure' not in formatted and 'Aperture' not in formatted
+    assert formatted['ISO'] == '100'
+
+def test_metadata_api_with_zero_denominators(client, workspace, add_photos):
+    photo_with_zero_denominators(workspace / 'photos' / 'camera.jpg')
+    add_photos({})
+    response = client.get('/api/metadata/camera.jpg')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['Focal Length'] == '50 mm'
+    assert 'Exposure' not in data and 'Aperture' not in data
+
+def test_metadata_of_a_file_not_indexed_yet(client, workspace, monkeypatch):
+    Image.new('RGB', (120, 80)).save(workspace / 'photos' / 'unindexed.jpg')
+    monkeypatch.setattr(routes, 'get_media_item', lambda user_id, filename: None)
+    response = client.get('/api/metadata/unindexed.jpg')
+    assert response.status_code == 200
+    assert response.get_json()['Dimensions'] == '120x80'
+    assert client.get('/view/unindexed.jpg').status_code == 200
+    assert client.get('/api/metadata/missing.jpg').status_code == 404
@@ -0,0 +1,70 @@
+"""Searching a user's media."""
+import re
+import pytest
+from database import add_new_user, get_user_by_username, upsert_media, get_media_item, set_media_annotations
+
+
+def annotate(client, filename, **fields):
+    response = client.put(f"/api/annotations/{filename}", json=fields)
+    assert response.status_code == 200
+
+def search(client, q, **params):
+    response = client.get('/api/search', query_string=dict(params, q=q))
+    assert response.status_code == 200
+    return response.get_json()
+
+def filenames(result):
+    return [item['filename'] for item in result['items']]
+
+
+@pytest.fixture(scope='module')
+def annotated(client, add_photos):
+    add_photos(['beach-trip.jpg', 'quokka.jpg', 'tagged.jpg'] + [f"herd-{i}.jpg" for i in range(5)])
+    annotate(client, 'beach-trip.jpg', caption='Sunset over the mountains', place='Lisbon')
+    annotate(client, 'tagged.jpg', tags=['quokka'])
+    for i in range(5):
+        annotate(client, f"herd-{i}.jpg", tags=['walrus'])
+
+
+def test_every_word_has_to_match(client, annotated):
+    assert filenames(search(client, 'sunset lisbon')) == ['beach-trip.jpg']
+    assert filenames(search(client, 'sunset paris')) == []
+
+def test_words_match_as_prefixes(client, annotated):
+    assert filenames(search(client, 'moun')) == ['beach-trip.jpg']
+    assert filenames(search(client, 'ountains')) == []
+
+def test_operators_are_searched_literally(client, annotated):
+    assert filenames(search(client, 'sunset OR nothing')) == []
+    assert search(client, '"sun* NEAR(')['items'] == []
+    assert search(client, '   ')['items'] == []
+
+def test_tag_matches_rank_above_filename_matches(client, annotated):
+    assert filenames(search(client, 'quokka')) == ['tagged.jpg', 'quokka.jpg']
+
+def test_search_is_paged_with_a_cursor(client, annotated):
+    seen, cursor = [], None
+    while True:
+        params = {'per_page': 2, 'cursor': cursor} if cursor else {'per_page': 2}
+        page = search(client, 'walrus', **params)
+        seen += filenames(page)
+        if not page['has_more']:
+            break
+        cursor = page['next_cursor']
+    assert sorted(seen) == [f"herd-{i}.jpg" for i in range(5)]
+
+def test_owner_column_is_not_searched(app, client, annotated):
+    with app.app_context():
+        admin_id = get_user_by_username('admin')['id']
+    # Only files with a word starting with 'u' match, not every file through the owner column
+    for item in search(client, 'u', per_page=100)['items']:
+        assert re.search(r'(^|[^a-z0-9])u', item['filename'].lower())
+    assert search(client, f"u{admin_id}")['items'] == []
+
+def test_other_users_media_is_not_found(app, client, annotated):
+    with app.app_context():
+        add_new_user('searcher', 'searcher', '/nonexistent/photos', '/nonexistent/videos')
+        other_id = get_user_by_username('searcher')['id']
+        upsert_media(other_id, 'photo', 'walrus-too.jpg', 1, 1.0)
+        set_media_annotations(get_media_item(other_id, 'walrus-too.jpg')['id'], None, None, ['walrus'])
+    assert 'walrus-too.jpg' not in filenames(search(client, 'walrus', per_page=100))
@@ -0,0 +1,82 @@
+"""Range requests on /media."""
+import pytest
+from serving import resolve_ranges
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture(scope='module')
+def media_url(client, workspace):
+    (workspace / 'videos' / 'ranges.mp4').write_bytes(CONTENT)
+    return '/media/ranges.mp4'
+
+
+def test_whole_file(client, media_url):
+    response = client.get(media_url)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.data == CONTENT
+
+def test_single_range(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f"bytes 100-199/{len(CONTENT)}"
+    assert response.data == CONTENT[100:200]
+
+def test_open_ended_range(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=1000-'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[1000:]
+
+def test_suffix_range(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=-24'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f"bytes 1000-1023/{len(CONTENT)}"
+    assert response.data == CONTENT[-24:]
+
+def test_multiple_ranges(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=0-9,500-509'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary'].encode('ascii')
+    assert response.content_length == len(response.data)
+
+    parts = response.data.split(b'--' + boundary)
+    assert parts[0] == b'' and parts[-1] == b'--\r\n'
+    bodies = {}
+    for part in parts[1:-1]:
+        headers, _, body = part.partition(b'\r\n\r\n')
+        content_range = [line for line in headers.split(b'\r\n') if line.startswith(b'Content-Range:')][0]
+        bodies[content_range.split(b' ')[-1].decode('ascii')] = body[:-2]
+    assert bodies == {f"0-9/{len(CONTENT)}": CONTENT[0:10], f"500-509/{len(CONTENT)}": CONTENT[500:510]}
+
+def test_overlapping_ranges_are_merged(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=0-99,50-149'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f"bytes 0-149/{len(CONTENT)}"
+    assert response.data == CONTENT[:150]
+
+def test_unsatisfiable_range(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=5000-6000'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f"bytes */{len(CONTENT)}"
+
+@pytest.mark.parametrize('header', ['bytes=\xb2-', 'bytes=-\xb2', 'bytes=1-٣', 'bytes=abc', 'bytes=-',
+                                    'bytes=9-5', 'items=0-9', 'bytes=' + ','.join(['0-1'] * 17)])
+def test_malformed_range_is_ignored(client, media_url, header):
+    response = client.get(media_url, headers={'Range': header})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+def test_if_range_mismatch_sends_whole_file(client, media_url):
+    response = client.get(media_url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+def test_resolve_ranges():
+    assert resolve_ranges('bytes=0-9', 100) == [(0, 10)]
+    assert resolve_ranges('bytes=-500', 100) == [(0, 100)]
+    assert resolve_ranges('bytes=90-200', 100) == [(90, 100)]
+    assert resolve_ranges('bytes=0-9,10-19', 100) == [(0, 20)]
+    assert resolve_ranges('bytes=100-', 100) == []
+    assert resolve_ranges('bytes=\xb2-', 100) is None
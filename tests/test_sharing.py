@@ -0,0 +1,117 @@
+"""Background public-share uploads, against a local stand-in for the ImageBB API."""
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import sharing
+from database import add_setting
+
+API_KEY = 'test-key'
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Answers uploads with the next scripted reply: 'ok', 'slow' (past the read timeout) or an HTTP status."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        server.requests.append({'path': self.path, 'content_type': self.headers['Content-Type'], 'body': body})
+        reply = server.replies.pop(0) if server.replies else 'ok'
+        if reply == 'slow':
+            time.sleep(1.5)
+            reply = 'ok'
+        status = 200 if reply == 'ok' else int(reply)
+        if reply == 'ok':
+            payload = {'success': True, 'data': {'url': f'https://img.example/{len(server.requests)}.jpg'}}
+        else:
+            payload = {'success': False, 'error': {'message': f'scripted {status}'}}
+        data = json.dumps(payload).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass  # The client gave up waiting
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(app, client, add_photos, monkeypatch):
+    add_photos(['share.jpg'])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.requests, server.replies = [], []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setitem(app.config, 'IMAGEBB_API_URL', f'http://127.0.0.1:{server.server_port}/1/upload')
+    monkeypatch.setattr(sharing, 'RETRY_BASE_DELAY', 0.05)
+    monkeypatch.setattr(sharing._worker, 'timeout', (2, 0.5))
+    with app.app_context():
+        add_setting('imagebb_api_key', API_KEY)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def share(client):
+    response = client.post('/api/upload-public/share.jpg')
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job['status'] in ('pending', 'running')
+    deadline = time.time() + 20
+    while job['status'] not in ('done', 'failed'):
+        assert time.time() < deadline, job
+        time.sleep(0.05)
+        job = client.get(job['status_url']).get_json()
+    return job
+
+def form_fields(request):
+    """Splits a multipart/form-data body into {field name: value}."""
+    boundary = request['content_type'].split('boundary=')[1].encode('ascii')
+    fields = {}
+    for part in request['body'].split(b'--' + boundary)[1:-1]:
+        headers, _, value = part.partition(b'\r\n\r\n')
+        name = headers.split(b'name="')[1].split(b'"')[0].decode('ascii')
+        fields[name] = value[:-2]
+    return fields
+
+
+def test_body_is_streamed_base64_multipart(client, workspace, stand_in):
+    job = share(client)
+    assert job['status'] == 'done'
+    assert job['public_link'] == 'https://img.example/1.jpg'
+
+    request = stand_in.requests[0]
+    assert request['content_type'].startswith('multipart/form-data; boundary=')
+    assert API_KEY not in request['path']
+    fields = form_fields(request)
+    assert fields['key'] == API_KEY.encode('ascii')
+    assert fields['name'] == b'share'
+    assert base64.b64decode(fields['image'], validate=True) == (workspace / 'photos' / 'share.jpg').read_bytes()
+
+def test_retries_server_errors_and_timeouts(client, stand_in):
+    stand_in.replies = ['503', 'slow', '500']
+    job = share(client)
+    assert job['status'] == 'done'
+    assert job['attempts'] == 4
+    assert job['error'] is None
+    assert len(stand_in.requests) == 4
+    # Every retry sends the whole file again
+    assert all(form_fields(request) == form_fields(stand_in.requests[0]) for request in stand_in.requests)
+
+def test_gives_up_after_max_attempts(client, stand_in):
+    stand_in.replies = ['503'] * 10
+    job = share(client)
+    assert job['status'] == 'failed'
+    assert job['attempts'] == sharing._worker.max_attempts
+    assert '503' in job['error']
+
+def test_client_errors_are_not_retried(client, stand_in):
+    stand_in.replies = ['400']
+    job = share(client)
+    assert job['status'] == 'failed'
+    assert job['attempts'] == 1
+    assert 'scripted 400' in job['error']
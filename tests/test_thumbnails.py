@@ -0,0 +1,43 @@
+"""The thumbnail cache."""
+import io
+import os
+from PIL import Image
+
+JPEG = {'Accept': 'image/jpeg'}
+
+
+def cache_files(app):
+    cache_dir = os.path.abspath(app.config['THUMBNAIL_CACHE_DIR'])
+    return {os.path.join(root, name) for root, _dirs, names in os.walk(cache_dir) for name in names}
+
+
+def test_thumbnail_fits_the_size(client, add_photos):
+    add_photos({'big.jpg': Image.new('RGB', (1200, 800), (10, 120, 30))})
+    response = client.get('/thumb/512/big.jpg', headers=JPEG)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert Image.open(io.BytesIO(response.data)).size == (512, 341)
+    assert client.get('/thumb/300/big.jpg').status_code == 404
+
+def test_identical_files_share_cache_entries(app, client, add_photos):
+    image = Image.new('RGB', (800, 600), (200, 40, 90))
+    add_photos({'same-a.jpg': image, 'same-b.jpg': image})
+
+    first = client.get('/thumb/1024/same-a.jpg', headers=JPEG)
+    before = cache_files(app)
+    second = client.get('/thumb/1024/same-b.jpg', headers=JPEG)
+    assert second.data == first.data
+    assert cache_files(app) == before
+
+def test_touched_and_renamed_files_keep_their_thumbnails(app, client, workspace, add_photos):
+    add_photos({'keep.jpg': Image.new('RGB', (900, 600), (5, 5, 250))})
+    client.get('/thumb/1024/keep.jpg', headers=JPEG)
+    before = cache_files(app)
+
+    path = workspace / 'photos' / 'keep.jpg'
+    stat = path.stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 60))
+    path.rename(workspace / 'photos' / 'kept.jpg')
+    add_photos({})
+    assert client.get('/thumb/1024/kept.jpg', headers=JPEG).status_code == 200
+    assert cache_files(app) == before
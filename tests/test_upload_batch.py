@@ -0,0 +1,70 @@
+"""Uploading several files in one request with /api/upload-batch."""
+import io
+import os
+from PIL import Image
+from database import get_user_by_username, get_media_item
+
+
+def photo(colour):
+    buffer = io.BytesIO()
+    Image.new('RGB', (30, 20), colour).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def post_batch(client, files):
+    """files is a list of (filename, bytes), sent in order as parts named 'files'."""
+    return client.post('/api/upload-batch', data={'files': [(io.BytesIO(data), name) for name, data in files]},
+                       content_type='multipart/form-data')
+
+def indexed(app, filename):
+    with app.app_context():
+        return get_media_item(get_user_by_username('admin')['id'], filename)
+
+
+def test_each_file_gets_its_own_result(app, client, workspace, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEDUPE_MODE', 'skip')
+    good, clip = photo((1, 200, 3)), os.urandom(2000)
+    response = post_batch(client, [
+        ('batch-good.jpg', good),
+        ('batch-clip.mp4', clip),
+        ('batch-broken.jpg', b'not an image'),
+        ('batch-script.exe', b'MZ'),
+        ('batch-good.jpg', photo((9, 9, 9))),
+        ('batch-copy.jpg', good),
+    ])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [(result['filename'], result['status'], result['saved_as'], result['duplicate'], result['error'])
+            for result in body['results']] == [
+        ('batch-good.jpg', 'ok', 'batch-good.jpg', False, None),
+        ('batch-clip.mp4', 'ok', 'batch-clip.mp4', False, None),
+        ('batch-broken.jpg', 'error', None, False, "Not a valid image"),
+        ('batch-script.exe', 'error', None, False, "File type not allowed"),
+        ('batch-good.jpg', 'error', None, False, "Duplicate file name in this batch"),
+        ('batch-copy.jpg', 'ok', 'batch-good.jpg', True, None),
+    ]
+    assert (body['saved'], body['duplicates'], body['failed']) == (2, 1, 3)
+
+    assert (workspace / 'photos' / 'batch-good.jpg').read_bytes() == good
+    assert (workspace / 'videos' / 'batch-clip.mp4').read_bytes() == clip
+    for name in ('batch-broken.jpg', 'batch-script.exe', 'batch-copy.jpg'):
+        assert not (workspace / 'photos' / name).exists()
+    assert indexed(app, 'batch-good.jpg')['kind'] == 'photo'
+    assert indexed(app, 'batch-clip.mp4')['kind'] == 'video'
+    assert indexed(app, 'batch-broken.jpg') is None
+    # No temp files are left behind by the failed or skipped uploads
+    assert not [name for name in os.listdir(workspace / 'photos') if name.startswith('.')]
+
+def test_taken_name_gets_a_numbered_variant(app, client, workspace):
+    post_batch(client, [('batch-taken.jpg', photo((50, 50, 50)))])
+    result = post_batch(client, [('batch-taken.jpg', photo((60, 60, 60)))]).get_json()['results'][0]
+    assert (result['status'], result['saved_as']) == ('ok', 'batch-taken_1.jpg')
+    assert indexed(app, 'batch-taken_1.jpg') is not None
+
+def test_batch_limits(app, client, monkeypatch):
+    response = client.post('/api/upload-batch', data={}, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+    monkeypatch.setitem(app.config, 'UPLOAD_BATCH_MAX_FILES', 2)
+    response = post_batch(client, [(f"batch-limit-{i}.jpg", photo((i, i, i))) for i in range(3)])
+    assert response.status_code == 413
+    assert indexed(app, 'batch-limit-0.jpg') is None
@@ -0,0 +1,84 @@
+"""The resumable upload API."""
+import os
+import uploads
+from database import get_upload_session
+
+CONTENT = os.urandom(3000)
+
+
+def start(client, name):
+    response = client.post('/api/uploads', json={'filename': name, 'size': len(CONTENT)})
+    assert response.status_code == 201
+    return response.get_json()['upload_id']
+
+
+def test_chunks_then_finalize(client, workspace):
+    upload_id = start(client, 'chunked.mp4')
+    assert client.put(f'/api/uploads/{upload_id}?offset=0', data=CONTENT[:1000]).get_json()['offset'] == 1000
+
+    response = client.put(f'/api/uploads/{upload_id}?offset=0', data=CONTENT[:1000])
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 1000
+
+    client.put(f'/api/uploads/{upload_id}?offset=1000', data=CONTENT[1000:])
+    response = client.post(f'/api/uploads/{upload_id}/finalize')
+    assert response.status_code == 200
+    assert (workspace / 'videos' / response.get_json()['filename']).read_bytes() == CONTENT
+
+def test_overlapping_chunk_gets_json_conflict(client, monkeypatch):
+    upload_id = start(client, 'busy.mp4')
+    monkeypatch.setattr(uploads, '_writing', {upload_id})
+
+    response = client.put(f'/api/uploads/{upload_id}?offset=0', data=CONTENT[:100])
+    assert response.status_code == 409
+    assert response.is_json
+    assert response.get_json()['upload_id'] == upload_id
+    assert response.get_json()['offset'] == 0
+    assert response.headers['Retry-After'] == '1'
+
+def test_failed_finalize_keeps_session_and_temp_file(app, client, monkeypatch):
+    upload_id = start(client, 'failing.mp4')
+    client.put(f'/api/uploads/{upload_id}?offset=0', data=CONTENT)
+
+    def broken_store_file(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(uploads, 'store_file', broken_store_file)
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    try:
+        assert client.post(f'/api/uploads/{upload_id}/finalize').status_code == 500
+    finally:
+        app.config['PROPAGATE_EXCEPTIONS'] = None
+
+    with app.app_context():
+        upload = get_upload_session(upload_id, 1)
+    assert upload is not None
+    assert os.path.exists(upload['temp_path'])
+
+    # Once storing works again, finalizing can be retried
+    monkeypatch.undo()
+    response = client.post(f'/api/uploads/{upload_id}/finalize')
+    assert response.status_code == 200
+    assert not os.path.exists(upload['temp_path'])
+    with app.app_context():
+        assert get_upload_session(upload_id, 1) is None
+
+def test_unreadable_temp_file_does_not_lock_the_upload(app, client, monkeypatch):
+    upload_id = start(client, 'unreadable.mp4')
+    client.put(f'/api/uploads/{upload_id}?offset=0', data=CONTENT[:1000])
+    with app.app_context():
+        temp_path = get_upload_session(upload_id, 1)['temp_path']
+
+    # After a restart the running hash is rebuilt from the temp file, which has gone missing
+    monkeypatch.setattr(uploads, '_hashers', {})
+    os.rename(temp_path, temp_path + '.away')
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    try:
+        assert client.put(f'/api/uploads/{upload_id}?offset=1000', data=CONTENT[1000:]).status_code == 500
+    finally:
+        app.config['PROPAGATE_EXCEPTIONS'] = None
+
+    os.rename(temp_path + '.away', temp_path)
+    response = client.put(f'/api/uploads/{upload_id}?offset=1000', data=CONTENT[1000:])
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == len(CONTENT)
+    assert client.post(f'/api/uploads/{upload_id}/finalize').status_code == 200
@@ -0,0 +1,72 @@
+"""The media directory watcher."""
+import io
+import os
+import time
+import pytest
+from PIL import Image
+from database import add_new_user, get_user_by_username, get_media_item
+from watcher import MediaWatcher
+
+
+@pytest.fixture
+def watched_user(app, tmp_path):
+    (tmp_path / 'photos').mkdir()
+    (tmp_path / 'videos').mkdir()
+    with app.app_context():
+        add_new_user(tmp_path.name, 'watched', str(tmp_path / 'photos'), str(tmp_path / 'videos'))
+        return get_user_by_username(tmp_path.name)
+
+def test_watches_are_added_before_start_returns(app, tmp_path, watched_user, monkeypatch):
+    # Keep the background thread out of it: only what start() itself set up counts
+    monkeypatch.setattr(MediaWatcher, 'run', lambda self: None)
+    watcher = MediaWatcher(app, 'inotify')
+    watcher.start()
+    try:
+        assert str(tmp_path / 'photos') in watcher.watches
+
+        # A file added between start() and the startup scan is still seen
+        Image.new('RGB', (20, 20)).save(tmp_path / 'photos' / 'early.jpg')
+        watcher.handle_events(watcher.inotify.read_events(timeout=1))
+        with app.app_context():
+            assert get_media_item(watched_user['id'], 'early.jpg') is not None
+    finally:
+        watcher.inotify.close()
+
+def test_polled_directories_get_checkpoints_before_start_returns(app, tmp_path, watched_user, monkeypatch):
+    monkeypatch.setattr(MediaWatcher, 'run', lambda self: None)
+    watcher = MediaWatcher(app, 'poll')
+    watcher.start()
+    assert str(tmp_path / 'photos') in watcher.checkpoints
+
+    time.sleep(0.05)  # Past the filesystem's timestamp granularity, so the directory mtime moves
+    Image.new('RGB', (20, 20)).save(tmp_path / 'photos' / 'polled.jpg')
+    watcher.poll()
+    with app.app_context():
+        assert get_media_item(watched_user['id'], 'polled.jpg') is not None
+
+def test_files_are_picked_up_once_written(app, tmp_path, watched_user, monkeypatch):
+    monkeypatch.setattr(MediaWatcher, 'run', lambda self: None)
+    watcher = MediaWatcher(app, 'inotify')
+    watcher.start()
+    try:
+        data = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(data, 'JPEG')
+        with open(tmp_path / 'photos' / 'copying.jpg', 'wb') as f:
+            f.write(data.getvalue()[:100])
+            f.flush()
+            watcher.handle_events(watcher.inotify.read_events(timeout=1))
+            with app.app_context():
+                assert get_media_item(watched_user['id'], 'copying.jpg') is None
+            f.write(data.getvalue()[100:])
+        watcher.handle_events(watcher.inotify.read_events(timeout=1))
+        with app.app_context():
+            assert get_media_item(watched_user['id'], 'copying.jpg')['size'] == len(data.getvalue())
+
+        # A hardlink is complete as soon as it appears, and gets no IN_CLOSE_WRITE
+        Image.new('RGB', (20, 20)).save(tmp_path / 'original.jpg')
+        os.link(tmp_path / 'original.jpg', tmp_path / 'photos' / 'linked.jpg')
+        watcher.handle_events(watcher.inotify.read_events(timeout=1))
+        with app.app_context():
+            assert get_media_item(watched_user['id'], 'linked.jpg') is not None
+    finally:
+        watcher.inotify.close()